@@ -1,11 +1,22 @@
 #ifndef CORRECTION_H
 #define CORRECTION_H
 
+#include <cstdint>
+#include <iterator>
 #include <string>
 #include <vector>
 #include <variant>
 #include <map>
+#include <set>
+#include <optional>
+#include <unordered_map>
 #include <memory>
+#include <mutex>
+#include <algorithm>
+#include <tuple>
+#include <limits>
+#include <cstring>
+#include <stdexcept>
 #include "correctionlib_version.h"
 
 namespace rapidjson {
@@ -22,17 +33,86 @@ namespace correction {
 
 constexpr int evaluator_version { 2 };
 
+// A JSON number parsed as in the documents loaded (which may differ from the
+// correctly rounded value in the last bit), for correctionlib.codegen
+double parse_number(const std::string& text);
+
+// internal: see LoadOptions::dedup
+class _ArrayPool;
+
+// Options that affect how a CorrectionSet is loaded
+struct LoadOptions {
+  // Allow formula optimizations that may change results in the last bits,
+  // such as rewriting integer powers as products, and for some special
+  // values: x^0.5 becomes sqrt(x), which is NaN rather than +inf at x = -inf
+  // and -0 rather than +0 at x = -0, and x + 0 becomes x, keeping the sign of
+  // a zero x. Without it, optimized formulas give bitwise identical results
+  // to the expressions as written.
+  bool fast_math {false};
+  // Shared library generated by correctionlib.codegen for this document, to
+  // evaluate the corrections it contains with instead of interpreting them.
+  // Its formulas are evaluated as written, so it cannot be used with fast_math
+  std::string compiled;
+  // Number of threads to build the corrections of a CorrectionSet on
+  // (0: one per hardware thread). With one, they are built while the JSON is
+  // parsed; otherwise it is parsed whole first, which takes more memory
+  size_t threads {1};
+  // Only find the corrections in the document when loading, and build each
+  // one when it is first accessed, so that errors in it are raised then
+  bool lazy {false};
+  // Directory where CorrectionSet::from_file keeps the binary form of each
+  // document it loads, named by a hash of the document, to load instead of
+  // the JSON next time (not used with lazy or only)
+  std::string cache_dir;
+  // If given, only the corrections of these names are built. The data of the
+  // others is skipped while parsing, with little checking: they are listed
+  // with their name, version, inputs and output, but cannot be evaluated.
+  // Names that no correction of the document has are an error
+  std::optional<std::set<std::string>> only;
+  // Share one instance of identical subtrees within each correction, and of
+  // identical bin edges across all corrections of a CorrectionSet, rather
+  // than building each occurrence (see CorrectionSet::dedup_savings)
+  bool dedup {false};
+  // internal: where the corrections of a CorrectionSet share their edges
+  std::shared_ptr<_ArrayPool> _arrays;
+};
+
+// internal: streams of the binary format of CorrectionSet::to_binary
+class _BinaryWriter;
+class _BinaryReader;
+// internal: reads a JSON document piece by piece while it is parsed
+class _JsonReader;
+
+// A non-owning view of one input over a batch of evaluations
+// A stride of zero broadcasts the single value at data to every row
+template<typename T>
+struct Column {
+  const T* data;
+  size_t stride;
+  const T& operator[](size_t i) const { return data[i * stride]; };
+};
+
+// The interned id of a value of a string input (see Correction::string_id),
+// which may be given in place of the string; -1 for an unknown string
+struct StringId {
+  int id;
+};
+
 class Variable {
   public:
     enum class VarType {string, integer, real};
-    typedef std::variant<int, double, std::string> Type;
+    typedef std::variant<int, double, std::string, StringId> Type;
+    typedef std::variant<Column<int>, Column<double>, Column<std::string>, Column<StringId>> BatchType;
 
     Variable(const rapidjson::Value& json);
+    Variable(_BinaryReader& in);
+    void write(_BinaryWriter& out) const;
     std::string name() const { return name_; };
     std::string description() const { return description_; };
     VarType type() const { return type_; };
     std::string typeStr() const;
     void validate(const Type& t) const;
+    void validate(const BatchType& t) const;
 
   private:
     std::string name_;
@@ -46,8 +126,44 @@ class Transform;
 class Binning;
 class MultiBinning;
 class Category;
-typedef std::variant<double, Formula, FormulaRef, Transform, Binning, MultiBinning, Category> Content;
 class Correction;
+class _NodeArena;
+
+// A node of a correction: either a number, or a handle to a node of one of
+// the other types, which are kept in the _NodeArena of the correction.
+// Numbers are stored as themselves, and handles as a NaN (which no number in
+// a correction is) with the type and index in its payload, so that a Content
+// takes no more space than a double
+class Content {
+  public:
+    // in the order of the node types of the binary format
+    enum class Type : uint8_t {number, formula, formularef, transform, binning, multibinning, category};
+
+    Content(double value = 0.) {
+      // any NaN given is kept as the one that is not a handle
+      if ( value != value ) value = std::numeric_limits<double>::quiet_NaN();
+      std::memcpy(&bits_, &value, sizeof(bits_));
+    };
+    Content(Type type, uint32_t index) : bits_(handle_bits | ((uint64_t) type << 32) | index) {};
+    Type type() const {
+      return ( (bits_ & handle_bits) == handle_bits ) ? (Type) ((bits_ >> 32) & 0xff) : Type::number;
+    };
+    bool number() const { return (bits_ & handle_bits) != handle_bits; };
+    // only for numbers
+    double value() const {
+      double value;
+      std::memcpy(&value, &bits_, sizeof(value));
+      return value;
+    };
+    // only for handles
+    uint32_t index() const { return (uint32_t) bits_; };
+
+  private:
+    // sign, exponent and quiet bit all set, and the next bit as well
+    static constexpr uint64_t handle_bits { 0xfffc000000000000 };
+    uint64_t bits_;
+};
+static_assert(sizeof(Content) == sizeof(double));
 
 class FormulaAst {
   public:
@@ -76,8 +192,27 @@ class FormulaAst {
       Pow,
     };
     enum class UnaryOp { Negative };
-    typedef double (*UnaryFcn)(double);
-    typedef double (*BinaryFcn)(double, double);
+    enum class UnaryFcn {
+      Log,
+      Log10,
+      Exp,
+      Erf,
+      Sqrt,
+      Abs,
+      Cos,
+      Sin,
+      Tan,
+      Acos,
+      Asin,
+      Atan,
+      Cosh,
+      Sinh,
+      Tanh,
+      Acosh,
+      Asinh,
+      Atanh,
+    };
+    enum class BinaryFcn { Atan2, Pow, Max, Min };
     typedef std::variant<
       std::monostate,
       double, // literal/parameter
@@ -97,40 +232,163 @@ class FormulaAst {
         const std::vector<size_t>& variableIdx,
         bool bind_parameters
         );
+    // Parses a TFormula expression with the peglib grammar, which the
+    // dedicated parser used by parse is checked against
+    static FormulaAst parse_reference(
+        const std::string_view expression,
+        const std::vector<double>& params,
+        const std::vector<size_t>& variableIdx,
+        bool bind_parameters
+        );
 
     FormulaAst() : nodetype_(NodeType::Undefined) {};
     FormulaAst(NodeType nodetype, NodeData data, Children children) :
-      nodetype_(nodetype), data_(data), children_(children) {};
+      nodetype_(nodetype), data_(data), children_(std::move(children)) {};
+    NodeType nodetype() const { return nodetype_; };
+    const NodeData& data() const { return data_; };
+    const Children& children() const { return children_; };
+    // Returns an equivalent tree with constant subexpressions folded and
+    // trivial operations removed; see LoadOptions::fast_math
+    FormulaAst simplify(bool fast_math) const;
+    // A C++ expression of the same value, in terms of double x[i] for the
+    // input with index i and p[i] for the parameters that are not bound
+    std::string source() const;
     double evaluate(const std::vector<Variable::Type>& variables, const std::vector<double>& parameters) const;
 
+    static double apply(UnaryFcn fcn, double x);
+    static double apply(BinaryFcn fcn, double x, double y);
+    static double apply(BinaryOp op, double left, double right);
+
   private:
     NodeType nodetype_;
     NodeData data_;
     Children children_;
 };
 
+// A FormulaAst flattened into postfix order, evaluated on a value stack
+class FormulaProgram {
+  public:
+    // one opcode per operation so that evaluation is a single switch
+    enum class OpCode : uint8_t {
+      Literal,
+      Variable,
+      Parameter,
+      // load or store (without popping) the result of a common subexpression
+      Load,
+      Store,
+      Negative,
+      // unary functions, in the order of FormulaAst::UnaryFcn
+      Log,
+      Log10,
+      Exp,
+      Erf,
+      Sqrt,
+      Abs,
+      Cos,
+      Sin,
+      Tan,
+      Acos,
+      Asin,
+      Atan,
+      Cosh,
+      Sinh,
+      Tanh,
+      Acosh,
+      Asinh,
+      Atanh,
+      // binary functions and operators
+      Atan2,
+      Pow,
+      Max,
+      Min,
+      Equal,
+      NotEqual,
+      Greater,
+      Less,
+      GreaterEq,
+      LessEq,
+      Minus,
+      Plus,
+      Div,
+      Times,
+    };
+    struct Instruction {
+      OpCode op;
+      // constant, variable, parameter, or local index
+      uint32_t arg;
+    };
+
+    FormulaProgram(const FormulaAst& ast);
+    // ninputs: number of inputs of the correction, to check the variables against
+    FormulaProgram(_BinaryReader& in, size_t ninputs);
+    void write(_BinaryWriter& out) const;
+    const std::vector<Instruction>& code() const { return code_; };
+    const std::vector<double>& constants() const { return constants_; };
+    size_t stack_size() const { return stack_size_; };
+    // number of common subexpression results kept during evaluation
+    size_t nlocals() const { return nlocals_; };
+    // number of parameters used (largest parameter index + 1)
+    size_t nparameters() const { return nparameters_; };
+    // indices of the inputs used, in increasing order
+    const std::vector<size_t>& variables() const { return variables_; };
+    double evaluate(const std::vector<Variable::Type>& variables, const std::vector<double>& parameters) const;
+    // Evaluate n rows at once, applying each instruction to a block of rows
+    // before moving on to the next. variables[i] points to the n values of
+    // input i, and may be null for the inputs not used
+    void evaluate(size_t n, const std::vector<const double*>& variables, const std::vector<double>& parameters, double* output) const;
+
+  private:
+    struct Subexpressions;
+    size_t compile(const FormulaAst& ast, size_t depth, Subexpressions& subexpressions);
+    // locals are stored after the stack_size() values of the stack
+    double run(double* stack, const std::vector<Variable::Type>& variables, const std::vector<double>& parameters) const;
+    // as run, for m rows starting at row start, with a stack of columns of
+    // block values each
+    void run(double* stack, size_t block, size_t start, size_t m, const std::vector<const double*>& variables, const std::vector<double>& parameters, double* output) const;
+
+    std::vector<Instruction> code_;
+    std::vector<double> constants_;
+    size_t stack_size_;
+    size_t nlocals_;
+    size_t nparameters_;
+    std::vector<size_t> variables_;
+};
+
 class Formula {
   public:
     typedef std::shared_ptr<const Formula> Ref;
 
     Formula(const rapidjson::Value& json, const Correction& context, bool generic = false);
+    Formula(_BinaryReader& in, const Correction& context);
+    void write(_BinaryWriter& out) const;
     std::string expression() const { return expression_; };
     double evaluate(const std::vector<Variable::Type>& values) const;
     double evaluate(const std::vector<Variable::Type>& values, const std::vector<double>& parameters) const;
+    // column-wise evaluation of n rows; see FormulaProgram
+    void evaluate(size_t n, const std::vector<const double*>& columns, double* output) const;
+    void evaluate(size_t n, const std::vector<const double*>& columns, const std::vector<double>& parameters, double* output) const;
+
+    const FormulaProgram& program() const { return program_; };
 
   private:
     std::string expression_;
     FormulaAst::ParserType type_;
-    std::unique_ptr<FormulaAst> ast_;
+    FormulaProgram program_;
     bool generic_;
 };
 
 class FormulaRef {
   public:
     FormulaRef(const rapidjson::Value& json, const Correction& context);
+    FormulaRef(_BinaryReader& in, const Correction& context);
+    void write(_BinaryWriter& out) const;
+    const Formula& formula() const { return *formula_; };
     double evaluate(const std::vector<Variable::Type>& values) const;
+    void evaluate(size_t n, const std::vector<const double*>& columns, double* output) const;
 
   private:
+    // index of the formula in the generic formulas of the correction
+    size_t index_;
     Formula::Ref formula_;
     std::vector<double> parameters_;
 };
@@ -138,24 +396,214 @@ class FormulaRef {
 class Transform {
   public:
     Transform(const rapidjson::Value& json, const Correction& context);
-    double evaluate(const std::vector<Variable::Type>& values) const;
+    Transform(_JsonReader& in, const Correction& context);
+    Transform(_BinaryReader& in, const Correction& context);
+    void write(_BinaryWriter& out, const _NodeArena& nodes) const;
+    double evaluate(const _NodeArena& nodes, const std::vector<Variable::Type>& values) const;
+    size_t input() const { return variableIdx_; };
+    Content rule() const { return rule_; };
+    Content content() const { return content_; };
 
   private:
     size_t variableIdx_;
-    std::unique_ptr<const Content> rule_;
-    std::unique_ptr<const Content> content_;
+    Content rule_;
+    Content content_;
+};
+
+// internal for Category and _LeafArray
+// Maps integer keys to positions, by direct indexing if the keys span a small
+// range and by an open-addressing hash table otherwise
+class _IntIndex {
+  public:
+    static constexpr uint32_t npos = UINT32_MAX;
+
+    // keys[i] maps to position i
+    _IntIndex(const std::vector<int>& keys);
+    // size: number of positions indexed, to check them against
+    _IntIndex(_BinaryReader& in, uint32_t size);
+    void write(_BinaryWriter& out) const;
+    bool direct() const { return direct_; };
+    uint32_t find(int key) const {
+      if ( direct_ ) {
+        // unsigned wraparound sends keys below offset_ out of range as well
+        const uint32_t i = (uint32_t) key - (uint32_t) offset_;
+        return ( i < slots_.size() ) ? slots_[i] : npos;
+      }
+      for (uint32_t i = hash(key); ; i = (i + 1) & mask_) {
+        const auto& [k, pos] = table_[i];
+        if ( pos == npos || k == key ) return pos;
+      }
+    };
+
+  private:
+    uint32_t hash(int key) const { return ((uint32_t) key * 2654435769u) >> shift_; };
+
+    bool direct_;
+    // direct indexing
+    int offset_;
+    std::vector<uint32_t> slots_;
+    // hash table with linear probing, at most half full
+    std::vector<std::pair<int, uint32_t>> table_;
+    uint32_t mask_;
+    int shift_;
+};
+
+// How the bins of a Binning or MultiBinning are stored (see _LeafArray and
+// Correction::leaf_encodings)
+enum class LeafEncoding {plain, sparse, dictionary};
+
+// common internal for Binning and MultiBinning
+// The content of their bins, chosen when loading from what it holds: as is
+// (plain), as the most common value with the positions of all others in an
+// _IntIndex (sparse), or as 8- or 16-bit indices into a table of the distinct
+// values (dictionary). A compressed encoding is only used where it takes at most
+// half the memory of the plain one
+template<typename T>
+class _LeafArray {
+  public:
+    _LeafArray() = default;
+    _LeafArray(std::vector<T> values);
+    LeafEncoding encoding() const { return encoding_; };
+    size_t size() const { return encoded_ ? encoded_->size : values_.size(); };
+    const T& operator[](size_t i) const {
+      if ( encoding_ == LeafEncoding::plain ) return values_[i];
+      const auto& encoded = *encoded_;
+      if ( encoding_ == LeafEncoding::sparse ) {
+        const uint32_t pos = encoded.exceptions.find((int) i);
+        return values_[( pos == _IntIndex::npos ) ? 0 : pos + 1];
+      }
+      return values_[encoded.wide.empty() ? encoded.narrow[i] : encoded.wide[i]];
+    };
+    const T& back() const { return (*this)[size() - 1]; };
+    // all values, in order
+    std::vector<T> values() const;
+
+  private:
+    struct Encoded {
+      size_t size;
+      // sparse: positions of the values other than the most common one
+      _IntIndex exceptions {{}};
+      // dictionary: position of each value in values_, one of both filled
+      std::vector<uint8_t> narrow;
+      std::vector<uint16_t> wide;
+    };
+
+    LeafEncoding encoding_ {LeafEncoding::plain};
+    // plain: all values; sparse: the most common value followed by the others
+    // in order; dictionary: the distinct values
+    std::vector<T> values_;
+    // null if plain
+    std::shared_ptr<const Encoded> encoded_;
 };
 
 // common internal for Binning and MultiBinning
 enum class _FlowBehavior {value, clamp, error};
 
+// common internal for Binning and MultiBinning
+// Uniform edges are stored as (low, high, n) only and the bin is computed
+// arithmetically. Explicit edges that are uniform within rounding keep their
+// values, and the arithmetic bin is corrected against them; other edges are
+// searched, in a way chosen by their number: a branch-free count for a few,
+// a branchless binary search for up to about a thousand, and beyond that a
+// descent of a copy laid out as a complete binary tree in breadth-first
+// (Eytzinger) order, whose upper levels share a few cache lines
+class _BinEdges {
+  public:
+    // no bins, until assigned
+    _BinEdges() = default;
+    _BinEdges(const rapidjson::Value& json);
+    // explicit edges
+    _BinEdges(std::vector<double> edges);
+    _BinEdges(_BinaryReader& in);
+    void write(_BinaryWriter& out) const;
+    // only to be used while loading: shares the edges with equal ones
+    void share(_ArrayPool& pool);
+    size_t nbins() const { return n_; };
+    bool uniform() const { return uniform_; };
+    // Returns the equivalent of std::upper_bound(edges) - std::begin(edges), i.e.
+    // 0 for underflow, nbins() + 1 for overflow (and NaN), otherwise the bin index + 1
+    size_t find(double value) const {
+      if ( uniform_ ) {
+        if ( value < low_ ) return 0;
+        if ( ! (value < high_) ) return n_ + 1;
+        size_t i = std::min((size_t) ((value - low_) * scale_), n_ - 1);
+        if ( edges_ ) {
+          // correct for rounding in the arithmetic
+          const auto& edges = *edges_;
+          while ( value < edges[i] ) --i;
+          while ( value >= edges[i + 1] ) ++i;
+        }
+        return i + 1;
+      }
+      const auto& edges = *edges_;
+      if ( search_ == Search::linear ) {
+        size_t count {0};
+        for (double edge : edges) count += ! (value < edge);
+        return count;
+      }
+      if ( search_ == Search::binary ) {
+        const double* base = edges.data();
+        for (size_t size = edges.size(); size > 1; ) {
+          const size_t half = size / 2;
+          base += ( ! (value < base[half]) ) * half;
+          size -= half;
+        }
+        return (base - edges.data()) + ! (value < *base);
+      }
+      // the leaf reached, counted from the left, is the number of edges not
+      // above the value, padding (+inf) included
+      const auto& tree = *tree_;
+      size_t k {1};
+      for (uint8_t level=0; level < levels_; ++level) k = 2 * k + ! (value < tree[k]);
+      return std::min(k - tree.size(), edges.size());
+    };
+    // find() of each of size values into out
+    void find(size_t size, const double* values, size_t* out) const;
+
+  private:
+    enum class Search : uint8_t {linear, binary, tree};
+    // picks the search for explicit edges, and builds the tree for it
+    void plan();
+
+    // null for uniform edges that are not kept
+    std::shared_ptr<const std::vector<double>> edges_;
+    // only for Search::tree: the edges padded with +inf to 2^levels_ - 1, at
+    // 1 for the root and 2k, 2k + 1 for the children of k
+    std::shared_ptr<const std::vector<double>> tree_;
+    Search search_ {Search::binary};
+    uint8_t levels_ {0};
+    bool uniform_ {false};
+    double low_ {0.};
+    double high_ {0.};
+    double scale_ {0.};
+    size_t n_ {0};
+};
+
+// internal for batch evaluation: the branch of a row that a node cannot take,
+// so that the row is evaluated on its own to report why
+constexpr size_t _nobranch {SIZE_MAX};
+
 class Binning {
   public:
     Binning(const rapidjson::Value& json, const Correction& context);
+    Binning(_JsonReader& in, const Correction& context);
+    Binning(_BinaryReader& in, const Correction& context);
+    void write(_BinaryWriter& out, const _NodeArena& nodes) const;
+    // only to be used while loading; see LoadOptions::dedup
+    void share(_ArrayPool& pool) { edges_.share(pool); };
     const Content& child(const std::vector<Variable::Type>& values) const;
+    // only for batch evaluation: the branch taken by each of n rows, which
+    // stands for branch(i), or _nobranch
+    void branches(const std::vector<Variable::BatchType>& values, const size_t* rows, size_t n, size_t* out) const;
+    size_t nbranches() const { return bins_.size(); };
+    Content branch(size_t i) const { return bins_[i]; };
+    LeafEncoding encoding() const { return bins_.encoding(); };
+    size_t size() const { return bins_.size(); };
 
   private:
-    std::vector<std::tuple<double, Content>> bins_;
+    _BinEdges edges_;
+    // content of each bin, followed by the default value
+    _LeafArray<Content> bins_;
     size_t variableIdx_;
     _FlowBehavior flow_;
 };
@@ -163,32 +611,169 @@ class Binning {
 class MultiBinning {
   public:
     MultiBinning(const rapidjson::Value& json, const Correction& context);
+    MultiBinning(_JsonReader& in, const Correction& context);
+    MultiBinning(_BinaryReader& in, const Correction& context);
+    void write(_BinaryWriter& out, const _NodeArena& nodes) const;
+    // only to be used while loading; see LoadOptions::dedup
+    void share(_ArrayPool& pool) {
+      for (auto& axis : axes_) std::get<2>(axis).share(pool);
+    };
     size_t ndimensions() const { return axes_.size(); };
+    bool dense() const { return std::holds_alternative<_LeafArray<double>>(content_); };
+    double evaluate(const _NodeArena& nodes, const std::vector<Variable::Type>& values) const;
+    // only for MultiBinnings that are not dense()
     const Content& child(const std::vector<Variable::Type>& values) const;
+    // only for batch evaluation, as for Binning; branches of dense MultiBinnings are numbers
+    void branches(const std::vector<Variable::BatchType>& values, const size_t* rows, size_t n, size_t* out) const;
+    size_t nbranches() const { return size(); };
+    Content branch(size_t i) const {
+      if ( auto dense = std::get_if<_LeafArray<double>>(&content_) ) return (*dense)[i];
+      return std::get<_LeafArray<Content>>(content_)[i];
+    };
+    LeafEncoding encoding() const {
+      return std::visit([](const auto& content) { return content.encoding(); }, content_);
+    };
+    size_t size() const {
+      return std::visit([](const auto& content) { return content.size(); }, content_);
+    };
 
   private:
+    // flat index into the content, where the default value is stored at the end
+    size_t index(const std::vector<Variable::Type>& values) const;
+
     // variableIdx, stride, edges
-    std::vector<std::tuple<size_t, size_t, std::vector<double>>> axes_;
-    std::vector<Content> content_;
+    std::vector<std::tuple<size_t, size_t, _BinEdges>> axes_;
+    // stored as a flat array of doubles if all content (and default) is numeric
+    std::variant<_LeafArray<double>, _LeafArray<Content>> content_;
     _FlowBehavior flow_;
 };
 
+// internal: ids of the string keys of all Category nodes of one string input
+typedef std::unordered_map<std::string, int> _StringIds;
+
 class Category {
   public:
     Category(const rapidjson::Value& json, const Correction& context);
+    Category(_JsonReader& in, const Correction& context);
+    Category(_BinaryReader& in, const Correction& context);
+    void write(_BinaryWriter& out, const _NodeArena& nodes) const;
     const Content& child(const std::vector<Variable::Type>& values) const;
+    // only for batch evaluation, as for Binning; the default is the last branch
+    void branches(const std::vector<Variable::BatchType>& values, const size_t* rows, size_t n, size_t* out) const;
+    size_t nbranches() const { return content_.size() + 1; };
+    Content branch(size_t i) const { return ( i < content_.size() ) ? content_[i] : *default_; };
 
   private:
-    typedef std::map<int, Content> IntMap;
-    typedef std::map<std::string, Content> StrMap;
-    std::variant<IntMap, StrMap> map_;
-    std::unique_ptr<const Content> default_;
+    // positions in content_ of each integer key, or string key id
+    _IntIndex index_;
+    // null unless the input is a string
+    std::shared_ptr<const _StringIds> string_ids_;
+    std::vector<Content> content_;
+    std::optional<Content> default_;
     size_t variableIdx_;
 };
 
+// internal: the nodes of one Correction other than numbers, in one contiguous
+// array per type, that Content handles index into
+class _NodeArena {
+  public:
+    template<typename T>
+    Content add(T&& node) {
+      auto& nodes = std::get<std::vector<T>>(nodes_);
+      if ( nodes.size() >= UINT32_MAX ) {
+        throw std::runtime_error("Too many nodes in correction");
+      }
+      nodes.push_back(std::move(node));
+      return Content(type<T>(), nodes.size() - 1);
+    };
+    template<typename T>
+    const T& get(const Content& node) const { return std::get<std::vector<T>>(nodes_)[node.index()]; };
+    // all nodes of one type, in the order they were added
+    template<typename T>
+    const std::vector<T>& all() const { return std::get<std::vector<T>>(nodes_); };
+    // Calls f with the number or node that node stands for
+    template<typename F>
+    decltype(auto) visit(F&& f, const Content& node) const {
+      switch ( node.type() ) {
+        case Content::Type::formula: return f(get<Formula>(node));
+        case Content::Type::formularef: return f(get<FormulaRef>(node));
+        case Content::Type::transform: return f(get<Transform>(node));
+        case Content::Type::binning: return f(get<Binning>(node));
+        case Content::Type::multibinning: return f(get<MultiBinning>(node));
+        case Content::Type::category: return f(get<Category>(node));
+        default: return f(node.value());
+      }
+    };
+    // frees the room left to grow into, once loaded
+    void shrink_to_fit() {
+      std::apply([](auto&... nodes) { (nodes.shrink_to_fit(), ...); }, nodes_);
+    };
+
+  private:
+    template<typename T>
+    static constexpr Content::Type type() {
+      if constexpr ( std::is_same_v<T, Formula> ) return Content::Type::formula;
+      else if constexpr ( std::is_same_v<T, FormulaRef> ) return Content::Type::formularef;
+      else if constexpr ( std::is_same_v<T, Transform> ) return Content::Type::transform;
+      else if constexpr ( std::is_same_v<T, Binning> ) return Content::Type::binning;
+      else if constexpr ( std::is_same_v<T, MultiBinning> ) return Content::Type::multibinning;
+      else return Content::Type::category;
+    };
+
+    std::tuple<
+      std::vector<Formula>,
+      std::vector<FormulaRef>,
+      std::vector<Transform>,
+      std::vector<Binning>,
+      std::vector<MultiBinning>,
+      std::vector<Category>
+    > nodes_;
+};
+
+// Layout of the tables exported by shared libraries from correctionlib.codegen
+struct CompiledStringId {
+  size_t input;
+  const char* value;
+  int id;
+};
+
+struct CompiledCorrection {
+  const char* name;
+  size_t ninputs;
+  // the interned string ids the code was generated with
+  const CompiledStringId* string_ids;
+  size_t nstring_ids;
+  // Correction::definition_hash of the correction the code was generated from
+  uint64_t definition_hash;
+  // all inputs as doubles, with strings given as their interned ids
+  double (*evaluate)(const double* values);
+};
+
+// A shared library generated by correctionlib.codegen
+class CompiledLibrary {
+  public:
+    // version of the exported tables
+    static constexpr int abi_version { 2 };
+
+    CompiledLibrary(const std::string& filename);
+    ~CompiledLibrary();
+    CompiledLibrary(const CompiledLibrary&) = delete;
+    CompiledLibrary& operator=(const CompiledLibrary&) = delete;
+    // nullptr if the library has no such correction
+    const CompiledCorrection* find(const std::string& name) const;
+
+  private:
+    void* handle_;
+    const CompiledCorrection* corrections_;
+    size_t ncorrections_;
+};
+
 class Correction {
   public:
-    Correction(const rapidjson::Value& json);
+    Correction(const rapidjson::Value& json, const LoadOptions& options = {});
+    Correction(_JsonReader& in, const LoadOptions& options = {});
+    Correction(_BinaryReader& in, const LoadOptions& options = {});
+    void write(_BinaryWriter& out) const;
     std::string name() const { return name_; };
     std::string description() const { return description_; };
     int version() const { return version_; };
@@ -196,38 +781,171 @@ class Correction {
     size_t input_index(const std::string_view name) const;
     Formula::Ref formula_ref(size_t idx) const { return formula_refs_.at(idx); };
     const Variable& output() const { return output_; };
+    const LoadOptions& options() const { return options_; };
+    // Evaluate with the compiled code of this correction in library from now
+    // on; throws if it was not generated from the same correction
+    void use_compiled(const std::shared_ptr<const CompiledLibrary>& library);
+    // A hash (64-bit FNV-1a) of the binary form of the correction as loaded,
+    // which changes with anything that may change its results
+    uint64_t definition_hash() const;
+    bool compiled() const { return compiled_ != nullptr; };
+    // false if left out by LoadOptions::only, so that only the description is there
+    bool loaded() const { return initialized_; };
+    // Strings used as Category keys are interned into integer ids when loading.
+    // A StringId may be given for a string input in place of the string, so
+    // callers may resolve each distinct string once; unknown strings have id -1
+    int string_id(size_t input, const std::string& value) const;
+    std::shared_ptr<const _StringIds> string_ids(size_t input) const { return string_ids_.at(input); };
+    // only to be used by Category nodes while loading
+    int intern_string(size_t input, const std::string& value) const;
+    // only to be used by nodes while loading: keeps node with the others,
+    // or returns an identical one instead with LoadOptions::dedup
+    template<typename T>
+    Content add_node(T&& node) const {
+      if ( options_.dedup ) return dedup(std::move(node));
+      return nodes_.add(std::move(node));
+    };
+    const _NodeArena& nodes() const { return nodes_; };
+    // approximate bytes of the subtrees found to be identical to another
+    // while loading with LoadOptions::dedup
+    size_t dedup_savings() const { return dedup_savings_; };
+    // type (binning or multibinning), encoding and number of values of the bins
+    // of each binned node, Binnings first, in the order they were built
+    std::vector<std::tuple<Content::Type, LeafEncoding, size_t>> leaf_encodings() const;
     double evaluate(const std::vector<Variable::Type>& values) const;
+    // threads: maximum number of threads to split the batch over (0: one per hardware thread)
+    // min_chunk: minimum number of rows evaluated by each task
+    void evaluate_batch(
+        size_t size,
+        const std::vector<Variable::BatchType>& values,
+        double* output,
+        size_t threads = 1,
+        size_t min_chunk = 4096
+        ) const;
 
   private:
+    // all but the data from json, which is read from in if given
+    Correction(const rapidjson::Value& json, _JsonReader* in, const LoadOptions& options);
+    template<typename T>
+    Content dedup(T&& node) const;
+    // once loaded
+    void finish();
+    void check_loaded() const;
+    void check_inputs(size_t size) const;
+    void check_string_id(size_t input, StringId value) const;
+    // the inputs as the compiled code takes them
+    void compiled_inputs(const std::vector<Variable::Type>& values, double* inputs) const;
+
     std::string name_;
     std::string description_;
     int version_;
     std::vector<Variable> inputs_;
     Variable output_;
+    LoadOptions options_;
     std::vector<Formula::Ref> formula_refs_;
+    // null for non-string inputs
+    std::vector<std::shared_ptr<_StringIds>> string_ids_;
     bool initialized_; // is data_ filled?
     Content data_;
+    // the nodes data_ refers to, filled while loading
+    mutable _NodeArena nodes_;
+    // identical nodes have the same key, see dedup()
+    mutable std::unordered_map<std::string, Content> dedup_keys_;
+    mutable size_t dedup_savings_ {0};
+    std::shared_ptr<const CompiledLibrary> library_;
+    const CompiledCorrection* compiled_ {nullptr};
 };
 
 typedef std::shared_ptr<const Correction> CorrectionPtr;
 
 class CorrectionSet {
   public:
-    static std::unique_ptr<CorrectionSet> from_file(const std::string& fn);
-    static std::unique_ptr<CorrectionSet> from_string(const char * data);
+    // Iterates over the (name, correction) pairs of a set, building those of a
+    // lazily loaded set as they are reached, as at() does
+    class const_iterator {
+      public:
+        typedef std::pair<const std::string&, CorrectionPtr> value_type;
+        typedef std::input_iterator_tag iterator_category;
+        typedef std::ptrdiff_t difference_type;
+        typedef const value_type* pointer;
+        typedef const value_type& reference;
+
+        const_iterator(const const_iterator& other) : set_(other.set_), it_(other.it_) {};
+        const_iterator& operator=(const const_iterator& other) {
+          set_ = other.set_;
+          it_ = other.it_;
+          current_.reset();
+          return *this;
+        };
+        // the name, without building the correction
+        const std::string& name() const { return it_->first; };
+        reference operator*() const {
+          current_.emplace(it_->first, set_->at(it_->first));
+          return *current_;
+        };
+        pointer operator->() const { return &**this; };
+        const_iterator& operator++() { ++it_; return *this; };
+        const_iterator operator++(int) { auto old = *this; ++it_; return old; };
+        bool operator==(const const_iterator& other) const { return it_ == other.it_; };
+        bool operator!=(const const_iterator& other) const { return it_ != other.it_; };
+
+      private:
+        friend class CorrectionSet;
+        const_iterator(const CorrectionSet* set, std::map<std::string, CorrectionPtr>::const_iterator it) : set_(set), it_(it) {};
+
+        const CorrectionSet* set_;
+        // the names of a set do not change once it is built, only the
+        // corrections of a lazily loaded one, which are read under its lock
+        std::map<std::string, CorrectionPtr>::const_iterator it_;
+        mutable std::optional<value_type> current_;
+    };
 
-    CorrectionSet(const rapidjson::Value& json);
+    // The file (or buffer) may be compressed with gzip, xz or zstd, if built
+    // with CORRECTIONLIB_ZLIB, CORRECTIONLIB_LZMA or CORRECTIONLIB_ZSTD
+    // respectively, and is then decompressed as it is parsed
+    static std::unique_ptr<CorrectionSet> from_file(const std::string& fn, const LoadOptions& options = {});
+    static std::unique_ptr<CorrectionSet> from_string(const char * data, const LoadOptions& options = {});
+    // JSON data of the given size, which need not be NUL-terminated
+    static std::unique_ptr<CorrectionSet> from_buffer(const char * data, size_t size, const LoadOptions& options = {});
+    // version of the format written by to_binary
+    static constexpr uint32_t binary_version { 1 };
+    // Load data written by to_binary, on a machine of the same byte order,
+    // with the fast_math setting it was written with
+    static std::unique_ptr<CorrectionSet> from_binary(const char * data, size_t size, const LoadOptions& options = {});
+    // The corrections as built, with formulas already parsed, for fast loading
+    std::string to_binary() const;
+
+    CorrectionSet(const rapidjson::Value& json, const LoadOptions& options = {});
     bool validate();
     int schema_version() const { return schema_version_; };
     auto size() const { return corrections_.size(); };
-    auto begin() const { return corrections_.cbegin(); };
-    auto end() const { return corrections_.cend(); };
-    CorrectionPtr at(const std::string& key) const { return corrections_.at(key); };
+    const_iterator begin() const { return {this, corrections_.cbegin()}; };
+    const_iterator end() const { return {this, corrections_.cend()}; };
+    CorrectionPtr at(const std::string& key) const;
     CorrectionPtr operator[](const std::string& key) const { return at(key); };
+    // approximate bytes saved by LoadOptions::dedup, over the corrections
+    // built so far
+    size_t dedup_savings() const;
 
   private:
+    // see LoadOptions::lazy; owner keeps the memory of document alive
+    CorrectionSet(std::shared_ptr<const void> owner, std::string_view document, const LoadOptions& options);
+    CorrectionSet(_BinaryReader& in, const LoadOptions& options);
+    // built while the document is parsed, where it is laid out as written by
+    // correctionlib (see _JsonReader)
+    CorrectionSet(_JsonReader& in, const LoadOptions& options);
+    // throws if LoadOptions::only names a correction not in the set
+    void check_only() const;
+
     int schema_version_;
-    std::map<std::string, CorrectionPtr> corrections_;
+    LoadOptions options_;
+    std::shared_ptr<const CompiledLibrary> library_;
+    // the document of a lazily loaded set, while some corrections are not built
+    mutable std::shared_ptr<const void> document_owner_;
+    mutable std::string_view document_;
+    mutable std::map<std::string, std::string_view> unbuilt_;
+    mutable std::map<std::string, CorrectionPtr> corrections_;
+    mutable std::mutex m_;
 };
 
 } // namespace correction
@@ -1,10 +1,39 @@
 #include <rapidjson/document.h>
-#include <rapidjson/filereadstream.h>
+#include <rapidjson/memorystream.h>
 #include <rapidjson/error/en.h>
 #include <optional>
 #include <algorithm>
 #include <stdexcept>
 #include <cmath>
+#include <atomic>
+#include <deque>
+#include <functional>
+#include <numeric>
+#include <mutex>
+#include <condition_variable>
+#include <thread>
+#include <unordered_set>
+#include <cstring>
+#include <chrono>
+#ifdef _WIN32
+#define NOMINMAX
+#include <windows.h>
+#else
+#include <dlfcn.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#endif
+#ifdef CORRECTIONLIB_ZLIB
+#include <zlib.h>
+#endif
+#ifdef CORRECTIONLIB_LZMA
+#include <lzma.h>
+#endif
+#ifdef CORRECTIONLIB_ZSTD
+#include <zstd.h>
+#endif
 #include "correction.h"
 
 using namespace correction;
@@ -22,15 +51,18 @@ namespace {
     return std::nullopt;
   }
 
+  // see below, with the constructors from a _JsonReader
+  Content resolve_content(_JsonReader& in, const Correction& context);
+
   Content resolve_content(const rapidjson::Value& json, const Correction& context) {
     if ( json.IsDouble() ) { return json.GetDouble(); }
-    else if ( json.HasMember("nodetype") ) {
-      if ( json["nodetype"] == "binning" ) { return Binning(json, context); }
-      else if ( json["nodetype"] == "multibinning" ) { return MultiBinning(json, context); }
-      else if ( json["nodetype"] == "category" ) { return Category(json, context); }
-      else if ( json["nodetype"] == "formula" ) { return Formula(json, context); }
-      else if ( json["nodetype"] == "formularef" ) { return FormulaRef(json, context); }
-      else if ( json["nodetype"] == "transform" ) { return Transform(json, context); }
+    else if ( json.IsObject() && json.HasMember("nodetype") ) {
+      if ( json["nodetype"] == "binning" ) { return context.add_node(Binning(json, context)); }
+      else if ( json["nodetype"] == "multibinning" ) { return context.add_node(MultiBinning(json, context)); }
+      else if ( json["nodetype"] == "category" ) { return context.add_node(Category(json, context)); }
+      else if ( json["nodetype"] == "formula" ) { return context.add_node(Formula(json, context)); }
+      else if ( json["nodetype"] == "formularef" ) { return context.add_node(FormulaRef(json, context)); }
+      else if ( json["nodetype"] == "transform" ) { return context.add_node(Transform(json, context)); }
     }
     throw std::runtime_error("Unrecognized Content node type");
   }
@@ -38,13 +70,13 @@ namespace {
   struct node_evaluate {
     double operator() (double node) { return node; };
     double operator() (const Binning& node) {
-      return std::visit(*this, node.child(values));
+      return nodes.visit(*this, node.child(values));
     };
     double operator() (const MultiBinning& node) {
-      return std::visit(*this, node.child(values));
+      return node.evaluate(nodes, values);
     };
     double operator() (const Category& node) {
-      return std::visit(*this, node.child(values));
+      return nodes.visit(*this, node.child(values));
     };
     double operator() (const Formula& node) {
       return node.evaluate(values);
@@ -53,12 +85,306 @@ namespace {
       return node.evaluate(values);
     };
     double operator() (const Transform& node) {
-      return node.evaluate(values);
+      return node.evaluate(nodes, values);
     };
 
+    const _NodeArena& nodes;
     const std::vector<Variable::Type>& values;
   };
 
+  const FormulaProgram& leaf_program(const _NodeArena& nodes, const Content& leaf) {
+    if ( leaf.type() == Content::Type::formula ) return nodes.get<Formula>(leaf).program();
+    return nodes.get<FormulaRef>(leaf).formula().program();
+  }
+
+  // fewest rows reaching a formula leaf for it to be evaluated column-wise
+  constexpr size_t min_formula_rows {16};
+  // fewest rows reaching a node for them to be partitioned rather than each
+  // followed down on its own
+  constexpr size_t min_partition_rows {8};
+
+  // Evaluates a batch node by node rather than row by row: the rows reaching a
+  // Binning, MultiBinning or Category are partitioned by the branch they take,
+  // and each branch is then evaluated for all of its rows at once, so that every
+  // node is visited once per batch and formulas receive whole columns.
+  // The rule of a Transform is evaluated into a column of its own, which stands
+  // in for the input column in the nodes below it.
+  // Rows that a node cannot take, and other nodes reached by too few rows, are
+  // evaluated row by row
+  class BatchWalk {
+    public:
+      // size: number of rows of the columns
+      BatchWalk(const Correction& corr, size_t size, const std::vector<Variable::BatchType>& values, double* output) :
+        corr_(corr), nodes_(corr.nodes()), size_(size), values_(values), output_(output), row_(values.size()), columns_(values.size())
+      {};
+
+      // rows: indices into the columns, which are reordered and overwritten
+      void evaluate(const Content& node, size_t* rows, size_t n) {
+        switch ( node.type() ) {
+          case Content::Type::number:
+            for (size_t k=0; k < n; ++k) output_[rows[k]] = node.value();
+            return;
+          case Content::Type::formula:
+          case Content::Type::formularef:
+            return evaluate_formula(node, rows, n);
+          case Content::Type::binning:
+            return partition<Binning>(node, rows, n);
+          case Content::Type::multibinning:
+            return partition<MultiBinning>(node, rows, n);
+          case Content::Type::category:
+            return partition<Category>(node, rows, n);
+          case Content::Type::transform:
+            return transform(node, rows, n);
+        }
+      };
+
+    private:
+      // rewrites the input column rather than copying the inputs of each row,
+      // however few rows there are, as the scratch columns are reused
+      void transform(const Content& handle, size_t* rows, size_t n) {
+        const Transform& node = nodes_.get<Transform>(handle);
+        // one set of scratch columns per level of Transform nesting (std::deque
+        // keeps references to existing ones valid as it grows)
+        if ( scratch_.size() <= depth_ ) scratch_.emplace_back();
+        auto& scratch = scratch_[depth_++];
+        scratch.rule.resize(size_);
+        double* const output = output_;
+        output_ = scratch.rule.data();
+        // on a copy, since the rows of a node are reordered and dropped as done
+        scratch.rows.assign(rows, rows + n);
+        evaluate(node.rule(), scratch.rows.data(), n);
+        output_ = output;
+        // strings cannot be transformed, and the column has the type of the input
+        const auto input = values_[node.input()];
+        if ( std::holds_alternative<Column<int>>(input) ) {
+          scratch.rounded.resize(size_);
+          for (size_t k=0; k < n; ++k) {
+            scratch.rounded[rows[k]] = (int) std::round(scratch.rule[rows[k]]);
+          }
+          values_[node.input()] = Column<int>{scratch.rounded.data(), 1};
+        }
+        else {
+          values_[node.input()] = Column<double>{scratch.rule.data(), 1};
+        }
+        evaluate(node.content(), rows, n);
+        values_[node.input()] = input;
+        --depth_;
+      };
+
+      template<typename T>
+      void partition(const Content& handle, size_t* rows, size_t n) {
+        if ( n < min_partition_rows ) {
+          for (size_t k=0; k < n; ++k) evaluate_row(handle, rows[k]);
+          return;
+        }
+        const T& node = nodes_.get<T>(handle);
+        // (branch, first row, number of rows) of each branch taken by a node
+        std::vector<std::tuple<size_t, size_t, size_t>> groups;
+        {
+          std::vector<size_t> branches(n);
+          node.branches(values_, rows, n, branches.data());
+          // rows ending in a number are done here; the others are kept, in front
+          size_t m {0};
+          for (size_t k=0; k < n; ++k) {
+            if ( branches[k] == _nobranch ) {
+              evaluate_row(handle, rows[k]);
+              continue;
+            }
+            const Content child = node.branch(branches[k]);
+            if ( child.number() ) {
+              output_[rows[k]] = child.value();
+              continue;
+            }
+            rows[m] = rows[k];
+            branches[m] = branches[k];
+            ++m;
+          }
+          if ( m == 0 ) return;
+
+          std::vector<size_t> sorted(m);
+          if ( node.nbranches() <= 2 * m + 16 ) {
+            // counting sort
+            std::vector<size_t> offsets(node.nbranches() + 1, 0);
+            for (size_t k=0; k < m; ++k) ++offsets[branches[k] + 1];
+            for (size_t b=0; b < node.nbranches(); ++b) {
+              if ( offsets[b + 1] > 0 ) groups.push_back({b, offsets[b], offsets[b + 1]});
+              offsets[b + 1] += offsets[b];
+            }
+            for (size_t k=0; k < m; ++k) sorted[offsets[branches[k]]++] = rows[k];
+          }
+          else {
+            // far more branches than rows
+            std::vector<std::pair<size_t, size_t>> pairs(m);
+            for (size_t k=0; k < m; ++k) pairs[k] = {branches[k], rows[k]};
+            std::sort(pairs.begin(), pairs.end());
+            for (size_t k=0; k < m; ++k) {
+              if ( k == 0 || pairs[k].first != pairs[k - 1].first ) groups.push_back({pairs[k].first, k, 1});
+              else ++std::get<2>(groups.back());
+              sorted[k] = pairs[k].second;
+            }
+          }
+          std::copy(sorted.begin(), sorted.end(), rows);
+        }
+        for (const auto& [branch, start, size] : groups) {
+          evaluate(node.branch(branch), rows + start, size);
+        }
+      };
+
+      void evaluate_formula(const Content& leaf, const size_t* rows, size_t n) {
+        const auto& program = leaf_program(nodes_, leaf);
+        bool columnar = n >= min_formula_rows;
+        for (size_t j : program.variables()) {
+          // otherwise the row-wise evaluation reports the type error
+          columnar &= std::holds_alternative<Column<double>>(values_[j]);
+        }
+        if ( ! columnar ) {
+          for (size_t k=0; k < n; ++k) evaluate_row(leaf, rows[k]);
+          return;
+        }
+        gathered_.resize(program.variables().size() * n);
+        double* dest = gathered_.data();
+        for (size_t j : program.variables()) {
+          const auto& column = std::get<Column<double>>(values_[j]);
+          for (size_t k=0; k < n; ++k) dest[k] = column[rows[k]];
+          columns_[j] = dest;
+          dest += n;
+        }
+        result_.resize(n);
+        if ( leaf.type() == Content::Type::formula ) {
+          nodes_.get<Formula>(leaf).evaluate(n, columns_, result_.data());
+        }
+        else {
+          nodes_.get<FormulaRef>(leaf).evaluate(n, columns_, result_.data());
+        }
+        for (size_t k=0; k < n; ++k) output_[rows[k]] = result_[k];
+      };
+
+      void evaluate_row(const Content& node, size_t i) {
+        // the row buffer is reused, so string inputs only allocate when they grow
+        for (size_t j=0; j < values_.size(); ++j) {
+          if ( auto column = std::get_if<Column<std::string>>(&values_[j]) ) {
+            // resolve each string once rather than at every Category it reaches
+            const int id = corr_.string_id(j, (*column)[i]);
+            if ( id >= 0 ) row_[j] = StringId{id};
+            else row_[j] = (*column)[i];
+            continue;
+          }
+          std::visit([&](const auto& column) { row_[j] = column[i]; }, values_[j]);
+        }
+        output_[i] = nodes_.visit(node_evaluate{nodes_, row_}, node);
+      };
+
+      const Correction& corr_;
+      const _NodeArena& nodes_;
+      const size_t size_;
+      std::vector<Variable::BatchType> values_;
+      double* output_;
+      std::vector<Variable::Type> row_;
+      std::vector<double> gathered_;
+      std::vector<const double*> columns_;
+      std::vector<double> result_;
+      struct TransformScratch {
+        std::vector<double> rule;
+        std::vector<int> rounded;
+        std::vector<size_t> rows;
+      };
+      std::deque<TransformScratch> scratch_;
+      size_t depth_ {0};
+  };
+
+  // A lazily grown pool of worker threads shared by all batch evaluations
+  class ThreadPool {
+    public:
+      static ThreadPool& instance() {
+        // intentionally leaked: joining threads during static destruction
+        // can deadlock when unloaded from a shared library
+        static ThreadPool* pool = new ThreadPool();
+        return *pool;
+      };
+
+      // Call task(i) for each i in [0, ntasks) on at most nthreads threads,
+      // one of which is the calling thread. The first exception thrown by
+      // any task is rethrown here, and remaining tasks are skipped.
+      void run(size_t ntasks, size_t nthreads, const std::function<void(size_t)>& task) {
+        if ( nthreads == 0 ) {
+          nthreads = std::max(std::thread::hardware_concurrency(), 1u);
+        }
+        nthreads = std::min(nthreads, ntasks);
+        if ( nthreads <= 1 ) {
+          for (size_t i=0; i < ntasks; ++i) task(i);
+          return;
+        }
+        auto job = std::make_shared<Job>(task, ntasks, nthreads - 1);
+        {
+          std::lock_guard<std::mutex> lock(m_);
+          while ( workers_.size() < nthreads - 1 ) {
+            workers_.emplace_back(&ThreadPool::worker, this);
+          }
+          jobs_.push_back(job);
+        }
+        cv_.notify_all();
+        job->work();
+        std::unique_lock<std::mutex> lock(job->m);
+        job->cv.wait(lock, [&job] { return job->done == job->ntasks; });
+        if ( job->error ) {
+          std::rethrow_exception(job->error);
+        }
+      };
+
+    private:
+      struct Job {
+        Job(const std::function<void(size_t)>& task, size_t ntasks, size_t helpers) :
+          task(task), ntasks(ntasks), helpers(helpers) {};
+
+        void work() {
+          size_t i;
+          while ( (i = next++) < ntasks ) {
+            if ( ! failed ) {
+              try { task(i); }
+              catch (...) {
+                std::lock_guard<std::mutex> lock(m);
+                if ( ! error ) error = std::current_exception();
+                failed = true;
+              }
+            }
+            if ( ++done == ntasks ) {
+              std::lock_guard<std::mutex> lock(m);
+              cv.notify_all();
+            }
+          }
+        };
+
+        const std::function<void(size_t)>& task;
+        const size_t ntasks;
+        size_t helpers; // remaining number of workers that may join, guarded by pool mutex
+        std::atomic<size_t> next{0};
+        std::atomic<size_t> done{0};
+        std::atomic<bool> failed{false};
+        std::exception_ptr error;
+        std::mutex m;
+        std::condition_variable cv;
+      };
+
+      void worker() {
+        std::unique_lock<std::mutex> lock(m_);
+        while ( true ) {
+          cv_.wait(lock, [this] { return ! jobs_.empty(); });
+          auto job = jobs_.front();
+          if ( --job->helpers == 0 ) {
+            jobs_.pop_front();
+          }
+          lock.unlock();
+          job->work();
+          lock.lock();
+        }
+      };
+
+      std::mutex m_;
+      std::condition_variable cv_;
+      std::deque<std::shared_ptr<Job>> jobs_;
+      std::vector<std::thread> workers_;
+  };
+
 }
 
 Variable::Variable(const rapidjson::Value& json) :
@@ -79,7 +405,7 @@ std::string Variable::typeStr() const {
 }
 
 void Variable::validate(const Type& t) const {
-  if ( std::holds_alternative<std::string>(t) ) {
+  if ( std::holds_alternative<std::string>(t) || std::holds_alternative<StringId>(t) ) {
     if ( type_ != VarType::string ) {
       throw std::runtime_error("Input " + name() + " has wrong type: got string expected " + typeStr());
     }
@@ -96,67 +422,131 @@ void Variable::validate(const Type& t) const {
   }
 }
 
-Formula::Formula(const rapidjson::Value& json, const Correction& context, bool generic) :
-  expression_(json["expression"].GetString()),
-  generic_(generic)
-{
-  if (json["parser"] == "TFormula") { type_ = FormulaAst::ParserType::TFormula; }
-  else if (json["parser"] == "numexpr") {
-    type_ = FormulaAst::ParserType::numexpr;
-    throw std::runtime_error("numexpr formula parser is not yet supported");
+void Variable::validate(const BatchType& t) const {
+  if ( std::holds_alternative<Column<std::string>>(t) || std::holds_alternative<Column<StringId>>(t) ) {
+    if ( type_ != VarType::string ) {
+      throw std::runtime_error("Input " + name() + " has wrong type: got string expected " + typeStr());
+    }
+  }
+  else if ( std::holds_alternative<Column<int>>(t) ) {
+    if ( type_ != VarType::integer ) {
+      throw std::runtime_error("Input " + name() + " has wrong type: got int expected " + typeStr());
+    }
+  }
+  else if ( std::holds_alternative<Column<double>>(t) ) {
+    if ( type_ != VarType::real ) {
+      throw std::runtime_error("Input " + name() + " has wrong type: got real-valued expected " + typeStr());
+    }
   }
-  else { throw std::runtime_error("Unrecognized formula parser type"); }
+}
 
-  std::vector<size_t> variableIdx;
-  for (const auto& item : json["variables"].GetArray()) {
-    variableIdx.push_back(context.input_index(item.GetString()));
+namespace {
+  FormulaAst::ParserType formula_parser(const rapidjson::Value& json) {
+    if (json["parser"] == "TFormula") { return FormulaAst::ParserType::TFormula; }
+    else if (json["parser"] == "numexpr") {
+      throw std::runtime_error("numexpr formula parser is not yet supported");
+    }
+    throw std::runtime_error("Unrecognized formula parser type");
   }
 
-  std::vector<double> params;
-  if ( auto items = getOptional<rapidjson::Value::ConstArray>(json, "parameters") ) {
-    for (const auto& item : *items) {
-      params.push_back(item.GetDouble());
+  FormulaAst parse_formula(const rapidjson::Value& json, const Correction& context, FormulaAst::ParserType type, bool generic) {
+    std::vector<size_t> variableIdx;
+    for (const auto& item : json["variables"].GetArray()) {
+      variableIdx.push_back(context.input_index(item.GetString()));
+    }
+
+    std::vector<double> params;
+    if ( auto items = getOptional<rapidjson::Value::ConstArray>(json, "parameters") ) {
+      for (const auto& item : *items) {
+        params.push_back(item.GetDouble());
+      }
     }
+
+    auto ast = FormulaAst::parse(type, json["expression"].GetString(), params, variableIdx, !generic);
+    return ast.simplify(context.options().fast_math);
   }
+}
 
-  ast_ = std::make_unique<FormulaAst>(FormulaAst::parse(type_, expression_, params, variableIdx, !generic));
+Formula::Formula(const rapidjson::Value& json, const Correction& context, bool generic) :
+  expression_(json["expression"].GetString()),
+  type_(formula_parser(json)),
+  program_(parse_formula(json, context, type_, generic)),
+  generic_(generic)
+{
 }
 
 double Formula::evaluate(const std::vector<Variable::Type>& values) const {
   if ( generic_ ) {
     throw std::runtime_error("Generic formulas must be evaluated with parameters");
   }
-  return ast_->evaluate(values, {});
+  return program_.evaluate(values, {});
 }
 
 double Formula::evaluate(const std::vector<Variable::Type>& values, const std::vector<double>& params) const {
-  return ast_->evaluate(values, params);
+  return program_.evaluate(values, params);
+}
+
+void Formula::evaluate(size_t n, const std::vector<const double*>& columns, double* output) const {
+  if ( generic_ ) {
+    throw std::runtime_error("Generic formulas must be evaluated with parameters");
+  }
+  program_.evaluate(n, columns, {}, output);
+}
+
+void Formula::evaluate(size_t n, const std::vector<const double*>& columns, const std::vector<double>& params, double* output) const {
+  program_.evaluate(n, columns, params, output);
 }
 
-FormulaRef::FormulaRef(const rapidjson::Value& json, const Correction& context) {
-  formula_ = context.formula_ref(json["index"].GetInt());
+FormulaRef::FormulaRef(const rapidjson::Value& json, const Correction& context) :
+  index_(json["index"].GetInt())
+{
+  formula_ = context.formula_ref(index_);
   for (const auto& item : json["parameters"].GetArray()) {
     parameters_.push_back(item.GetDouble());
   }
+  if ( parameters_.size() < formula_->program().nparameters() ) {
+    throw std::runtime_error("Insufficient parameters for formula");
+  }
 }
 
 double FormulaRef::evaluate(const std::vector<Variable::Type>& values) const {
   return formula_->evaluate(values, parameters_);
 }
 
+void FormulaRef::evaluate(size_t n, const std::vector<const double*>& columns, double* output) const {
+  formula_->evaluate(n, columns, parameters_, output);
+}
+
 Transform::Transform(const rapidjson::Value& json, const Correction& context) {
   variableIdx_ = context.input_index(json["input"].GetString());
   const auto& variable = context.inputs()[variableIdx_];
   if ( variable.type() == Variable::VarType::string ) {
     throw std::runtime_error("Transform cannot rewrite string inputs");
   }
-  rule_ = std::make_unique<Content>(resolve_content(json["rule"], context));
-  content_ = std::make_unique<Content>(resolve_content(json["content"], context));
+  rule_ = resolve_content(json["rule"], context);
+  content_ = resolve_content(json["content"], context);
 }
 
-double Transform::evaluate(const std::vector<Variable::Type>& values) const {
-  std::vector<Variable::Type> new_values(values);
-  double vnew = std::visit(node_evaluate{values}, *rule_);
+double Transform::evaluate(const _NodeArena& nodes, const std::vector<Variable::Type>& values) const {
+  // One reusable input buffer per thread and level of Transform nesting, so that
+  // once warm the copy below does not allocate (std::deque keeps references
+  // to existing buffers valid as it grows)
+  thread_local std::deque<std::vector<Variable::Type>> scratch;
+  thread_local size_t depth {0};
+  struct DepthGuard {
+    DepthGuard() { depth++; };
+    ~DepthGuard() { depth--; };
+  };
+
+  double vnew = nodes.visit(node_evaluate{nodes, values}, rule_);
+  if ( scratch.size() <= depth ) {
+    scratch.resize(depth + 1);
+  }
+  auto& new_values = scratch[depth];
+  // element-wise assignment reuses the capacity of any strings already there
+  new_values.resize(values.size());
+  std::copy(values.begin(), values.end(), new_values.begin());
+  DepthGuard guard;
   auto& v = new_values[variableIdx_];
   if ( std::holds_alternative<double>(v) ) {
     v = vnew;
@@ -167,21 +557,192 @@ double Transform::evaluate(const std::vector<Variable::Type>& values) const {
   else {
     throw std::logic_error("I should not have ever seen a string");
   }
-  return std::visit(node_evaluate{new_values}, *content_);
+  return nodes.visit(node_evaluate{nodes, new_values}, content_);
 }
 
-Binning::Binning(const rapidjson::Value& json, const Correction& context)
-{
-  if (json["nodetype"] != "binning") { throw std::runtime_error("Attempted to construct Binning node but data is not that type"); }
+namespace correction {
+  // Arrays of numbers by a hash of their contents, so that equal ones are
+  // only stored once; shared by corrections built concurrently
+  class _ArrayPool {
+    public:
+      // the first array interned that is equal to values
+      std::shared_ptr<const std::vector<double>> intern(const std::shared_ptr<const std::vector<double>>& values) {
+        const size_t size = values->size() * sizeof(double);
+        const size_t hash = std::hash<std::string_view>()(std::string_view((const char*) values->data(), size));
+        const std::lock_guard<std::mutex> lock(m_);
+        const auto [begin, end] = arrays_.equal_range(hash);
+        for (auto it = begin; it != end; ++it) {
+          const auto& array = it->second;
+          if ( array->size() == values->size() && std::memcmp(array->data(), values->data(), size) == 0 ) {
+            if ( array != values ) saved_ += sizeof(std::vector<double>) + size;
+            return array;
+          }
+        }
+        arrays_.emplace(hash, values);
+        return values;
+      };
+      // bytes of the arrays found to be equal to one interned before
+      size_t saved() const {
+        const std::lock_guard<std::mutex> lock(m_);
+        return saved_;
+      };
+
+    private:
+      mutable std::mutex m_;
+      std::unordered_multimap<size_t, std::shared_ptr<const std::vector<double>>> arrays_;
+      size_t saved_ {0};
+  };
+}
+
+namespace {
+  // null if there are no values
+  std::shared_ptr<const std::vector<double>> shared_array(std::vector<double> values) {
+    if ( values.empty() ) return nullptr;
+    return std::make_shared<const std::vector<double>>(std::move(values));
+  }
+
+  // with the pool the corrections built with them share their edges in
+  LoadOptions with_array_pool(const LoadOptions& options) {
+    LoadOptions result = options;
+    if ( result.dedup && ! result._arrays ) {
+      result._arrays = std::make_shared<_ArrayPool>();
+    }
+    return result;
+  }
+}
+
+_BinEdges::_BinEdges(const rapidjson::Value& json) {
+  if ( json.IsObject() ) {
+    n_ = json["n"].GetUint();
+    low_ = json["low"].GetDouble();
+    high_ = json["high"].GetDouble();
+    if ( n_ == 0 || ! (low_ < high_) ) {
+      throw std::runtime_error("Invalid uniform binning");
+    }
+    uniform_ = true;
+    scale_ = n_ / (high_ - low_);
+    return;
+  }
   std::vector<double> edges;
-  for (const auto& item : json["edges"].GetArray()) {
+  edges.reserve(json.GetArray().Size());
+  for (const auto& item : json.GetArray()) {
     edges.push_back(item.GetDouble());
   }
+  *this = _BinEdges(std::move(edges));
+}
+
+_BinEdges::_BinEdges(std::vector<double> edges) {
+  if ( edges.size() < 2 ) {
+    throw std::runtime_error("Binning edges must contain at least two values");
+  }
+  n_ = edges.size() - 1;
+  low_ = edges.front();
+  high_ = edges.back();
+  scale_ = n_ / (high_ - low_);
+  const double width = (high_ - low_) / n_;
+  uniform_ = true;
+  for (size_t i=1; i < n_; ++i) {
+    if ( std::abs(edges[i] - (low_ + i * width)) > 1e-6 * width ) {
+      uniform_ = false;
+      break;
+    }
+  }
+  if ( uniform_ ) {
+    // The arithmetic bin is monotone in the value, so if it changes exactly at
+    // each of the given edges it agrees with them everywhere and they can be dropped
+    bool exact {true};
+    for (size_t i=1; exact && i < n_; ++i) {
+      exact = find(edges[i]) == i + 1 && find(std::nextafter(edges[i], low_)) == i;
+    }
+    if ( exact ) return;
+  }
+  edges_ = shared_array(std::move(edges));
+  plan();
+}
+
+void _BinEdges::plan() {
+  if ( uniform_ ) return;
+  const size_t size = edges_->size();
+  // for the branch-free count to beat the binary search, and for the tree to
+  // take more than a few kB of cache with the binary search
+  constexpr size_t max_linear {8}, min_tree {1024};
+  if ( size <= max_linear ) {
+    search_ = Search::linear;
+    return;
+  }
+  if ( size < min_tree ) {
+    search_ = Search::binary;
+    return;
+  }
+  search_ = Search::tree;
+  levels_ = 0;
+  while ( ((size_t) 1 << levels_) - 1 < size ) ++levels_;
+  std::vector<double> tree((size_t) 1 << levels_);
+  // in-order traversal of the tree visits the edges in order
+  size_t i {0};
+  std::function<void(size_t)> fill = [&](size_t k) {
+    if ( k >= tree.size() ) return;
+    fill(2 * k);
+    tree[k] = ( i < size ) ? (*edges_)[i] : std::numeric_limits<double>::infinity();
+    ++i;
+    fill(2 * k + 1);
+  };
+  fill(1);
+  tree_ = std::make_shared<const std::vector<double>>(std::move(tree));
+}
+
+void _BinEdges::find(size_t size, const double* values, size_t* out) const {
+  // The searches of a group of values advance in lockstep, so that their loads
+  // overlap rather than each waiting on the one before it
+  constexpr size_t group {8};
+  size_t i {0};
+  if ( ! uniform_ && search_ == Search::binary ) {
+    const double* const begin = edges_->data();
+    for (; i + group <= size; i += group) {
+      const double* base[group];
+      std::fill(std::begin(base), std::end(base), begin);
+      for (size_t n = edges_->size(); n > 1; ) {
+        const size_t half = n / 2;
+        for (size_t j=0; j < group; ++j) base[j] += ( ! (values[i + j] < base[j][half]) ) * half;
+        n -= half;
+      }
+      for (size_t j=0; j < group; ++j) out[i + j] = (base[j] - begin) + ! (values[i + j] < *base[j]);
+    }
+  }
+  else if ( ! uniform_ && search_ == Search::tree ) {
+    const auto& tree = *tree_;
+    for (; i + group <= size; i += group) {
+      size_t k[group];
+      std::fill(std::begin(k), std::end(k), 1);
+      for (uint8_t level=0; level < levels_; ++level) {
+        for (size_t j=0; j < group; ++j) k[j] = 2 * k[j] + ! (values[i + j] < tree[k[j]]);
+      }
+      for (size_t j=0; j < group; ++j) out[i + j] = std::min(k[j] - tree.size(), edges_->size());
+    }
+  }
+  for (; i < size; ++i) out[i] = find(values[i]);
+}
+
+void _BinEdges::share(_ArrayPool& pool) {
+  if ( edges_ ) edges_ = pool.intern(edges_);
+  if ( tree_ ) tree_ = pool.intern(tree_);
+}
+
+Binning::Binning(const rapidjson::Value& json, const Correction& context) :
+  edges_(json["edges"])
+{
+  if (json["nodetype"] != "binning") { throw std::runtime_error("Attempted to construct Binning node but data is not that type"); }
   const auto& content = json["content"].GetArray();
-  if ( edges.size() != content.Size() + 1 ) {
+  if ( edges_.nbins() != content.Size() ) {
     throw std::runtime_error("Inconsistency in Binning: number of content nodes does not match binning");
   }
   variableIdx_ = context.input_index(json["input"].GetString());
+  std::vector<Content> bins;
+  bins.reserve(content.Size() + 1);
+  for (const auto& item : content) {
+    bins.push_back(resolve_content(item, context));
+  }
+  // as in MultiBinning, the flow is resolved after the content
   Content default_value{0.};
   if ( json["flow"] == "clamp" ) {
     flow_ = _FlowBehavior::clamp;
@@ -193,41 +754,61 @@ Binning::Binning(const rapidjson::Value& json, const Correction& context)
     flow_ = _FlowBehavior::value;
     default_value = resolve_content(json["flow"], context);
   }
-  bins_.reserve(edges.size());
-  // first bin is never accessed for content in range (corresponds to std::upper_bound underflow)
-  // use it to store default value
-  bins_.push_back({*edges.begin(), std::move(default_value)});
-  for (size_t i=0; i < content.Size(); ++i) {
-    bins_.push_back({edges[i + 1], resolve_content(content[i], context)});
-  }
+  // store default value at end of content array
+  bins.push_back(std::move(default_value));
+  bins_ = _LeafArray<Content>(std::move(bins));
 }
 
 const Content& Binning::child(const std::vector<Variable::Type>& values) const {
   double value = std::get<double>(values[variableIdx_]);
-  auto it = std::upper_bound(std::begin(bins_), std::end(bins_), value, [](const double& a, const auto& b) { return a < std::get<0>(b); });
-  if ( it == std::begin(bins_) ) {
+  size_t idx = edges_.find(value);
+  if ( idx == 0 ) {
     if ( flow_ == _FlowBehavior::value ) {
-      // default value already at std::begin
+      return bins_.back();
     }
     else if ( flow_ == _FlowBehavior::error ) {
       throw std::runtime_error("Index below bounds in Binning for input " + std::to_string(variableIdx_) + " value: " + std::to_string(value));
     }
     else { // clamp
-      it++;
+      idx++;
     }
   }
-  else if ( it == std::end(bins_) ) {
+  else if ( idx == edges_.nbins() + 1 ) {
     if ( flow_ == _FlowBehavior::value ) {
-      it = std::begin(bins_);
+      return bins_.back();
     }
     else if ( flow_ == _FlowBehavior::error ) {
       throw std::runtime_error("Index above bounds in Binning for input " + std::to_string(variableIdx_) + " value: " + std::to_string(value));
     }
     else { // clamp
-      it--;
+      idx--;
+    }
+  }
+  return bins_[idx - 1];
+}
+
+void Binning::branches(const std::vector<Variable::BatchType>& values, const size_t* rows, size_t n, size_t* out) const {
+  const auto& column = std::get<Column<double>>(values[variableIdx_]);
+  std::vector<double> gathered(n);
+  for (size_t k=0; k < n; ++k) gathered[k] = column[rows[k]];
+  edges_.find(n, gathered.data(), out);
+  const size_t nbins = edges_.nbins();
+  for (size_t k=0; k < n; ++k) {
+    size_t idx = out[k];
+    if ( idx == 0 || idx == nbins + 1 ) {
+      if ( flow_ == _FlowBehavior::value ) {
+        // default value at end of content array
+        out[k] = nbins;
+        continue;
+      }
+      else if ( flow_ == _FlowBehavior::error ) {
+        out[k] = _nobranch;
+        continue;
+      }
+      idx = ( idx == 0 ) ? 1 : nbins;
     }
+    out[k] = idx - 1;
   }
-  return std::get<1>(*it);
 }
 
 MultiBinning::MultiBinning(const rapidjson::Value& json, const Correction& context)
@@ -236,142 +817,392 @@ MultiBinning::MultiBinning(const rapidjson::Value& json, const Correction& conte
   axes_.reserve(json["edges"].GetArray().Size());
   size_t idx {0};
   for (const auto& dimension : json["edges"].GetArray()) {
-    std::vector<double> dim_edges;
-    dim_edges.reserve(dimension.GetArray().Size());
-    for (const auto& item : dimension.GetArray()) {
-      dim_edges.push_back(item.GetDouble());
-    }
     const auto& input = json["inputs"].GetArray()[idx];
-    axes_.push_back({context.input_index(input.GetString()), 0, std::move(dim_edges)});
+    axes_.push_back({context.input_index(input.GetString()), 0, _BinEdges(dimension)});
     idx++;
   }
 
   size_t stride {1};
   for (auto it=axes_.rbegin(); it != axes_.rend(); ++it) {
     std::get<1>(*it) = stride;
-    stride *= std::get<2>(*it).size() - 1;
+    stride *= std::get<2>(*it).nbins();
   }
-  content_.reserve(json["content"].GetArray().Size() + 1); // + 1 for default value
-  for (const auto& item : json["content"].GetArray()) {
-    content_.push_back(resolve_content(item, context));
-  }
-  if ( content_.size() != stride ) {
+  const auto& content = json["content"].GetArray();
+  if ( content.Size() != stride ) {
     throw std::runtime_error("Inconsistency in MultiBinning: number of content nodes does not match binning");
   }
-  if ( json["flow"] == "clamp" ) {
+  const auto& flow = json["flow"];
+  if ( flow == "clamp" ) {
     flow_ = _FlowBehavior::clamp;
   }
-  else if ( json["flow"] == "error" ) {
+  else if ( flow == "error" ) {
     flow_ = _FlowBehavior::error;
   }
   else { // Content node
     flow_ = _FlowBehavior::value;
-    // store default value at end of content array
-    content_.push_back(resolve_content(json["flow"], context));
+  }
+  const bool dense = (flow_ != _FlowBehavior::value || flow.IsDouble())
+    && std::all_of(content.begin(), content.end(), [](const auto& item) { return item.IsDouble(); });
+  if ( dense ) {
+    std::vector<double> values;
+    values.reserve(content.Size() + 1); // + 1 for default value
+    for (const auto& item : content) {
+      values.push_back(item.GetDouble());
+    }
+    if ( flow_ == _FlowBehavior::value ) {
+      // store default value at end of content array
+      values.push_back(flow.GetDouble());
+    }
+    content_ = _LeafArray<double>(std::move(values));
+  }
+  else {
+    std::vector<Content> nodes;
+    nodes.reserve(content.Size() + 1); // + 1 for default value
+    for (const auto& item : content) {
+      nodes.push_back(resolve_content(item, context));
+    }
+    if ( flow_ == _FlowBehavior::value ) {
+      // store default value at end of content array
+      nodes.push_back(resolve_content(flow, context));
+    }
+    content_ = _LeafArray<Content>(std::move(nodes));
   }
 }
 
-const Content& MultiBinning::child(const std::vector<Variable::Type>& values) const {
+size_t MultiBinning::index(const std::vector<Variable::Type>& values) const {
   size_t idx {0};
   for (const auto& [variableIdx, stride, edges] : axes_) {
     double value = std::get<double>(values[variableIdx]);
-    auto it = std::upper_bound(std::begin(edges), std::end(edges), value);
-    if ( it == std::begin(edges) ) {
+    size_t localidx = edges.find(value);
+    if ( localidx == 0 ) {
       if ( flow_ == _FlowBehavior::value ) {
-        return *content_.rbegin();
+        // default value at end of content array
+        return std::visit([](const auto& content) { return content.size() - 1; }, content_);
       }
       else if ( flow_ == _FlowBehavior::error ) {
         throw std::runtime_error("Index below bounds in MultiBinning for input " + std::to_string(variableIdx) + " val: " + std::to_string(value));
       }
       else { // clamp
-        it++;
+        localidx++;
       }
     }
-    else if ( it == std::end(edges) ) {
+    else if ( localidx == edges.nbins() + 1 ) {
       if ( flow_ == _FlowBehavior::value ) {
-        return *content_.rbegin();
+        return std::visit([](const auto& content) { return content.size() - 1; }, content_);
       }
       else if ( flow_ == _FlowBehavior::error ) {
         throw std::runtime_error("Index above bounds in MultiBinning input " + std::to_string(variableIdx) + " val: " + std::to_string(value));
       }
       else { // clamp
-        it--;
+        localidx--;
+      }
+    }
+    idx += (localidx - 1) * stride;
+  }
+  return idx;
+}
+
+double MultiBinning::evaluate(const _NodeArena& nodes, const std::vector<Variable::Type>& values) const {
+  if ( auto dense = std::get_if<_LeafArray<double>>(&content_) ) {
+    return (*dense)[index(values)];
+  }
+  return nodes.visit(node_evaluate{nodes, values}, child(values));
+}
+
+const Content& MultiBinning::child(const std::vector<Variable::Type>& values) const {
+  return std::get<_LeafArray<Content>>(content_)[index(values)];
+}
+
+void MultiBinning::branches(const std::vector<Variable::BatchType>& values, const size_t* rows, size_t n, size_t* out) const {
+  // flat indices of the bins are below ncells, and the default value is at ncells
+  const size_t ncells = size() - (flow_ == _FlowBehavior::value);
+  std::fill(out, out + n, 0);
+  std::vector<double> gathered(n);
+  std::vector<size_t> found(n);
+  for (const auto& [variableIdx, stride, edges] : axes_) {
+    const auto& column = std::get<Column<double>>(values[variableIdx]);
+    for (size_t k=0; k < n; ++k) gathered[k] = column[rows[k]];
+    edges.find(n, gathered.data(), found.data());
+    for (size_t k=0; k < n; ++k) {
+      // out of range on an axis before
+      if ( out[k] >= ncells ) continue;
+      size_t localidx = found[k];
+      if ( localidx == 0 || localidx == edges.nbins() + 1 ) {
+        if ( flow_ == _FlowBehavior::value ) {
+          out[k] = ncells;
+          continue;
+        }
+        else if ( flow_ == _FlowBehavior::error ) {
+          out[k] = _nobranch;
+          continue;
+        }
+        localidx = ( localidx == 0 ) ? 1 : edges.nbins();
+      }
+      out[k] += (localidx - 1) * stride;
+    }
+  }
+}
+
+_IntIndex::_IntIndex(const std::vector<int>& keys) :
+  direct_(true), offset_(0), mask_(0), shift_(0)
+{
+  if ( keys.empty() ) {
+    return;
+  }
+  const auto [min, max] = std::minmax_element(keys.begin(), keys.end());
+  const int64_t span = (int64_t) *max - *min + 1;
+  direct_ = span <= 4 * (int64_t) keys.size() + 16;
+  if ( direct_ ) {
+    offset_ = *min;
+    slots_.resize(span, npos);
+    for (size_t i=0; i < keys.size(); ++i) {
+      slots_[keys[i] - offset_] = i;
+    }
+    return;
+  }
+  int bits = 1;
+  while ( ((size_t) 1 << bits) < 2 * keys.size() ) ++bits;
+  table_.resize((size_t) 1 << bits, {0, npos});
+  mask_ = (1u << bits) - 1;
+  shift_ = 32 - bits;
+  for (size_t i=0; i < keys.size(); ++i) {
+    uint32_t j = hash(keys[i]);
+    while ( table_[j].second != npos && table_[j].first != keys[i] ) {
+      j = (j + 1) & mask_;
+    }
+    table_[j] = {keys[i], i};
+  }
+}
+
+template<typename T>
+_LeafArray<T>::_LeafArray(std::vector<T> values) :
+  values_(std::move(values))
+{
+  static_assert(sizeof(T) == sizeof(uint64_t));
+  const size_t n = values_.size();
+  // too small to be worth the indirection, or too large to index
+  if ( n < 16 || n > (size_t) std::numeric_limits<int>::max() ) {
+    return;
+  }
+  // values are compared by bit pattern
+  const auto bits = [this](size_t i) {
+    uint64_t bits;
+    std::memcpy(&bits, &values_[i], sizeof(bits));
+    return bits;
+  };
+  // the most common value, if any is in the majority (Boyer-Moore vote):
+  // without one, a sparse encoding cannot pay off anyway
+  uint64_t common = bits(0);
+  size_t votes {0};
+  for (size_t i=0; i < n; ++i) {
+    if ( votes == 0 ) common = bits(i);
+    if ( bits(i) == common ) ++votes;
+    else --votes;
+  }
+  size_t nexceptions {0};
+  for (size_t i=0; i < n; ++i) nexceptions += ( bits(i) != common );
+  const size_t plain_size = n * sizeof(T);
+  // the _IntIndex takes up to four 8-byte slots per key
+  const size_t sparse_size = (nexceptions + 1) * sizeof(T) + 32 * nexceptions;
+
+  // a dictionary takes at least a byte per value, so it is only worth trying if
+  // it may beat the sparse encoding; gives up beyond 16-bit indices
+  std::vector<T> table;
+  std::vector<uint16_t> positions;
+  if ( sparse_size > n ) {
+    const size_t max_distinct = std::min(n / 2, (size_t) UINT16_MAX + 1);
+    int shift = 64;
+    while ( ((size_t) 1 << (64 - shift)) < 2 * max_distinct ) --shift;
+    const size_t mask = ((size_t) 1 << (64 - shift)) - 1;
+    std::vector<std::pair<uint64_t, uint32_t>> ids(mask + 1, {0, _IntIndex::npos});
+    positions.resize(n);
+    for (size_t i=0; i < n; ++i) {
+      const uint64_t value = bits(i);
+      size_t j = (value * 0x9e3779b97f4a7c15) >> shift;
+      while ( ids[j].second != _IntIndex::npos && ids[j].first != value ) j = (j + 1) & mask;
+      if ( ids[j].second == _IntIndex::npos ) {
+        if ( table.size() == max_distinct ) {
+          table.clear();
+          positions.clear();
+          break;
+        }
+        ids[j] = {value, (uint32_t) table.size()};
+        table.push_back(values_[i]);
       }
+      positions[i] = ids[j].second;
     }
-    size_t localidx = std::distance(std::begin(edges), it) - 1;
-    idx += localidx * stride;
   }
-  return content_.at(idx);
+  const size_t dictionary_size = table.empty() ? SIZE_MAX :
+    table.size() * sizeof(T) + n * (( table.size() <= UINT8_MAX + 1 ) ? 1 : 2);
+  if ( 2 * std::min(sparse_size, dictionary_size) > plain_size ) {
+    return;
+  }
+
+  auto encoded = std::make_shared<Encoded>();
+  encoded->size = n;
+  if ( sparse_size <= dictionary_size ) {
+    encoding_ = LeafEncoding::sparse;
+    std::vector<int> keys;
+    keys.reserve(nexceptions);
+    table.clear();
+    table.reserve(nexceptions + 1);
+    for (size_t i=0; table.empty(); ++i) {
+      if ( bits(i) == common ) table.push_back(values_[i]);
+    }
+    for (size_t i=0; i < n; ++i) {
+      if ( bits(i) != common ) {
+        keys.push_back(i);
+        table.push_back(values_[i]);
+      }
+    }
+    encoded->exceptions = _IntIndex(keys);
+  }
+  else {
+    encoding_ = LeafEncoding::dictionary;
+    if ( table.size() <= UINT8_MAX + 1 ) {
+      encoded->narrow.assign(positions.begin(), positions.end());
+    }
+    else {
+      encoded->wide = std::move(positions);
+    }
+  }
+  values_ = std::move(table);
+  encoded_ = std::move(encoded);
+}
+
+template<typename T>
+std::vector<T> _LeafArray<T>::values() const {
+  if ( encoding_ == LeafEncoding::plain ) return values_;
+  std::vector<T> out;
+  out.reserve(size());
+  for (size_t i=0; i < size(); ++i) out.push_back((*this)[i]);
+  return out;
 }
 
-Category::Category(const rapidjson::Value& json, const Correction& context)
+template class correction::_LeafArray<double>;
+template class correction::_LeafArray<Content>;
+
+Category::Category(const rapidjson::Value& json, const Correction& context) :
+  index_({})
 {
   if (json["nodetype"] != "category") { throw std::runtime_error("Attempted to construct Category node but data is not that type"); }
   variableIdx_ = context.input_index(json["input"].GetString());
   const auto& variable = context.inputs()[variableIdx_];
-  if ( variable.type() == Variable::VarType::string ) {
-    map_ = StrMap();
-  } // (default-constructed as IntMap)
-  for (const auto& kv_pair : json["content"].GetArray())
+  // as with std::map::try_emplace, the first occurrence of a key wins
+  std::vector<int> keys;
+  std::unordered_set<int> seen;
+  const auto& content = json["content"].GetArray();
+  content_.reserve(content.Size());
+  for (const auto& kv_pair : content)
   {
+    int key;
     if ( kv_pair["key"].IsString() ) {
       if ( variable.type() != Variable::VarType::string ) {
         throw std::runtime_error("Category got a key not of type string, but its input is string type");
       }
-      std::get<StrMap>(map_).try_emplace(kv_pair["key"].GetString(), resolve_content(kv_pair["value"], context));
+      key = context.intern_string(variableIdx_, kv_pair["key"].GetString());
     }
     else if ( kv_pair["key"].IsInt() ) {
       if ( variable.type() != Variable::VarType::integer ) {
         throw std::runtime_error("Category got a key not of type int, but its input is int type");
       }
-      std::get<IntMap>(map_).try_emplace(kv_pair["key"].GetInt(), resolve_content(kv_pair["value"], context));
+      key = kv_pair["key"].GetInt();
     }
     else {
       throw std::runtime_error("Invalid key type in Category");
     }
+    if ( ! seen.insert(key).second ) continue;
+    keys.push_back(key);
+    content_.push_back(resolve_content(kv_pair["value"], context));
+  }
+  index_ = _IntIndex(keys);
+  if ( variable.type() == Variable::VarType::string ) {
+    string_ids_ = context.string_ids(variableIdx_);
   }
   const auto it = json.FindMember("default");
   if ( it != json.MemberEnd() && !it->value.IsNull() ) {
-    default_ = std::make_unique<Content>(resolve_content(it->value, context));
+    default_ = resolve_content(it->value, context);
   }
 }
 
 const Content& Category::child(const std::vector<Variable::Type>& values) const {
-  if ( auto pval = std::get_if<std::string>(&values[variableIdx_]) ) {
-    try {
-      return std::get<StrMap>(map_).at(*pval);
-    } catch (std::out_of_range& ex) {
-      if ( default_ ) {
-        return *default_;
-      }
-      else {
-        throw std::out_of_range("Index not available in Category for index " + std::to_string(variableIdx_) + " val: " + *pval);
-      }
+  int key;
+  if ( auto pval = std::get_if<int>(&values[variableIdx_]) ) {
+    key = *pval;
+  }
+  else if ( auto pval = std::get_if<StringId>(&values[variableIdx_]); pval && string_ids_ ) {
+    key = pval->id;
+  }
+  else if ( auto pval = std::get_if<std::string>(&values[variableIdx_]) ) {
+    if ( ! string_ids_ ) {
+      throw std::runtime_error("Invalid variable type");
+    }
+    const auto it = string_ids_->find(*pval);
+    key = ( it != string_ids_->end() ) ? it->second : -1;
+    if ( key < 0 && ! default_ ) {
+      throw std::out_of_range("Index not available in Category for index " + std::to_string(variableIdx_) + " val: " + *pval);
     }
   }
-  else if ( auto pval = std::get_if<int>(&values[variableIdx_]) ) {
-    try {
-      return std::get<IntMap>(map_).at(*pval);
-    } catch (std::out_of_range& ex) {
-      if ( default_ ) {
-        return *default_;
-      }
-      else {
-        throw std::out_of_range("Index not available in Category for index " + std::to_string(variableIdx_) + " val: " + std::to_string(*pval));
-      }
+  else {
+    throw std::runtime_error("Invalid variable type");
+  }
+  const uint32_t pos = index_.find(key);
+  if ( pos != _IntIndex::npos ) {
+    return content_[pos];
+  }
+  else if ( default_ ) {
+    return *default_;
+  }
+  throw std::out_of_range("Index not available in Category for index " + std::to_string(variableIdx_) + " val: " + std::to_string(key));
+}
+
+void Category::branches(const std::vector<Variable::BatchType>& values, const size_t* rows, size_t n, size_t* out) const {
+  auto branch = [this](int key) -> size_t {
+    const uint32_t pos = index_.find(key);
+    if ( pos != _IntIndex::npos ) return pos;
+    return default_ ? content_.size() : _nobranch;
+  };
+  if ( auto column = std::get_if<Column<int>>(&values[variableIdx_]) ) {
+    for (size_t k=0; k < n; ++k) out[k] = branch((*column)[rows[k]]);
+  }
+  else if ( auto column = std::get_if<Column<StringId>>(&values[variableIdx_]); column && string_ids_ ) {
+    for (size_t k=0; k < n; ++k) out[k] = branch((*column)[rows[k]].id);
+  }
+  else if ( auto column = std::get_if<Column<std::string>>(&values[variableIdx_]); column && string_ids_ ) {
+    for (size_t k=0; k < n; ++k) {
+      const auto it = string_ids_->find((*column)[rows[k]]);
+      out[k] = branch(( it != string_ids_->end() ) ? it->second : -1);
     }
   }
-  throw std::runtime_error("Invalid variable type");
+  else {
+    std::fill(out, out + n, _nobranch);
+  }
+}
+
+Correction::Correction(const rapidjson::Value& json, const LoadOptions& options) :
+  Correction(json, nullptr, options)
+{
 }
 
-Correction::Correction(const rapidjson::Value& json) :
+Correction::Correction(const rapidjson::Value& json, _JsonReader* in, const LoadOptions& options) :
   name_(json["name"].GetString()),
   description_(getOptional<const char*>(json, "description").value_or("")),
   version_(json["version"].GetInt()),
-  output_(json["output"])
+  output_(json["output"]),
+  options_(with_array_pool(options)),
+  initialized_(false)
 {
   for (const auto& item : json["inputs"].GetArray()) {
     inputs_.emplace_back(item);
+    if ( inputs_.back().type() == Variable::VarType::string ) {
+      string_ids_.push_back(std::make_shared<_StringIds>());
+    }
+    else {
+      string_ids_.push_back(nullptr);
+    }
+  }
+  if ( options.only && options.only->count(name_) == 0 ) {
+    return;
   }
   if ( const auto& items = getOptional<rapidjson::Value::ConstArray>(json, "generic_formulas") ) {
     for (const auto& item : *items) {
@@ -379,7 +1210,8 @@ Correction::Correction(const rapidjson::Value& json) :
     }
   }
 
-  data_ = resolve_content(json["data"], *this);
+  data_ = in ? resolve_content(*in, *this) : resolve_content(json["data"], *this);
+  finish();
   initialized_ = true;
 }
 
@@ -392,69 +1224,1966 @@ size_t Correction::input_index(const std::string_view name) const {
   throw std::runtime_error("Error: could not find variable " + std::string(name) + " in inputs");
 }
 
-double Correction::evaluate(const std::vector<Variable::Type>& values) const {
+void Correction::check_loaded() const {
   if ( ! initialized_ ) {
-    throw std::logic_error("Not initialized");
+    throw std::logic_error("Correction " + name_ + " was not loaded");
   }
-  if ( values.size() > inputs_.size() ) {
+}
+
+void Correction::check_inputs(size_t size) const {
+  check_loaded();
+  if ( size > inputs_.size() ) {
     throw std::runtime_error("Too many inputs");
   }
-  else if ( values.size() < inputs_.size() ) {
+  else if ( size < inputs_.size() ) {
     throw std::runtime_error("Insufficient inputs");
   }
-  for (size_t i=0; i < inputs_.size(); ++i) {
-    inputs_[i].validate(values[i]);
+}
+
+void Correction::check_string_id(size_t input, StringId value) const {
+  // -1 is any string that is not a key, which the default (if any) is taken for
+  if ( value.id < -1 || value.id >= (int) string_ids_[input]->size() ) {
+    throw std::out_of_range("Input " + inputs_[input].name() + " has no string with id " + std::to_string(value.id));
   }
-  return std::visit(node_evaluate{values}, data_);
 }
 
-std::unique_ptr<CorrectionSet> CorrectionSet::from_file(const std::string& fn) {
-  rapidjson::Document json;
-  FILE* fp = fopen(fn.c_str(), "rb");
-  char readBuffer[65536];
-  rapidjson::FileReadStream is(fp, readBuffer, sizeof(readBuffer));
-  rapidjson::ParseResult ok = json.ParseStream(is);
-  if (!ok) {
-    throw std::runtime_error(
-        std::string("JSON parse error: ") + rapidjson::GetParseError_En(ok.Code())
-        + " at offset " + std::to_string(ok.Offset())
-        );
+int Correction::string_id(size_t input, const std::string& value) const {
+  const auto& ids = string_ids_.at(input);
+  if ( ! ids ) {
+    throw std::runtime_error("Input " + inputs_[input].name() + " is not a string");
   }
-  fclose(fp);
-  return std::make_unique<CorrectionSet>(json);
+  const auto it = ids->find(value);
+  return ( it != ids->end() ) ? it->second : -1;
 }
 
-std::unique_ptr<CorrectionSet> CorrectionSet::from_string(const char * data) {
-  rapidjson::Document json;
-  rapidjson::ParseResult ok = json.Parse(data);
-  if (!ok) {
-    throw std::runtime_error(
-        std::string("JSON parse error: ") + rapidjson::GetParseError_En(ok.Code())
-        + " at offset " + std::to_string(ok.Offset())
-        );
+int Correction::intern_string(size_t input, const std::string& value) const {
+  auto& ids = *string_ids_.at(input);
+  return ids.try_emplace(value, ids.size()).first->second;
+}
+
+void Correction::use_compiled(const std::shared_ptr<const CompiledLibrary>& library) {
+  // nothing to evaluate
+  if ( ! initialized_ ) return;
+  if ( options_.fast_math ) {
+    throw std::runtime_error("Compiled corrections evaluate formulas as written, and cannot be used with fast_math");
   }
-  return std::make_unique<CorrectionSet>(json);
+  const auto compiled = library->find(name_);
+  if ( ! compiled ) {
+    throw std::runtime_error("Compiled library has no correction " + name_);
+  }
+  bool match = compiled->ninputs == inputs_.size() && compiled->definition_hash == definition_hash();
+  for (size_t i=0; match && i < compiled->nstring_ids; ++i) {
+    const auto& [input, value, id] = compiled->string_ids[i];
+    match = input < inputs_.size() && string_ids_[input] && string_id(input, value) == id;
+  }
+  if ( ! match ) {
+    throw std::runtime_error("Compiled correction " + name_ + " was generated from a different definition");
+  }
+  library_ = library;
+  compiled_ = compiled;
 }
 
-CorrectionSet::CorrectionSet(const rapidjson::Value& json) {
-  if ( auto schema_version_ = getOptional<int>(json, "schema_version") ) {
-    if ( schema_version_ > evaluator_version ) {
-      throw std::runtime_error("Evaluator is designed for schema v" + std::to_string(evaluator_version) + " and is not forward-compatible");
+void Correction::compiled_inputs(const std::vector<Variable::Type>& values, double* inputs) const {
+  for (size_t i=0; i < values.size(); ++i) {
+    if ( auto value = std::get_if<std::string>(&values[i]) ) {
+      inputs[i] = string_id(i, *value);
     }
-    else if ( schema_version_ < evaluator_version ) {
-      throw std::runtime_error("Evaluator is designed for schema v" + std::to_string(evaluator_version) + " and is not backward-compatible");
+    else if ( auto value = std::get_if<StringId>(&values[i]) ) {
+      inputs[i] = value->id;
+    }
+    else if ( auto value = std::get_if<int>(&values[i]) ) {
+      inputs[i] = *value;
+    }
+    else {
+      inputs[i] = std::get<double>(values[i]);
     }
   }
-  else {
-    throw std::runtime_error("Missing schema_version in CorrectionSet document");
+}
+
+std::vector<std::tuple<Content::Type, LeafEncoding, size_t>> Correction::leaf_encodings() const {
+  check_loaded();
+  std::vector<std::tuple<Content::Type, LeafEncoding, size_t>> out;
+  for (const auto& node : nodes_.all<Binning>()) {
+    out.push_back({Content::Type::binning, node.encoding(), node.size()});
   }
-  if ( const auto& items = getOptional<rapidjson::Value::ConstArray>(json, "corrections") ) {
-    for (const auto& item : *items) {
-      auto corr = std::make_shared<Correction>(item);
-      corrections_[corr->name()] = corr;
+  for (const auto& node : nodes_.all<MultiBinning>()) {
+    out.push_back({Content::Type::multibinning, node.encoding(), node.size()});
+  }
+  return out;
+}
+
+double Correction::evaluate(const std::vector<Variable::Type>& values) const {
+  check_inputs(values.size());
+  for (size_t i=0; i < inputs_.size(); ++i) {
+    inputs_[i].validate(values[i]);
+    if ( auto value = std::get_if<StringId>(&values[i]) ) check_string_id(i, *value);
+  }
+  if ( compiled_ ) {
+    thread_local std::vector<double> inputs;
+    inputs.resize(values.size());
+    compiled_inputs(values, inputs.data());
+    return compiled_->evaluate(inputs.data());
+  }
+  return nodes_.visit(node_evaluate{nodes_, values}, data_);
+}
+
+void Correction::evaluate_batch(
+    size_t size,
+    const std::vector<Variable::BatchType>& values,
+    double* output,
+    size_t threads,
+    size_t min_chunk
+    ) const {
+  check_inputs(values.size());
+  // types are checked once per column rather than once per row
+  for (size_t i=0; i < inputs_.size(); ++i) {
+    inputs_[i].validate(values[i]);
+    if ( auto column = std::get_if<Column<StringId>>(&values[i]) ) {
+      for (size_t k=0; k < (column->stride ? size : 1); ++k) check_string_id(i, (*column)[k]);
     }
   }
-  else { throw std::runtime_error("Missing corrections array in CorrectionSet document"); }
+  const size_t chunk = std::max(min_chunk, (size_t) 1);
+  const size_t nchunks = (size + chunk - 1) / chunk;
+  ThreadPool::instance().run(nchunks, threads, [&](size_t ichunk) {
+    const size_t end = std::min(size, (ichunk + 1) * chunk);
+    if ( compiled_ ) {
+      std::vector<double> inputs(values.size());
+      for (size_t i=ichunk * chunk; i < end; ++i) {
+        for (size_t j=0; j < values.size(); ++j) {
+          std::visit([&](const auto& column) {
+            if constexpr ( std::is_same_v<decltype(column), const Column<std::string>&> ) {
+              inputs[j] = string_id(j, column[i]);
+            }
+            else if constexpr ( std::is_same_v<decltype(column), const Column<StringId>&> ) {
+              inputs[j] = column[i].id;
+            }
+            else {
+              inputs[j] = column[i];
+            }
+          }, values[j]);
+        }
+        output[i] = compiled_->evaluate(inputs.data());
+      }
+      return;
+    }
+
+    // the rows of the chunk, indexed from 0
+    const size_t start = ichunk * chunk;
+    std::vector<Variable::BatchType> columns;
+    columns.reserve(values.size());
+    for (const auto& value : values) {
+      columns.push_back(std::visit([&](const auto& column) -> Variable::BatchType {
+        return std::decay_t<decltype(column)>{column.data + start * column.stride, column.stride};
+      }, value));
+    }
+    std::vector<size_t> rows(end - start);
+    std::iota(rows.begin(), rows.end(), 0);
+    BatchWalk(*this, rows.size(), columns, output + start).evaluate(data_, rows.data(), rows.size());
+  });
+}
+
+namespace {
+  void close_library(void* handle) {
+#ifdef _WIN32
+    FreeLibrary((HMODULE) handle);
+#else
+    dlclose(handle);
+#endif
+  }
+}
+
+CompiledLibrary::CompiledLibrary(const std::string& filename) {
+#ifdef _WIN32
+  handle_ = (void*) LoadLibraryA(filename.c_str());
+  if ( ! handle_ ) {
+    throw std::runtime_error("Unable to load compiled corrections from " + filename);
+  }
+  auto symbol = [this](const char* name) { return (const void*) GetProcAddress((HMODULE) handle_, name); };
+#else
+  handle_ = dlopen(filename.c_str(), RTLD_NOW | RTLD_LOCAL);
+  if ( ! handle_ ) {
+    throw std::runtime_error("Unable to load compiled corrections: " + std::string(dlerror()));
+  }
+  auto symbol = [this](const char* name) { return (const void*) dlsym(handle_, name); };
+#endif
+  const auto version = (const int*) symbol("correctionlib_abi_version");
+  const auto ncorrections = (const size_t*) symbol("correctionlib_ncorrections");
+  corrections_ = (const CompiledCorrection*) symbol("correctionlib_corrections");
+  if ( ! version || *version != abi_version || ! ncorrections || ! corrections_ ) {
+    close_library(handle_);
+    throw std::runtime_error("Incompatible compiled corrections in " + filename);
+  }
+  ncorrections_ = *ncorrections;
+}
+
+CompiledLibrary::~CompiledLibrary() {
+  close_library(handle_);
+}
+
+const CompiledCorrection* CompiledLibrary::find(const std::string& name) const {
+  for (size_t i=0; i < ncorrections_; ++i) {
+    if ( name == corrections_[i].name ) return &corrections_[i];
+  }
+  return nullptr;
+}
+
+namespace correction {
+  // Values are written in native byte order, with sizes as 64 bit integers
+  // and arrays of values as one block each
+  class _BinaryWriter {
+    public:
+      // A shallow writer writes the handles of the nodes below the one
+      // written rather than the nodes, as a key for LoadOptions::dedup
+      explicit _BinaryWriter(bool shallow = false) : shallow_(shallow) {};
+      bool shallow() const { return shallow_; };
+      template<typename T>
+      void value(T v) {
+        static_assert(std::is_trivially_copyable_v<T>);
+        buffer_.append((const char*) &v, sizeof(T));
+      };
+      void size(size_t n) { value<uint64_t>(n); };
+      void string(const std::string& s) {
+        size(s.size());
+        buffer_.append(s);
+      };
+      template<typename T>
+      void array(const std::vector<T>& v) {
+        static_assert(std::is_trivially_copyable_v<T>);
+        size(v.size());
+        buffer_.append((const char*) v.data(), v.size() * sizeof(T));
+      };
+      void sizes(const std::vector<size_t>& v) {
+        size(v.size());
+        for (const auto i : v) size(i);
+      };
+      std::string& buffer() { return buffer_; };
+
+    private:
+      bool shallow_;
+      std::string buffer_;
+  };
+
+  // Reads what _BinaryWriter wrote, throwing on anything out of place
+  class _BinaryReader {
+    public:
+      _BinaryReader(const char * data, size_t size) : pos_(data), end_(data + size) {};
+      static void check(bool valid) {
+        if ( ! valid ) {
+          throw std::runtime_error("Invalid binary CorrectionSet data");
+        }
+      };
+      void read(void* out, size_t n) {
+        check(n <= (size_t) (end_ - pos_));
+        std::memcpy(out, pos_, n);
+        pos_ += n;
+      };
+      template<typename T>
+      T value() {
+        static_assert(std::is_trivially_copyable_v<T>);
+        T v;
+        read(&v, sizeof(T));
+        return v;
+      };
+      // an enumeration with values up to last
+      template<typename T>
+      T enumeration(T last) {
+        const auto v = value<uint8_t>();
+        check(v <= (uint8_t) last);
+        return (T) v;
+      };
+      size_t size() {
+        const auto n = value<uint64_t>();
+        check(n <= SIZE_MAX);
+        return n;
+      };
+      // the number of items that follow, of at least item_size bytes each
+      size_t count(size_t item_size = 1) {
+        const size_t n = size();
+        check(n <= (size_t) (end_ - pos_) / item_size);
+        return n;
+      };
+      std::string string() {
+        const size_t n = count();
+        std::string s(pos_, n);
+        pos_ += n;
+        return s;
+      };
+      template<typename T>
+      std::vector<T> array() {
+        const size_t n = count(sizeof(T));
+        std::vector<T> v(n);
+        read(v.data(), n * sizeof(T));
+        return v;
+      };
+      std::vector<size_t> sizes() {
+        std::vector<size_t> v(count(sizeof(uint64_t)));
+        for (auto& i : v) i = size();
+        return v;
+      };
+      bool done() const { return pos_ == end_; };
+
+    private:
+      const char * pos_;
+      const char * end_;
+  };
+}
+
+namespace {
+  Content read_content(_BinaryReader& in, const Correction& context) {
+    switch ( (Content::Type) in.value<uint8_t>() ) {
+      case Content::Type::number: return in.value<double>();
+      case Content::Type::formula: return context.add_node(Formula(in, context));
+      case Content::Type::formularef: return context.add_node(FormulaRef(in, context));
+      case Content::Type::transform: return context.add_node(Transform(in, context));
+      case Content::Type::binning: return context.add_node(Binning(in, context));
+      case Content::Type::multibinning: return context.add_node(MultiBinning(in, context));
+      case Content::Type::category: return context.add_node(Category(in, context));
+    }
+    _BinaryReader::check(false);
+    return 0.;
+  }
+
+  template<typename T>
+  void write_node(_BinaryWriter& out, const _NodeArena& nodes, const T& node) {
+    if constexpr ( std::is_same_v<T, Formula> || std::is_same_v<T, FormulaRef> ) node.write(out);
+    else node.write(out, nodes);
+  }
+
+  void write_content(_BinaryWriter& out, const _NodeArena& nodes, const Content& content) {
+    out.value<uint8_t>((uint8_t) content.type());
+    if ( out.shallow() && ! content.number() ) {
+      out.value(content);
+      return;
+    }
+    nodes.visit([&](const auto& node) {
+      if constexpr ( std::is_same_v<std::decay_t<decltype(node)>, double> ) out.value(node);
+      else write_node(out, nodes, node);
+    }, content);
+  }
+
+  size_t read_input(_BinaryReader& in, const Correction& context) {
+    const size_t idx = in.size();
+    _BinaryReader::check(idx < context.inputs().size());
+    return idx;
+  }
+}
+
+template<typename T>
+Content Correction::dedup(T&& node) const {
+  if constexpr ( std::is_same_v<T, Binning> || std::is_same_v<T, MultiBinning> ) {
+    node.share(*options_._arrays);
+  }
+  // the nodes below were deduplicated already, so only their handles are compared
+  _BinaryWriter out(true);
+  write_node(out, nodes_, node);
+  auto& key = out.buffer();
+  const auto it = dedup_keys_.find(key);
+  if ( it != dedup_keys_.end() ) {
+    dedup_savings_ += sizeof(T) + key.size();
+    return it->second;
+  }
+  const Content handle = nodes_.add(std::move(node));
+  dedup_keys_.emplace(std::move(key), handle);
+  return handle;
+}
+
+void Correction::finish() {
+  nodes_.shrink_to_fit();
+  // only used while loading
+  dedup_keys_ = {};
+}
+
+Variable::Variable(_BinaryReader& in) :
+  name_(in.string()),
+  description_(in.string()),
+  type_(in.enumeration(VarType::real))
+{
+}
+
+void Variable::write(_BinaryWriter& out) const {
+  out.string(name_);
+  out.string(description_);
+  out.value<uint8_t>((uint8_t) type_);
+}
+
+FormulaProgram::FormulaProgram(_BinaryReader& in, size_t ninputs) {
+  const auto ops = in.array<uint8_t>();
+  const auto args = in.array<uint32_t>();
+  constants_ = in.array<double>();
+  stack_size_ = in.size();
+  nlocals_ = in.size();
+  nparameters_ = in.size();
+  variables_ = in.sizes();
+  _BinaryReader::check(ops.size() == args.size());
+  // check that the code runs within the sizes given
+  size_t depth {0};
+  size_t max_depth {0};
+  code_.reserve(ops.size());
+  for (size_t i=0; i < ops.size(); ++i) {
+    const auto op = (OpCode) ops[i];
+    const size_t arg = args[i];
+    bool valid = ops[i] <= (uint8_t) OpCode::Times;
+    switch ( op ) {
+      case OpCode::Literal: valid &= arg < constants_.size(); depth++; break;
+      case OpCode::Variable: valid &= arg < ninputs; depth++; break;
+      case OpCode::Parameter: valid &= arg < nparameters_; depth++; break;
+      case OpCode::Load: valid &= arg < nlocals_; depth++; break;
+      case OpCode::Store: valid &= arg < nlocals_ && depth > 0; break;
+      default:
+        if ( op < OpCode::Atan2 ) valid &= depth > 0;
+        else valid &= depth-- > 1;
+    }
+    _BinaryReader::check(valid);
+    max_depth = std::max(max_depth, depth);
+    code_.push_back({op, (uint32_t) arg});
+  }
+  _BinaryReader::check(depth == 1 && max_depth <= stack_size_);
+  for (const auto idx : variables_) _BinaryReader::check(idx < ninputs);
+}
+
+void FormulaProgram::write(_BinaryWriter& out) const {
+  std::vector<uint8_t> ops;
+  std::vector<uint32_t> args;
+  ops.reserve(code_.size());
+  args.reserve(code_.size());
+  for (const auto& [op, arg] : code_) {
+    ops.push_back((uint8_t) op);
+    args.push_back(arg);
+  }
+  out.array(ops);
+  out.array(args);
+  out.array(constants_);
+  out.size(stack_size_);
+  out.size(nlocals_);
+  out.size(nparameters_);
+  out.sizes(variables_);
+}
+
+Formula::Formula(_BinaryReader& in, const Correction& context) :
+  expression_(in.string()),
+  type_(in.enumeration(FormulaAst::ParserType::numexpr)),
+  program_(in, context.inputs().size()),
+  generic_(in.value<uint8_t>())
+{
+}
+
+void Formula::write(_BinaryWriter& out) const {
+  out.string(expression_);
+  out.value<uint8_t>((uint8_t) type_);
+  program_.write(out);
+  out.value<uint8_t>(generic_);
+}
+
+FormulaRef::FormulaRef(_BinaryReader& in, const Correction& context) :
+  index_(in.size()),
+  parameters_(in.array<double>())
+{
+  formula_ = context.formula_ref(index_);
+  _BinaryReader::check(parameters_.size() >= formula_->program().nparameters());
+}
+
+void FormulaRef::write(_BinaryWriter& out) const {
+  out.size(index_);
+  out.array(parameters_);
+}
+
+Transform::Transform(_BinaryReader& in, const Correction& context) :
+  variableIdx_(read_input(in, context)),
+  rule_(read_content(in, context)),
+  content_(read_content(in, context))
+{
+  _BinaryReader::check(context.inputs()[variableIdx_].type() != Variable::VarType::string);
+}
+
+void Transform::write(_BinaryWriter& out, const _NodeArena& nodes) const {
+  out.size(variableIdx_);
+  write_content(out, nodes, rule_);
+  write_content(out, nodes, content_);
+}
+
+_BinEdges::_BinEdges(_BinaryReader& in) :
+  edges_(shared_array(in.array<double>())),
+  uniform_(in.value<uint8_t>()),
+  low_(in.value<double>()),
+  high_(in.value<double>()),
+  scale_(in.value<double>()),
+  n_(in.size())
+{
+  _BinaryReader::check(n_ > 0 && (uniform_ ? ! edges_ || edges_->size() == n_ + 1 : edges_ && edges_->size() == n_ + 1));
+  // the values as well, since find relies on them
+  _BinaryReader::check(low_ < high_ && std::isfinite(scale_) && scale_ > 0 && scale_ == n_ / (high_ - low_));
+  if ( edges_ ) {
+    const auto& edges = *edges_;
+    _BinaryReader::check(edges.front() == low_ && edges.back() == high_);
+    for (size_t i=1; i < edges.size(); ++i) {
+      _BinaryReader::check(edges[i - 1] < edges[i]);
+    }
+  }
+  plan();
+}
+
+void _BinEdges::write(_BinaryWriter& out) const {
+  if ( out.shallow() ) {
+    // shared if equal
+    out.value(edges_.get());
+  }
+  else {
+    out.array(edges_ ? *edges_ : std::vector<double>());
+  }
+  out.value<uint8_t>(uniform_);
+  out.value(low_);
+  out.value(high_);
+  out.value(scale_);
+  out.size(n_);
+}
+
+Binning::Binning(_BinaryReader& in, const Correction& context) :
+  edges_(in),
+  variableIdx_(read_input(in, context)),
+  flow_(in.enumeration(_FlowBehavior::error))
+{
+  std::vector<Content> bins(in.count());
+  _BinaryReader::check(bins.size() == edges_.nbins() + 1);
+  for (auto& bin : bins) bin = read_content(in, context);
+  bins_ = _LeafArray<Content>(std::move(bins));
+}
+
+void Binning::write(_BinaryWriter& out, const _NodeArena& nodes) const {
+  edges_.write(out);
+  out.size(variableIdx_);
+  out.value<uint8_t>((uint8_t) flow_);
+  out.size(bins_.size());
+  for (const auto& bin : bins_.values()) write_content(out, nodes, bin);
+}
+
+MultiBinning::MultiBinning(_BinaryReader& in, const Correction& context) {
+  const size_t naxes = in.count();
+  size_t stride {1};
+  for (size_t i=0; i < naxes; ++i) {
+    const size_t idx = read_input(in, context);
+    const size_t axis_stride = in.size();
+    axes_.push_back({idx, axis_stride, _BinEdges(in)});
+  }
+  for (auto it=axes_.rbegin(); it != axes_.rend(); ++it) {
+    _BinaryReader::check(std::get<1>(*it) == stride);
+    stride *= std::get<2>(*it).nbins();
+  }
+  flow_ = in.enumeration(_FlowBehavior::error);
+  const size_t size = stride + (flow_ == _FlowBehavior::value);
+  if ( in.value<uint8_t>() ) {
+    auto values = in.array<double>();
+    _BinaryReader::check(values.size() == size);
+    content_ = _LeafArray<double>(std::move(values));
+  }
+  else {
+    std::vector<Content> nodes(in.count());
+    _BinaryReader::check(nodes.size() == size);
+    for (auto& node : nodes) node = read_content(in, context);
+    content_ = _LeafArray<Content>(std::move(nodes));
+  }
+}
+
+void MultiBinning::write(_BinaryWriter& out, const _NodeArena& nodes) const {
+  out.size(axes_.size());
+  for (const auto& [variableIdx, stride, edges] : axes_) {
+    out.size(variableIdx);
+    out.size(stride);
+    edges.write(out);
+  }
+  out.value<uint8_t>((uint8_t) flow_);
+  out.value<uint8_t>(dense());
+  if ( const auto values = std::get_if<_LeafArray<double>>(&content_) ) {
+    out.array(values->values());
+  }
+  else {
+    const auto content = std::get<_LeafArray<Content>>(content_).values();
+    out.size(content.size());
+    for (const auto& node : content) write_content(out, nodes, node);
+  }
+}
+
+_IntIndex::_IntIndex(_BinaryReader& in, uint32_t size) :
+  direct_(in.value<uint8_t>()),
+  offset_(in.value<int32_t>()),
+  slots_(in.array<uint32_t>()),
+  mask_(0),
+  shift_(0)
+{
+  for (const auto pos : slots_) _BinaryReader::check(pos < size || pos == npos);
+  const auto keys = in.array<int32_t>();
+  const auto positions = in.array<uint32_t>();
+  const size_t n = keys.size();
+  // the hash table size is a power of two, with at least one free slot
+  int bits = 0;
+  while ( ((size_t) 1 << bits) < n ) ++bits;
+  _BinaryReader::check(direct_ ? n == 0 : (n == ((size_t) 1 << bits) && bits > 0 && bits < 32 && positions.size() == n));
+  table_.reserve(n);
+  bool free {false};
+  for (size_t i=0; i < n; ++i) {
+    _BinaryReader::check(positions[i] < size || positions[i] == npos);
+    free |= positions[i] == npos;
+    table_.emplace_back(keys[i], positions[i]);
+  }
+  if ( ! direct_ ) {
+    _BinaryReader::check(free);
+    mask_ = (1u << bits) - 1;
+    shift_ = 32 - bits;
+  }
+}
+
+void _IntIndex::write(_BinaryWriter& out) const {
+  out.value<uint8_t>(direct_);
+  out.value<int32_t>(offset_);
+  out.array(slots_);
+  std::vector<int32_t> keys;
+  std::vector<uint32_t> positions;
+  for (const auto& [key, pos] : table_) {
+    keys.push_back(key);
+    positions.push_back(pos);
+  }
+  out.array(keys);
+  out.array(positions);
+}
+
+Category::Category(_BinaryReader& in, const Correction& context) :
+  index_({}),
+  variableIdx_(read_input(in, context))
+{
+  content_.resize(in.count());
+  _BinaryReader::check(content_.size() < _IntIndex::npos);
+  for (auto& node : content_) node = read_content(in, context);
+  index_ = _IntIndex(in, content_.size());
+  if ( in.value<uint8_t>() ) {
+    default_ = read_content(in, context);
+  }
+  if ( context.inputs()[variableIdx_].type() == Variable::VarType::string ) {
+    string_ids_ = context.string_ids(variableIdx_);
+  }
+}
+
+void Category::write(_BinaryWriter& out, const _NodeArena& nodes) const {
+  out.size(variableIdx_);
+  out.size(content_.size());
+  for (const auto& node : content_) write_content(out, nodes, node);
+  index_.write(out);
+  out.value<uint8_t>(default_.has_value());
+  if ( default_ ) write_content(out, nodes, *default_);
+}
+
+Correction::Correction(_BinaryReader& in, const LoadOptions& options) :
+  name_(in.string()),
+  description_(in.string()),
+  version_(in.value<int32_t>()),
+  output_(in),
+  options_(with_array_pool(options))
+{
+  const size_t ninputs = in.count();
+  for (size_t i=0; i < ninputs; ++i) {
+    inputs_.emplace_back(in);
+  }
+  for (const auto& input : inputs_) {
+    if ( input.type() == Variable::VarType::string ) {
+      // in order of id
+      auto ids = std::make_shared<_StringIds>();
+      const size_t n = in.count();
+      for (size_t i=0; i < n; ++i) {
+        _BinaryReader::check(ids->try_emplace(in.string(), i).second);
+      }
+      string_ids_.push_back(ids);
+    }
+    else {
+      string_ids_.push_back(nullptr);
+    }
+  }
+  const size_t nformulas = in.count();
+  for (size_t i=0; i < nformulas; ++i) {
+    formula_refs_.push_back(std::make_shared<Formula>(in, *this));
+  }
+  Content data = read_content(in, *this);
+  if ( options.only && options.only->count(name_) == 0 ) {
+    // as if read from JSON
+    for (auto& ids : string_ids_) {
+      if ( ids ) ids = std::make_shared<_StringIds>();
+    }
+    formula_refs_.clear();
+    nodes_ = _NodeArena();
+    finish();
+    initialized_ = false;
+    return;
+  }
+  data_ = std::move(data);
+  finish();
+  initialized_ = true;
+}
+
+void Correction::write(_BinaryWriter& out) const {
+  check_loaded();
+  out.string(name_);
+  out.string(description_);
+  out.value<int32_t>(version_);
+  output_.write(out);
+  out.size(inputs_.size());
+  for (const auto& input : inputs_) input.write(out);
+  for (const auto& ids : string_ids_) {
+    if ( ! ids ) continue;
+    std::vector<const std::string*> strings(ids->size());
+    for (const auto& [value, id] : *ids) strings[id] = &value;
+    out.size(strings.size());
+    for (const auto value : strings) out.string(*value);
+  }
+  out.size(formula_refs_.size());
+  for (const auto& formula : formula_refs_) formula->write(out);
+  write_content(out, nodes_, data_);
+}
+
+uint64_t Correction::definition_hash() const {
+  _BinaryWriter out;
+  write(out);
+  uint64_t hash {0xcbf29ce484222325};
+  for (const char c : out.buffer()) {
+    hash = (hash ^ (uint8_t) c) * 0x100000001b3;
+  }
+  return hash;
+}
+
+namespace {
+  int check_schema_version(const std::optional<int>& schema_version) {
+    if ( ! schema_version ) {
+      throw std::runtime_error("Missing schema_version in CorrectionSet document");
+    }
+    else if ( *schema_version > evaluator_version ) {
+      throw std::runtime_error("Evaluator is designed for schema v" + std::to_string(evaluator_version) + " and is not forward-compatible");
+    }
+    else if ( *schema_version < evaluator_version ) {
+      throw std::runtime_error("Evaluator is designed for schema v" + std::to_string(evaluator_version) + " and is not backward-compatible");
+    }
+    return *schema_version;
+  }
+
+  // A file mapped read-only into memory, or read into memory if it cannot
+  // be mapped (e.g. if it is empty, or not a regular file)
+  class MappedFile {
+    public:
+      MappedFile(const std::string& fn) {
+#ifdef _WIN32
+        HANDLE file = CreateFileA(fn.c_str(), GENERIC_READ, FILE_SHARE_READ, nullptr, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, nullptr);
+        if ( file != INVALID_HANDLE_VALUE ) {
+          LARGE_INTEGER size;
+          if ( GetFileSizeEx(file, &size) && size.QuadPart > 0 ) {
+            if ( HANDLE mapping = CreateFileMappingA(file, nullptr, PAGE_READONLY, 0, 0, nullptr) ) {
+              map_ = MapViewOfFile(mapping, FILE_MAP_READ, 0, 0, 0);
+              CloseHandle(mapping);
+              size_ = size.QuadPart;
+            }
+          }
+          CloseHandle(file);
+        }
+#else
+        const int fd = open(fn.c_str(), O_RDONLY);
+        if ( fd >= 0 ) {
+          struct stat st;
+          if ( fstat(fd, &st) == 0 && S_ISREG(st.st_mode) && st.st_size > 0 ) {
+            void* map = mmap(nullptr, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+            if ( map != MAP_FAILED ) {
+              map_ = map;
+              size_ = st.st_size;
+            }
+          }
+          close(fd);
+        }
+#endif
+        if ( map_ ) return;
+        FILE* fp = fopen(fn.c_str(), "rb");
+        if ( ! fp ) {
+          throw std::runtime_error("Unable to open file " + fn);
+        }
+        char readBuffer[65536];
+        size_t n;
+        while ( (n = fread(readBuffer, 1, sizeof(readBuffer), fp)) > 0 ) {
+          contents_.append(readBuffer, n);
+        }
+        fclose(fp);
+      };
+      ~MappedFile() {
+        if ( ! map_ ) return;
+#ifdef _WIN32
+        UnmapViewOfFile(map_);
+#else
+        munmap(map_, size_);
+#endif
+      };
+      MappedFile(const MappedFile&) = delete;
+      MappedFile& operator=(const MappedFile&) = delete;
+      const char * data() const { return map_ ? (const char *) map_ : contents_.data(); };
+      size_t size() const { return map_ ? size_ : contents_.size(); };
+      std::string_view view() const { return {data(), size()}; };
+      // the contents if they were read rather than mapped, which may be
+      // modified, e.g. by parsing in place
+      std::string* contents() { return map_ ? nullptr : &contents_; };
+
+    private:
+      void* map_ {nullptr};
+      size_t size_ {0};
+      std::string contents_;
+  };
+
+  // The compression formats recognized by their leading magic bytes
+  enum class Compression {none, gzip, xz, zstd};
+
+  Compression detect_compression(const char * data, size_t size) {
+    const auto starts_with = [&](std::string_view magic) {
+      return size >= magic.size() && std::string_view(data, magic.size()) == magic;
+    };
+    if ( starts_with({"\x1f\x8b", 2}) ) return Compression::gzip;
+    if ( starts_with({"\xfd" "7zXZ\0", 6}) ) return Compression::xz;
+    if ( starts_with({"\x28\xb5\x2f\xfd", 4}) ) return Compression::zstd;
+    return Compression::none;
+  }
+
+  // Decompresses a buffer held in memory (e.g. a file mapping) piece by piece
+  class Decompressor {
+    public:
+      virtual ~Decompressor() = default;
+      // fill out with up to size bytes, returning fewer only at the end of the data
+      virtual size_t read(char * out, size_t size) = 0;
+  };
+
+#ifdef CORRECTIONLIB_ZLIB
+  class GzipDecompressor : public Decompressor {
+    public:
+      GzipDecompressor(const char * data, size_t size) : input_(data), remaining_(size) {
+        // 16: expect a gzip header
+        if ( inflateInit2(&stream_, 16 + MAX_WBITS) != Z_OK ) {
+          throw std::runtime_error("Unable to initialize gzip decompression");
+        }
+      };
+      ~GzipDecompressor() { inflateEnd(&stream_); };
+      size_t read(char * out, size_t size) override {
+        stream_.next_out = (Bytef*) out;
+        stream_.avail_out = size;
+        while ( stream_.avail_out > 0 && ! done_ ) {
+          if ( stream_.avail_in == 0 ) {
+            if ( remaining_ == 0 ) {
+              throw std::runtime_error("Truncated gzip-compressed data");
+            }
+            // avail_in is only an unsigned int
+            const size_t n = std::min(remaining_, (size_t) 1 << 30);
+            stream_.next_in = (Bytef*) input_;
+            stream_.avail_in = n;
+            input_ += n;
+            remaining_ -= n;
+          }
+          const int ret = inflate(&stream_, Z_NO_FLUSH);
+          if ( ret == Z_STREAM_END ) {
+            // as with gunzip, concatenated members are decompressed in sequence
+            if ( stream_.avail_in == 0 && remaining_ == 0 ) done_ = true;
+            else inflateReset(&stream_);
+          }
+          else if ( ret != Z_OK ) {
+            throw std::runtime_error(std::string("Invalid gzip-compressed data: ") + (stream_.msg ? stream_.msg : zError(ret)));
+          }
+        }
+        return size - stream_.avail_out;
+      };
+
+    private:
+      z_stream stream_ {};
+      const char * input_;
+      size_t remaining_;
+      bool done_ {false};
+  };
+#endif
+
+#ifdef CORRECTIONLIB_LZMA
+  class XzDecompressor : public Decompressor {
+    public:
+      XzDecompressor(const char * data, size_t size) {
+        if ( lzma_stream_decoder(&stream_, UINT64_MAX, LZMA_CONCATENATED) != LZMA_OK ) {
+          throw std::runtime_error("Unable to initialize xz decompression");
+        }
+        stream_.next_in = (const uint8_t*) data;
+        stream_.avail_in = size;
+      };
+      ~XzDecompressor() { lzma_end(&stream_); };
+      size_t read(char * out, size_t size) override {
+        stream_.next_out = (uint8_t*) out;
+        stream_.avail_out = size;
+        while ( stream_.avail_out > 0 && ! done_ ) {
+          // all of the input is available from the start
+          const lzma_ret ret = lzma_code(&stream_, LZMA_FINISH);
+          if ( ret == LZMA_STREAM_END ) done_ = true;
+          else if ( ret == LZMA_BUF_ERROR ) {
+            throw std::runtime_error("Truncated xz-compressed data");
+          }
+          else if ( ret != LZMA_OK ) {
+            throw std::runtime_error("Invalid xz-compressed data (liblzma error " + std::to_string(ret) + ")");
+          }
+        }
+        return size - stream_.avail_out;
+      };
+
+    private:
+      lzma_stream stream_ = LZMA_STREAM_INIT;
+      bool done_ {false};
+  };
+#endif
+
+#ifdef CORRECTIONLIB_ZSTD
+  class ZstdDecompressor : public Decompressor {
+    public:
+      ZstdDecompressor(const char * data, size_t size) : stream_(ZSTD_createDStream()), input_{data, size, 0} {
+        if ( stream_ == nullptr || ZSTD_isError(ZSTD_initDStream(stream_)) ) {
+          ZSTD_freeDStream(stream_);
+          throw std::runtime_error("Unable to initialize zstd decompression");
+        }
+      };
+      ~ZstdDecompressor() { ZSTD_freeDStream(stream_); };
+      size_t read(char * out, size_t size) override {
+        ZSTD_outBuffer output {out, size, 0};
+        while ( output.pos < output.size ) {
+          // a zero hint means all frames so far are complete and flushed
+          if ( input_.pos == input_.size && hint_ == 0 ) break;
+          const size_t consumed = input_.pos;
+          const size_t produced = output.pos;
+          hint_ = ZSTD_decompressStream(stream_, &output, &input_);
+          if ( ZSTD_isError(hint_) ) {
+            throw std::runtime_error(std::string("Invalid zstd-compressed data: ") + ZSTD_getErrorName(hint_));
+          }
+          if ( input_.pos == consumed && output.pos == produced ) {
+            throw std::runtime_error("Truncated zstd-compressed data");
+          }
+        }
+        return output.pos;
+      };
+
+    private:
+      ZSTD_DStream* stream_;
+      ZSTD_inBuffer input_;
+      size_t hint_ {1};
+  };
+#endif
+
+  std::unique_ptr<Decompressor> make_decompressor(Compression compression, const char * data, size_t size) {
+    switch ( compression ) {
+      case Compression::gzip:
+#ifdef CORRECTIONLIB_ZLIB
+        return std::make_unique<GzipDecompressor>(data, size);
+#else
+        throw std::runtime_error("Unable to read gzip-compressed data: correctionlib was built without zlib");
+#endif
+      case Compression::xz:
+#ifdef CORRECTIONLIB_LZMA
+        return std::make_unique<XzDecompressor>(data, size);
+#else
+        throw std::runtime_error("Unable to read xz-compressed data: correctionlib was built without liblzma");
+#endif
+      case Compression::zstd:
+#ifdef CORRECTIONLIB_ZSTD
+        return std::make_unique<ZstdDecompressor>(data, size);
+#else
+        throw std::runtime_error("Unable to read zstd-compressed data: correctionlib was built without libzstd");
+#endif
+      case Compression::none:
+        break;
+    }
+    throw std::logic_error("Not a compression format");
+  }
+
+  // A rapidjson input stream over data in memory, or over its decompressed
+  // contents one chunk at a time (c.f. rapidjson::FileReadStream)
+  class JsonStream {
+    public:
+      typedef char Ch;
+
+      JsonStream(const char * data, size_t size) : begin_(data), end_(data + size), current_(data) {
+        if ( size == 0 ) Fill();
+      };
+      JsonStream(Decompressor& decompressor) : decompressor_(&decompressor), buffer_(65536) { Fill(); };
+      JsonStream(const JsonStream&) = delete;
+      JsonStream& operator=(const JsonStream&) = delete;
+      Ch Peek() const { return *current_; };
+      Ch Take() {
+        Ch c = *current_;
+        // stays on the NUL past the end
+        if ( current_ != end_ && ++current_ == end_ ) Fill();
+        return c;
+      };
+      size_t Tell() const { return count_ + (current_ - begin_); };
+
+      // not implemented
+      void Put(Ch) { RAPIDJSON_ASSERT(false); };
+      void Flush() { RAPIDJSON_ASSERT(false); };
+      Ch* PutBegin() { RAPIDJSON_ASSERT(false); return 0; };
+      size_t PutEnd(Ch*) { RAPIDJSON_ASSERT(false); return 0; };
+
+    private:
+      // the next chunk, or a NUL at the end of the data
+      void Fill() {
+        count_ += end_ - begin_;
+        const size_t n = decompressor_ ? decompressor_->read(buffer_.data(), buffer_.size()) : 0;
+        begin_ = ( n > 0 ) ? buffer_.data() : &nul_;
+        end_ = begin_ + n;
+        current_ = begin_;
+      };
+
+      Decompressor* decompressor_ {nullptr};
+      std::vector<char> buffer_;
+      const char nul_ {'\0'};
+      const char * begin_ {nullptr};
+      const char * end_ {nullptr};
+      const char * current_ {nullptr};
+      size_t count_ {0};
+  };
+
+  std::string decompress(Compression compression, const char * data, size_t size) {
+    auto decompressor = make_decompressor(compression, data, size);
+    std::string out;
+    size_t n;
+    do {
+      const size_t offset = out.size();
+      out.resize(offset + 65536);
+      n = decompressor->read(out.data() + offset, 65536);
+      out.resize(offset + n);
+    } while ( n == 65536 );
+    return out;
+  }
+
+  // written under a temporary name first, so that concurrent readers never
+  // see a partial file; failures only mean there is no cache
+  void write_cache_file(const std::string& fn, const std::string& data) {
+    const auto unique = std::hash<std::thread::id>{}(std::this_thread::get_id())
+      ^ (size_t) std::chrono::steady_clock::now().time_since_epoch().count();
+    const std::string tmp = fn + "." + std::to_string(unique) + ".tmp";
+    FILE* fp = fopen(tmp.c_str(), "wb");
+    if ( ! fp ) return;
+    const bool ok = fwrite(data.data(), 1, data.size(), fp) == data.size();
+    if ( fclose(fp) != 0 || ! ok || std::rename(tmp.c_str(), fn.c_str()) != 0 ) {
+      std::remove(tmp.c_str());
+    }
+  }
+
+  // FNV-1a, to name the cached binary form of a document
+  uint64_t content_hash(const std::string_view data) {
+    uint64_t hash = 14695981039346656037ull;
+    for (const unsigned char c : data) {
+      hash = (hash ^ c) * 1099511628211ull;
+    }
+    return hash;
+  }
+
+  std::string cache_file(const std::string_view document, const LoadOptions& options) {
+    char name[64];
+    std::snprintf(name, sizeof(name), "/%016llx-v%u%s.bin",
+        (unsigned long long) content_hash(document),
+        (unsigned) CorrectionSet::binary_version,
+        options.fast_math ? "-fast" : "");
+    return options.cache_dir + name;
+  }
+
+  // marks the start of the binary format, followed by the version and a
+  // value that differs between byte orders
+  constexpr char binary_magic[8] = {'\x89', 'C', 'L', 'I', 'B', '\r', '\n', '\x1a'};
+  constexpr uint32_t byte_order_mark {0x01020304};
+
+  std::runtime_error json_parse_error(const rapidjson::ParseResult& result, size_t offset = 0) {
+    return std::runtime_error(
+        std::string("JSON parse error: ") + rapidjson::GetParseError_En(result.Code())
+        + " at offset " + std::to_string(offset + result.Offset())
+        );
+  }
+
+  // Finds the schema version and the name and source of each correction of a
+  // CorrectionSet document without building it, for LoadOptions::lazy
+  class DocumentScanner : public rapidjson::BaseReaderHandler<rapidjson::UTF8<>, DocumentScanner> {
+    public:
+      DocumentScanner(const rapidjson::MemoryStream& stream) : stream_(stream) {};
+
+      bool Key(const char* str, rapidjson::SizeType length, bool) {
+        if ( depth_ == 1 ) root_key_.assign(str, length);
+        in_name_ = in_correction() && std::string_view(str, length) == "name";
+        return true;
+      };
+      bool String(const char* str, rapidjson::SizeType length, bool) {
+        if ( in_name_ ) name_.emplace(str, length);
+        in_name_ = false;
+        return true;
+      };
+      bool Int(int i) {
+        if ( depth_ == 1 && root_key_ == "schema_version" ) schema_version = i;
+        return true;
+      };
+      bool Uint(unsigned i) {
+        if ( i <= (unsigned) std::numeric_limits<int>::max() ) return Int((int) i);
+        return true;
+      };
+      bool StartObject() {
+        if ( depth_ == 2 && in_corrections_ ) {
+          start_ = stream_.Tell() - 1;
+          name_.reset();
+        }
+        ++depth_;
+        return true;
+      };
+      bool EndObject(rapidjson::SizeType) {
+        if ( in_correction() ) {
+          if ( ! name_ ) {
+            throw std::runtime_error("Missing name of correction in CorrectionSet document");
+          }
+          corrections.emplace_back(*name_, std::string_view(stream_.begin_ + start_, stream_.Tell() - start_));
+        }
+        --depth_;
+        return true;
+      };
+      bool StartArray() {
+        if ( depth_ == 1 && root_key_ == "corrections" ) {
+          in_corrections_ = true;
+          has_corrections = true;
+        }
+        ++depth_;
+        return true;
+      };
+      bool EndArray(rapidjson::SizeType) {
+        if ( --depth_ == 1 ) in_corrections_ = false;
+        return true;
+      };
+
+      std::optional<int> schema_version;
+      bool has_corrections {false};
+      std::vector<std::pair<std::string, std::string_view>> corrections;
+
+    private:
+      bool in_correction() const { return depth_ == 3 && in_corrections_; };
+
+      const rapidjson::MemoryStream& stream_;
+      size_t depth_ {0};
+      std::string root_key_;
+      bool in_corrections_ {false};
+      bool in_name_ {false};
+      size_t start_ {0};
+      std::optional<std::string> name_;
+  };
+}
+
+namespace correction {
+  // Reads a JSON document piece by piece, so that a CorrectionSet can be built
+  // while it is parsed rather than from a complete rapidjson::Document. Only
+  // the brackets and separators are read here: each scalar is parsed by the
+  // same rapidjson::Reader as a Document would be, so values and errors are
+  // the same. Small objects are read into a Document of their own.
+  class _JsonReader {
+    public:
+      // Thrown where the document is not laid out as the constructors from a
+      // _JsonReader expect, i.e. with the members of each object in the order
+      // correctionlib writes them, so that it is loaded as a whole instead
+      struct Unstreamable {};
+      static void expect(bool valid) {
+        if ( ! valid ) throw Unstreamable();
+      };
+
+      // The last scalar read, as a rapidjson::Value would hold it
+      struct Scalar : public rapidjson::BaseReaderHandler<rapidjson::UTF8<>, Scalar> {
+        bool Default() { set(false, false, false); return true; };
+        bool Int(int i) { set(true, true, false); number = i; int_value = i; return true; };
+        bool Uint(unsigned u) {
+          set(true, u <= (unsigned) std::numeric_limits<int>::max(), false);
+          number = u;
+          int_value = (int) u;
+          return true;
+        };
+        bool Int64(int64_t i) { set(true, false, false); number = (double) i; return true; };
+        bool Uint64(uint64_t u) { set(true, false, false); number = (double) u; return true; };
+        bool Double(double d) { set(true, false, true); number = d; return true; };
+        bool String(const char* str, rapidjson::SizeType length, bool) {
+          set(false, false, false);
+          is_string = true;
+          string.assign(str, length);
+          return true;
+        };
+
+        bool is_string {false};
+        bool is_number {false};
+        // IsInt() and IsDouble() of rapidjson::Value
+        bool is_int {false};
+        bool is_double {false};
+        double number {0.};
+        int int_value {0};
+        std::string string;
+
+        private:
+          void set(bool numeric, bool integer, bool floating) {
+            is_string = false;
+            is_number = numeric;
+            is_int = integer;
+            is_double = floating;
+          };
+      };
+
+      // Numbers of an array, read in one go straight into values; those that
+      // are not IsDouble() are refused if doubles is set
+      struct Numbers : public rapidjson::BaseReaderHandler<rapidjson::UTF8<>, Numbers> {
+        Numbers(std::vector<double>& values, bool doubles) : values(values), doubles(doubles) {};
+        bool Default() { return false; };
+        bool StartObject() { object = true; return false; };
+        bool StartArray() { return depth++ == 0; };
+        bool EndArray(rapidjson::SizeType) { --depth; return true; };
+        bool Int(int i) { return add(i, false); };
+        bool Uint(unsigned u) { return add(u, false); };
+        bool Int64(int64_t i) { return add((double) i, false); };
+        bool Uint64(uint64_t u) { return add((double) u, false); };
+        bool Double(double d) { return add(d, true); };
+        bool add(double value, bool is_double) {
+          if ( doubles && ! is_double ) return false;
+          values.push_back(value);
+          return true;
+        };
+
+        std::vector<double>& values;
+        const bool doubles;
+        size_t depth {0};
+        bool object {false};
+      };
+
+      _JsonReader(JsonStream& stream) :
+        stream_(stream),
+        buffer_(16384),
+        pool_(buffer_.data(), buffer_.size()),
+        scratch_(&pool_),
+        item_(&pool_)
+      {};
+
+      // The first character of the next value
+      char peek() {
+        rapidjson::SkipWhitespace(stream_);
+        return stream_.Peek();
+      };
+      // If the next value is an object (array), enter it and return true
+      bool object() { return open('{'); };
+      bool array() { return open('['); };
+      // The name of the next member of the current object, or false at its end
+      bool member(std::string& key) {
+        if ( ! next('}', rapidjson::kParseErrorObjectMissCommaOrCurlyBracket) ) return false;
+        if ( stream_.Peek() != '"' ) error(rapidjson::kParseErrorObjectMissName);
+        key = scalar().string;
+        rapidjson::SkipWhitespace(stream_);
+        if ( stream_.Peek() != ':' ) error(rapidjson::kParseErrorObjectMissColon);
+        stream_.Take();
+        return true;
+      };
+      // Whether another element of the current array follows
+      bool element() { return next(']', rapidjson::kParseErrorArrayMissCommaOrSquareBracket); };
+      // The next value, which must not be an object or array
+      const Scalar& scalar() {
+        expect(start() != '{' && stream_.Peek() != '[');
+        parse(scalar_);
+        return scalar_;
+      };
+      double number() {
+        expect(scalar().is_number);
+        return scalar_.number;
+      };
+      const std::string& string() {
+        expect(scalar().is_string);
+        return scalar_.string;
+      };
+      void skip() {
+        rapidjson::BaseReaderHandler<> ignore;
+        start();
+        parse(ignore);
+      };
+      // The next value, only scanned for where it ends, which is much faster
+      // than skip(): what is between its brackets and quotes is not checked
+      void skim() {
+        const char first = start();
+        if ( first == ',' || first == ']' || first == '}' ) throw Unstreamable();
+        size_t depth {0};
+        while ( true ) {
+          const char c = stream_.Peek();
+          // the end of a number or literal
+          if ( depth == 0 && (c == ',' || c == ']' || c == '}') ) return;
+          // truncated: for the whole parse to report
+          if ( c == '\0' ) throw Unstreamable();
+          stream_.Take();
+          if ( c == '"' ) {
+            for (char s = stream_.Take(); s != '"'; s = stream_.Take()) {
+              if ( s == '\\' ) s = stream_.Take();
+              if ( s == '\0' ) throw Unstreamable();
+            }
+            if ( depth == 0 ) return;
+          }
+          else if ( c == '[' || c == '{' ) ++depth;
+          else if ( (c == ']' || c == '}') && --depth == 0 ) return;
+        }
+      };
+      // The next value, into a Document
+      void value(rapidjson::Document& json) {
+        start();
+        const rapidjson::ParseResult ok = json.ParseStream<rapidjson::kParseStopWhenDoneFlag>(stream_);
+        if ( ! ok ) throw json_parse_error(ok);
+      };
+      // An array of numbers, read straight into values. If doubles is set, an
+      // object among them is entered instead, along with the array, and false
+      // returned for the caller to read on from there with member()
+      bool numbers(std::vector<double>& values, bool doubles) {
+        expect(peek() == '[');
+        Numbers handler(values, doubles);
+        const auto ok = reader_.Parse<rapidjson::kParseStopWhenDoneFlag>(stream_, handler);
+        if ( ok ) return true;
+        if ( ok.Code() != rapidjson::kParseErrorTermination ) throw json_parse_error(ok);
+        expect(doubles && handler.object && handler.depth == 1);
+        // past the first element of the array, before that of the object
+        first_.push_back(false);
+        first_.push_back(true);
+        return false;
+      };
+      // The remaining members of the current object, as a Document that is
+      // only valid until the next call
+      rapidjson::Document& rest() {
+        scratch_.SetObject();
+        pool_.Clear();
+        std::string key;
+        while ( member(key) ) {
+          value(item_);
+          scratch_.AddMember(rapidjson::Value(key.c_str(), key.size(), pool_), item_, pool_);
+        }
+        return scratch_;
+      };
+      // Nothing but whitespace may follow the document
+      void end() {
+        rapidjson::SkipWhitespace(stream_);
+        if ( stream_.Peek() != '\0' ) error(rapidjson::kParseErrorDocumentRootNotSingular);
+      };
+
+    private:
+      [[noreturn]] void error(rapidjson::ParseErrorCode code) {
+        throw json_parse_error(rapidjson::ParseResult(code, stream_.Tell()));
+      };
+      // skip to the start of a value, as rapidjson::Reader::ParseValue would
+      char start() {
+        if ( peek() == '\0' ) error(rapidjson::kParseErrorValueInvalid);
+        return stream_.Peek();
+      };
+      template<typename Handler>
+      void parse(Handler& handler) {
+        const auto ok = reader_.Parse<rapidjson::kParseStopWhenDoneFlag>(stream_, handler);
+        if ( ! ok ) throw json_parse_error(ok);
+      };
+      bool open(char bracket) {
+        if ( peek() != bracket ) return false;
+        stream_.Take();
+        first_.push_back(true);
+        return true;
+      };
+      // past the separator before the next item of the current object or
+      // array, or its closing bracket
+      bool next(char bracket, rapidjson::ParseErrorCode missing) {
+        rapidjson::SkipWhitespace(stream_);
+        const char c = stream_.Peek();
+        if ( c == bracket ) {
+          stream_.Take();
+          first_.pop_back();
+          return false;
+        }
+        if ( first_.back() ) {
+          first_.back() = false;
+          return true;
+        }
+        if ( c != ',' ) error(missing);
+        stream_.Take();
+        rapidjson::SkipWhitespace(stream_);
+        return true;
+      };
+
+      JsonStream& stream_;
+      rapidjson::Reader reader_;
+      Scalar scalar_;
+      // for rest(), reused for each object
+      std::vector<char> buffer_;
+      rapidjson::MemoryPoolAllocator<> pool_;
+      rapidjson::Document scratch_;
+      rapidjson::Document item_;
+      // whether the next item of each object or array entered is its first
+      std::vector<bool> first_;
+  };
+}
+
+namespace {
+  // a Content node, the object of which has been entered
+  Content resolve_node(_JsonReader& in, const Correction& context) {
+    std::string key;
+    _JsonReader::expect(in.member(key) && key == "nodetype");
+    const std::string nodetype = in.string();
+    if ( nodetype == "binning" ) { return context.add_node(Binning(in, context)); }
+    else if ( nodetype == "multibinning" ) { return context.add_node(MultiBinning(in, context)); }
+    else if ( nodetype == "category" ) { return context.add_node(Category(in, context)); }
+    else if ( nodetype == "transform" ) { return context.add_node(Transform(in, context)); }
+    else if ( nodetype == "formula" || nodetype == "formularef" ) {
+      // small enough to read whole
+      auto& json = in.rest();
+      json.AddMember("nodetype", rapidjson::Value(nodetype.c_str(), nodetype.size(), json.GetAllocator()), json.GetAllocator());
+      if ( nodetype == "formula" ) return context.add_node(Formula(json, context));
+      return context.add_node(FormulaRef(json, context));
+    }
+    throw std::runtime_error("Unrecognized Content node type");
+  }
+
+  Content resolve_content(_JsonReader& in, const Correction& context) {
+    if ( in.object() ) return resolve_node(in, context);
+    const auto& value = in.scalar();
+    if ( value.is_double ) return value.number;
+    throw std::runtime_error("Unrecognized Content node type");
+  }
+
+  // The content of a Binning or MultiBinning, straight into values as long
+  // as it is all numbers, and otherwise into nodes; returns whether it was
+  bool read_content(_JsonReader& in, const Correction& context, std::vector<double>& values, std::vector<Content>& nodes) {
+    if ( in.numbers(values, true) ) return true;
+    nodes.reserve(values.capacity());
+    nodes.assign(values.begin(), values.end());
+    values = {};
+    nodes.push_back(resolve_node(in, context));
+    while ( in.element() ) {
+      nodes.push_back(resolve_content(in, context));
+    }
+    return false;
+  }
+
+  // the flow of a Binning or MultiBinning, with the default value if it is a
+  // Content node; only resolved after the content, as from a Document
+  _FlowBehavior read_flow(_JsonReader& in, const Correction& context, bool after_content, Content& default_value) {
+    if ( in.peek() == '"' ) {
+      const auto& flow = in.string();
+      if ( flow == "clamp" ) return _FlowBehavior::clamp;
+      else if ( flow == "error" ) return _FlowBehavior::error;
+      throw std::runtime_error("Unrecognized Content node type");
+    }
+    _JsonReader::expect(after_content || in.peek() != '{');
+    default_value = resolve_content(in, context);
+    return _FlowBehavior::value;
+  }
+
+  _BinEdges read_edges(_JsonReader& in) {
+    if ( in.object() ) {
+      return _BinEdges(in.rest());
+    }
+    std::vector<double> edges;
+    in.numbers(edges, false);
+    edges.shrink_to_fit();
+    return _BinEdges(std::move(edges));
+  }
+
+  // The members of a Correction object before its data, which correctionlib
+  // writes last; the data is then read by the constructor
+  rapidjson::Document correction_header(_JsonReader& in) {
+    rapidjson::Document json(rapidjson::kObjectType);
+    std::string key;
+    while ( in.member(key) ) {
+      if ( key == "data" ) {
+        for (const char * name : {"name", "version", "inputs", "output"}) {
+          _JsonReader::expect(json.HasMember(name));
+        }
+        return json;
+      }
+      rapidjson::Document item(&json.GetAllocator());
+      in.value(item);
+      json.AddMember(rapidjson::Value(key.c_str(), key.size(), json.GetAllocator()), item, json.GetAllocator());
+    }
+    throw _JsonReader::Unstreamable();
+  }
+}
+
+Transform::Transform(_JsonReader& in, const Correction& context) {
+  bool has_input {false}, has_rule {false}, has_content {false};
+  std::string key;
+  while ( in.member(key) ) {
+    if ( key == "input" ) {
+      _JsonReader::expect(! has_input);
+      variableIdx_ = context.input_index(in.string());
+      if ( context.inputs()[variableIdx_].type() == Variable::VarType::string ) {
+        throw std::runtime_error("Transform cannot rewrite string inputs");
+      }
+      has_input = true;
+    }
+    else if ( key == "rule" ) {
+      _JsonReader::expect(! has_rule);
+      rule_ = resolve_content(in, context);
+      has_rule = true;
+    }
+    else if ( key == "content" ) {
+      _JsonReader::expect(has_rule && ! has_content);
+      content_ = resolve_content(in, context);
+      has_content = true;
+    }
+    else in.skip();
+  }
+  _JsonReader::expect(has_input && has_content);
+}
+
+Binning::Binning(_JsonReader& in, const Correction& context) {
+  bool has_input {false}, has_edges {false}, has_content {false}, has_flow {false};
+  std::vector<Content> bins;
+  Content default_value{0.};
+  std::string key;
+  while ( in.member(key) ) {
+    if ( key == "input" ) {
+      _JsonReader::expect(! has_input);
+      variableIdx_ = context.input_index(in.string());
+      has_input = true;
+    }
+    else if ( key == "edges" ) {
+      _JsonReader::expect(! has_edges);
+      edges_ = read_edges(in);
+      has_edges = true;
+    }
+    else if ( key == "content" ) {
+      _JsonReader::expect(! has_content);
+      std::vector<double> values;
+      if ( has_edges ) values.reserve(edges_.nbins());
+      if ( read_content(in, context, values, bins) ) {
+        bins.reserve(values.size() + 1);
+        bins.assign(values.begin(), values.end());
+      }
+      has_content = true;
+    }
+    else if ( key == "flow" ) {
+      _JsonReader::expect(! has_flow);
+      flow_ = read_flow(in, context, has_content, default_value);
+      has_flow = true;
+    }
+    else in.skip();
+  }
+  _JsonReader::expect(has_input && has_edges && has_content && has_flow);
+  if ( edges_.nbins() != bins.size() ) {
+    throw std::runtime_error("Inconsistency in Binning: number of content nodes does not match binning");
+  }
+  // store default value at end of content array
+  bins.push_back(std::move(default_value));
+  bins_ = _LeafArray<Content>(std::move(bins));
+}
+
+MultiBinning::MultiBinning(_JsonReader& in, const Correction& context) {
+  std::vector<std::string> inputs;
+  std::vector<_BinEdges> edges;
+  bool has_inputs {false}, has_edges {false}, has_content {false}, has_flow {false};
+  // only one of these is filled, depending on whether the content is dense
+  std::vector<double> values;
+  std::vector<Content> nodes;
+  bool dense {true};
+  Content default_value{0.};
+  std::string key;
+  while ( in.member(key) ) {
+    if ( key == "inputs" ) {
+      _JsonReader::expect(! has_inputs && in.array());
+      while ( in.element() ) inputs.push_back(in.string());
+      has_inputs = true;
+    }
+    else if ( key == "edges" ) {
+      _JsonReader::expect(! has_edges && in.array());
+      while ( in.element() ) edges.push_back(read_edges(in));
+      has_edges = true;
+    }
+    else if ( key == "content" ) {
+      _JsonReader::expect(! has_content);
+      if ( has_edges ) {
+        size_t size {1};
+        for (const auto& axis : edges) size *= axis.nbins();
+        values.reserve(size + 1); // + 1 for default value
+      }
+      dense = read_content(in, context, values, nodes);
+      has_content = true;
+    }
+    else if ( key == "flow" ) {
+      _JsonReader::expect(! has_flow);
+      flow_ = read_flow(in, context, has_content, default_value);
+      has_flow = true;
+    }
+    else in.skip();
+  }
+  _JsonReader::expect(has_inputs && has_edges && has_content && has_flow && inputs.size() >= edges.size());
+  axes_.reserve(edges.size());
+  for (size_t i=0; i < edges.size(); ++i) {
+    axes_.push_back({context.input_index(inputs[i]), 0, std::move(edges[i])});
+  }
+  size_t stride {1};
+  for (auto it=axes_.rbegin(); it != axes_.rend(); ++it) {
+    std::get<1>(*it) = stride;
+    stride *= std::get<2>(*it).nbins();
+  }
+  if ( (dense ? values.size() : nodes.size()) != stride ) {
+    throw std::runtime_error("Inconsistency in MultiBinning: number of content nodes does not match binning");
+  }
+  if ( dense && flow_ == _FlowBehavior::value && ! default_value.number() ) {
+    nodes.reserve(values.size() + 1);
+    nodes.assign(values.begin(), values.end());
+    values = {};
+    dense = false;
+  }
+  if ( dense ) {
+    if ( flow_ == _FlowBehavior::value ) {
+      // store default value at end of content array
+      values.push_back(default_value.value());
+    }
+    content_ = _LeafArray<double>(std::move(values));
+  }
+  else {
+    if ( flow_ == _FlowBehavior::value ) {
+      nodes.push_back(std::move(default_value));
+    }
+    content_ = _LeafArray<Content>(std::move(nodes));
+  }
+}
+
+Category::Category(_JsonReader& in, const Correction& context) :
+  index_({})
+{
+  bool has_input {false}, has_content {false}, has_default {false};
+  std::vector<int> keys;
+  std::string key;
+  while ( in.member(key) ) {
+    if ( key == "input" ) {
+      _JsonReader::expect(! has_input);
+      variableIdx_ = context.input_index(in.string());
+      has_input = true;
+    }
+    else if ( key == "content" ) {
+      // string keys are interned in order, with the nodes they lead to
+      _JsonReader::expect(has_input && ! has_content && in.array());
+      const auto& variable = context.inputs()[variableIdx_];
+      // as with std::map::try_emplace, the first occurrence of a key wins
+      std::unordered_set<int> seen;
+      while ( in.element() ) {
+        _JsonReader::expect(in.object());
+        std::optional<int> item_key;
+        bool has_value {false};
+        while ( in.member(key) ) {
+          if ( key == "key" ) {
+            _JsonReader::expect(! item_key);
+            const auto& value = in.scalar();
+            if ( value.is_string ) {
+              if ( variable.type() != Variable::VarType::string ) {
+                throw std::runtime_error("Category got a key not of type string, but its input is string type");
+              }
+              item_key = context.intern_string(variableIdx_, value.string);
+            }
+            else if ( value.is_int ) {
+              if ( variable.type() != Variable::VarType::integer ) {
+                throw std::runtime_error("Category got a key not of type int, but its input is int type");
+              }
+              item_key = value.int_value;
+            }
+            else {
+              throw std::runtime_error("Invalid key type in Category");
+            }
+          }
+          else if ( key == "value" ) {
+            _JsonReader::expect(item_key && ! has_value);
+            if ( seen.insert(*item_key).second ) {
+              keys.push_back(*item_key);
+              content_.push_back(resolve_content(in, context));
+            }
+            else in.skip();
+            has_value = true;
+          }
+          else in.skip();
+        }
+        _JsonReader::expect(has_value);
+      }
+      content_.shrink_to_fit();
+      has_content = true;
+    }
+    else if ( key == "default" ) {
+      _JsonReader::expect(! has_default && (has_content || in.peek() != '{'));
+      if ( in.peek() == 'n' ) in.skip();
+      else default_ = resolve_content(in, context);
+      has_default = true;
+    }
+    else in.skip();
+  }
+  _JsonReader::expect(has_content);
+  index_ = _IntIndex(keys);
+  if ( context.inputs()[variableIdx_].type() == Variable::VarType::string ) {
+    string_ids_ = context.string_ids(variableIdx_);
+  }
+}
+
+Correction::Correction(_JsonReader& in, const LoadOptions& options) :
+  Correction(correction_header(in), &in, options)
+{
+  if ( ! initialized_ ) {
+    // the data of a correction left out by LoadOptions::only
+    in.skim();
+  }
+  // anything after the data must not have been needed for it
+  std::string key;
+  while ( in.member(key) ) {
+    for (const char * name : {"name", "description", "version", "inputs", "output", "generic_formulas", "data"}) {
+      _JsonReader::expect(key != name);
+    }
+    in.skip();
+  }
+}
+
+CorrectionSet::CorrectionSet(_JsonReader& in, const LoadOptions& options) :
+  options_(with_array_pool(options))
+{
+  _JsonReader::expect(in.object());
+  bool has_version {false}, has_corrections {false};
+  std::string key;
+  while ( in.member(key) ) {
+    if ( key == "schema_version" ) {
+      _JsonReader::expect(! has_version);
+      const auto& value = in.scalar();
+      schema_version_ = check_schema_version(value.is_int ? std::optional<int>(value.int_value) : std::nullopt);
+      if ( ! options.compiled.empty() ) {
+        library_ = std::make_shared<const CompiledLibrary>(options.compiled);
+      }
+      has_version = true;
+    }
+    else if ( key == "corrections" ) {
+      _JsonReader::expect(has_version && ! has_corrections && in.array());
+      while ( in.element() ) {
+        _JsonReader::expect(in.object());
+        auto corr = std::make_shared<Correction>(in, options_);
+        if ( library_ ) corr->use_compiled(library_);
+        corrections_[corr->name()] = corr;
+      }
+      has_corrections = true;
+    }
+    else in.skip();
+  }
+  _JsonReader::expect(has_corrections);
+  in.end();
+  check_only();
+}
+
+std::unique_ptr<CorrectionSet> CorrectionSet::from_file(const std::string& fn, const LoadOptions& options) {
+  if ( options.lazy ) {
+    auto file = std::make_shared<MappedFile>(fn);
+    if ( detect_compression(file->data(), file->size()) != Compression::none ) {
+      return from_buffer(file->data(), file->size(), options);
+    }
+    // the corrections are later built from the mapping
+    return std::unique_ptr<CorrectionSet>(new CorrectionSet(file, file->view(), options));
+  }
+  MappedFile file(fn);
+  if ( ! options.cache_dir.empty() && ! options.only ) {
+    const std::string cached = cache_file(file.view(), options);
+    try {
+      const MappedFile binary(cached);
+      return from_binary(binary.data(), binary.size(), options);
+    }
+    catch (const std::exception&) {
+      // missing, from an incompatible version, or damaged: replaced below
+    }
+    auto cset = from_buffer(file.data(), file.size(), options);
+    write_cache_file(cached, cset->to_binary());
+    return cset;
+  }
+  if ( options.threads == 1 || detect_compression(file.data(), file.size()) != Compression::none ) {
+    // read from the mapping as it is parsed
+    return from_buffer(file.data(), file.size(), options);
+  }
+  rapidjson::Document json;
+  rapidjson::ParseResult ok;
+  // parsing in place modifies the text, so is only done on a private copy,
+  // as writing to a mapping would copy every page anyway
+  if ( auto contents = file.contents() ) {
+    ok = json.ParseInsitu(contents->data());
+  }
+  else {
+    ok = json.Parse(file.data(), file.size());
+  }
+  if (!ok) {
+    throw json_parse_error(ok);
+  }
+  return std::make_unique<CorrectionSet>(json, options);
+}
+
+std::unique_ptr<CorrectionSet> CorrectionSet::from_string(const char * data, const LoadOptions& options) {
+  return from_buffer(data, std::strlen(data), options);
+}
+
+std::unique_ptr<CorrectionSet> CorrectionSet::from_buffer(const char * data, size_t size, const LoadOptions& options) {
+  const Compression compression = detect_compression(data, size);
+  if ( options.lazy ) {
+    auto document = std::make_shared<const std::string>(
+        compression == Compression::none ? std::string(data, size) : decompress(compression, data, size)
+        );
+    return std::unique_ptr<CorrectionSet>(new CorrectionSet(document, *document, options));
+  }
+  if ( options.threads == 1 ) {
+    // built while it is parsed, so that the document is never held whole
+    try {
+      auto decompressor = ( compression != Compression::none ) ? make_decompressor(compression, data, size) : nullptr;
+      auto stream = decompressor ? std::make_unique<JsonStream>(*decompressor) : std::make_unique<JsonStream>(data, size);
+      _JsonReader in(*stream);
+      return std::unique_ptr<CorrectionSet>(new CorrectionSet(in, options));
+    }
+    catch (const _JsonReader::Unstreamable&) {
+      // laid out otherwise than correctionlib writes it: parsed whole below
+    }
+  }
+  rapidjson::Document json;
+  rapidjson::ParseResult ok;
+  if ( compression != Compression::none ) {
+    auto decompressor = make_decompressor(compression, data, size);
+    JsonStream stream(*decompressor);
+    ok = json.ParseStream(stream);
+  }
+  else {
+    ok = json.Parse(data, size);
+  }
+  if (!ok) {
+    throw json_parse_error(ok);
+  }
+  return std::make_unique<CorrectionSet>(json, options);
+}
+
+double correction::parse_number(const std::string& text) {
+  rapidjson::Document json;
+  rapidjson::ParseResult ok = json.Parse(text.data(), text.size());
+  if (!ok) {
+    throw json_parse_error(ok);
+  }
+  if ( ! json.IsNumber() ) {
+    throw std::runtime_error("Not a JSON number: " + text);
+  }
+  return json.GetDouble();
+}
+
+std::unique_ptr<CorrectionSet> CorrectionSet::from_binary(const char * data, size_t size, const LoadOptions& options) {
+  _BinaryReader in(data, size);
+  return std::unique_ptr<CorrectionSet>(new CorrectionSet(in, options));
+}
+
+std::string CorrectionSet::to_binary() const {
+  _BinaryWriter out;
+  out.buffer().append(binary_magic, sizeof(binary_magic));
+  out.value<uint32_t>(binary_version);
+  out.value<uint32_t>(byte_order_mark);
+  out.value<int32_t>(schema_version_);
+  out.value<uint8_t>(options_.fast_math);
+  out.size(corrections_.size());
+  for (const auto& [name, corr] : corrections_) {
+    at(name)->write(out);
+  }
+  return std::move(out.buffer());
+}
+
+CorrectionSet::CorrectionSet(_BinaryReader& in, const LoadOptions& options) :
+  options_(with_array_pool(options))
+{
+  char magic[sizeof(binary_magic)];
+  in.read(magic, sizeof(magic));
+  if ( std::memcmp(magic, binary_magic, sizeof(magic)) != 0 ) {
+    throw std::runtime_error("Not binary CorrectionSet data");
+  }
+  if ( in.value<uint32_t>() != binary_version ) {
+    throw std::runtime_error("Binary CorrectionSet data is not of version " + std::to_string(binary_version));
+  }
+  if ( in.value<uint32_t>() != byte_order_mark ) {
+    throw std::runtime_error("Binary CorrectionSet data was written on a machine of different byte order");
+  }
+  schema_version_ = check_schema_version(in.value<int32_t>());
+  options_.fast_math = in.value<uint8_t>();
+  if ( ! options.compiled.empty() ) {
+    library_ = std::make_shared<const CompiledLibrary>(options.compiled);
+  }
+  const size_t n = in.count();
+  for (size_t i=0; i < n; ++i) {
+    auto corr = std::make_shared<Correction>(in, options_);
+    if ( library_ ) corr->use_compiled(library_);
+    corrections_[corr->name()] = corr;
+  }
+  _BinaryReader::check(in.done());
+  check_only();
+}
+
+CorrectionSet::CorrectionSet(const rapidjson::Value& json, const LoadOptions& options) :
+  options_(with_array_pool(options))
+{
+  schema_version_ = check_schema_version(getOptional<int>(json, "schema_version"));
+  if ( ! options.compiled.empty() ) {
+    library_ = std::make_shared<const CompiledLibrary>(options.compiled);
+  }
+  if ( const auto& items = getOptional<rapidjson::Value::ConstArray>(json, "corrections") ) {
+    // corrections are independent, so they can be built concurrently
+    std::vector<std::shared_ptr<Correction>> corrections(items->Size());
+    ThreadPool::instance().run(corrections.size(), options.threads, [&](size_t i) {
+      corrections[i] = std::make_shared<Correction>((*items)[i], options_);
+      if ( library_ ) corrections[i]->use_compiled(library_);
+    });
+    for (const auto& corr : corrections) {
+      corrections_[corr->name()] = corr;
+    }
+  }
+  else { throw std::runtime_error("Missing corrections array in CorrectionSet document"); }
+  check_only();
+}
+
+CorrectionSet::CorrectionSet(std::shared_ptr<const void> owner, std::string_view document, const LoadOptions& options) :
+  options_(with_array_pool(options)),
+  document_owner_(std::move(owner)),
+  document_(document)
+{
+  rapidjson::MemoryStream stream(document_.data(), document_.size());
+  DocumentScanner scanner(stream);
+  rapidjson::Reader reader;
+  rapidjson::ParseResult ok = reader.Parse(stream, scanner);
+  if (!ok) {
+    throw json_parse_error(ok);
+  }
+  schema_version_ = check_schema_version(scanner.schema_version);
+  if ( ! scanner.has_corrections ) {
+    throw std::runtime_error("Missing corrections array in CorrectionSet document");
+  }
+  if ( ! options.compiled.empty() ) {
+    library_ = std::make_shared<const CompiledLibrary>(options.compiled);
+  }
+  for (const auto& [name, source] : scanner.corrections) {
+    unbuilt_[name] = source;
+    corrections_[name] = nullptr;
+  }
+  check_only();
+}
+
+void CorrectionSet::check_only() const {
+  if ( ! options_.only ) return;
+  for (const auto& name : *options_.only) {
+    if ( corrections_.count(name) == 0 ) {
+      throw std::runtime_error("Correction " + name + " to load (see only) is not in the CorrectionSet");
+    }
+  }
+}
+
+CorrectionPtr CorrectionSet::at(const std::string& key) const {
+  const std::lock_guard<std::mutex> lock(m_);
+  auto& corr = corrections_.at(key);
+  if ( ! corr ) {
+    const auto source = unbuilt_.at(key);
+    rapidjson::Document json;
+    rapidjson::ParseResult ok = json.Parse(source.data(), source.size());
+    if (!ok) {
+      throw json_parse_error(ok, source.data() - document_.data());
+    }
+    auto built = std::make_shared<Correction>(json, options_);
+    if ( library_ ) built->use_compiled(library_);
+    corr = built;
+    unbuilt_.erase(key);
+    if ( unbuilt_.empty() ) {
+      document_owner_.reset();
+      document_ = {};
+    }
+  }
+  return corr;
+}
+
+size_t CorrectionSet::dedup_savings() const {
+  const std::lock_guard<std::mutex> lock(m_);
+  size_t saved = options_._arrays ? options_._arrays->saved() : 0;
+  for (const auto& [name, corr] : corrections_) {
+    if ( corr ) saved += corr->dedup_savings();
+  }
+  return saved;
 }
 
 bool CorrectionSet::validate() {
@@ -0,0 +1,432 @@
+"""Compile corrections ahead of time
+
+The corrections of a CorrectionSet document are translated into C++ source,
+where bin edges and content become static arrays, categories become switch
+statements and formulas become inline expressions, and built with the system
+C++ compiler (``$CXX``, or ``c++``) into a shared library. Libraries are cached
+on disk by the hash of their source, so each document is only built once.
+
+Example::
+
+    cset = codegen.load("corrections.json")
+    sf = cset["muon_sf"].evaluate(eta, pt)
+
+The compiled corrections are evaluated through the usual ``Correction`` objects,
+and give the same results as the interpreted ones.
+"""
+import hashlib
+import json
+import math
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import _core
+
+# must match correction::CompiledLibrary::abi_version
+ABI_VERSION = 2
+
+_PREAMBLE = """\
+// Generated by correctionlib.codegen
+#include <algorithm>
+#include <cmath>
+#include <cstddef>
+#include <cstdint>
+#include <limits>
+#include <stdexcept>
+#include <string>
+
+#if defined(_WIN32)
+#define CORRECTIONLIB_EXPORT extern "C" __declspec(dllexport)
+#else
+#define CORRECTIONLIB_EXPORT extern "C" __attribute__((visibility("default")))
+#endif
+
+// layout of correction::CompiledStringId and correction::CompiledCorrection
+struct correctionlib_string_id {
+  size_t input;
+  const char* value;
+  int id;
+};
+
+struct correctionlib_correction {
+  const char* name;
+  size_t ninputs;
+  const correctionlib_string_id* string_ids;
+  size_t nstring_ids;
+  uint64_t definition_hash;
+  double (*evaluate)(const double* x);
+};
+
+namespace {
+  // as correction::_BinEdges::find
+  template<size_t N>
+  size_t find_bin(const double (&edges)[N], double value) {
+    return std::upper_bound(edges, edges + N, value) - edges;
+  }
+
+  size_t find_uniform_bin(size_t n, double low, double high, double value) {
+    if ( value < low ) return 0;
+    if ( ! (value < high) ) return n + 1;
+    return std::min((size_t) ((value - low) * (n / (high - low))), n - 1) + 1;
+  }
+}
+"""
+
+
+def _literal(value: float) -> str:
+    value = float(value)
+    if math.isnan(value):
+        return "std::numeric_limits<double>::quiet_NaN()"
+    if math.isinf(value):
+        inf = "std::numeric_limits<double>::infinity()"
+        return inf if value > 0 else f"(-{inf})"
+    # hexadecimal, so that the value is exact
+    if math.copysign(1.0, value) < 0:
+        return f"({value.hex()})"
+    return value.hex()
+
+
+def _cstring(value: str) -> str:
+    out = []
+    for byte in value.encode("utf-8"):
+        char = chr(byte)
+        if char in '"\\?' or not (32 <= byte < 127):
+            out.append(f"\\{byte:03o}")
+        else:
+            out.append(char)
+    return '"' + "".join(out) + '"'
+
+
+class _CorrectionGenerator:
+    """Generates the functions evaluating one correction"""
+
+    def __init__(self, data: Dict[str, Any], evaluator: _core.Correction, prefix: str):
+        self.inputs = [var["name"] for var in data["inputs"]]
+        self.types = [var["type"] for var in data["inputs"]]
+        self.generic_formulas = data.get("generic_formulas") or []
+        self.evaluator = evaluator
+        self.prefix = prefix
+        self.functions: List[str] = []
+        self.string_ids: Dict[Tuple[int, str], int] = {}
+        self.entry = self.function(data["data"])
+
+    def input_index(self, name: str) -> int:
+        return self.inputs.index(name)
+
+    def function(self, node: Any) -> str:
+        """Emit a function evaluating node, and return its name"""
+        index = len(self.functions)
+        name = f"{self.prefix}node{index}"
+        # children are appended after their parent, so the functions are
+        # written out in reverse order
+        self.functions.append("")
+        body = self.body(node)
+        self.functions[index] = f"double {name}(const double* x) {{\n{body}}}\n"
+        return name
+
+    def expression(self, node: Any) -> str:
+        """A C++ expression of x evaluating node"""
+        if isinstance(node, (int, float)):
+            return _literal(node)
+        elif node["nodetype"] == "formula":
+            return self.formula(
+                node["expression"],
+                node["parser"],
+                node["variables"],
+                node.get("parameters") or [],
+            )
+        elif node["nodetype"] == "formularef":
+            generic = self.generic_formulas[node["index"]]
+            return self.formula(
+                generic["expression"],
+                generic["parser"],
+                generic["variables"],
+                node["parameters"],
+            )
+        return f"{self.function(node)}(x)"
+
+    def formula(
+        self,
+        expression: str,
+        parser: str,
+        variables: List[str],
+        parameters: List[float],
+    ) -> str:
+        if parser != "TFormula":
+            raise ValueError(f"Unsupported formula parser {parser}")
+        for name in variables:
+            if self.types[self.input_index(name)] != "real":
+                raise ValueError(f"Formula variable {name} is not a real input")
+        indices = [self.input_index(name) for name in variables]
+        return _core.formula_source(expression, indices, parameters)
+
+    def body(self, node: Any) -> str:
+        if isinstance(node, (int, float)) or node["nodetype"] in (
+            "formula",
+            "formularef",
+        ):
+            return f"  return {self.expression(node)};\n"
+        elif node["nodetype"] == "binning":
+            return self.binning(node)
+        elif node["nodetype"] == "multibinning":
+            return self.multibinning(node)
+        elif node["nodetype"] == "category":
+            return self.category(node)
+        elif node["nodetype"] == "transform":
+            return self.transform(node)
+        raise ValueError(f"Unrecognized Content node type {node['nodetype']}")
+
+    def find_bin(self, edges: Any, value: str, name: str) -> Tuple[str, int]:
+        """Statements finding the bin of value along edges as in _BinEdges::find"""
+        if isinstance(edges, dict):
+            n = edges["n"]
+            find = (
+                f"find_uniform_bin({n}, {_literal(edges['low'])}, "
+                f"{_literal(edges['high'])}, {value})"
+            )
+            return f"  size_t {name} = {find};\n", n
+        array = ", ".join(_literal(edge) for edge in edges)
+        return (
+            f"  static const double {name}_edges[] = {{{array}}};\n"
+            f"  size_t {name} = find_bin({name}_edges, {value});\n",
+            len(edges) - 1,
+        )
+
+    def flow(
+        self, flow: Any, bound: str, name: str, n: int, value: str, message: str
+    ) -> str:
+        """Statement for a value out of bounds, bin name of n being 0 or n + 1
+
+        message is the error of the interpreter, up to the value
+        """
+        if flow == "clamp":
+            return f"{name} = {1 if bound == 'below' else n};"
+        elif flow == "error":
+            return f'throw std::runtime_error("{message}" + std::to_string({value}));'
+        return f"return {self.expression(flow)};"
+
+    def content(self, content: List[Any], index: str) -> str:
+        """Statements returning the content at index"""
+        if all(isinstance(item, (int, float)) for item in content):
+            array = ", ".join(_literal(item) for item in content)
+            return (
+                f"  static const double content[] = {{{array}}};\n"
+                f"  return content[{index}];\n"
+            )
+        lines = [f"  switch ( {index} ) {{\n"]
+        for i, item in enumerate(content[:-1]):
+            lines.append(f"    case {i}: return {self.expression(item)};\n")
+        lines.append(f"    default: return {self.expression(content[-1])};\n")
+        lines.append("  }\n")
+        return "".join(lines)
+
+    def binning(self, node: Dict[str, Any]) -> str:
+        idx = self.input_index(node["input"])
+        value = f"x[{idx}]"
+        find, n = self.find_bin(node["edges"], value, "bin")
+        below = self.flow(
+            node["flow"],
+            "below",
+            "bin",
+            n,
+            value,
+            f"Index below bounds in Binning for input {idx} value: ",
+        )
+        above = self.flow(
+            node["flow"],
+            "above",
+            "bin",
+            n,
+            value,
+            f"Index above bounds in Binning for input {idx} value: ",
+        )
+        return (
+            find
+            + f"  if ( bin == 0 ) {{ {below} }}\n"
+            + f"  else if ( bin == {n + 1} ) {{ {above} }}\n"
+            + self.content(node["content"], "bin - 1")
+        )
+
+    def multibinning(self, node: Dict[str, Any]) -> str:
+        lines = ["  size_t index = 0;\n"]
+        dimensions = []
+        for input, edges in zip(node["inputs"], node["edges"]):
+            idx = self.input_index(input)
+            dimensions.append((idx, edges))
+        stride = 1
+        strides = []
+        for _, edges in reversed(dimensions):
+            strides.insert(0, stride)
+            stride *= edges["n"] if isinstance(edges, dict) else len(edges) - 1
+        for axis, ((idx, edges), stride) in enumerate(zip(dimensions, strides)):
+            value = f"x[{idx}]"
+            name = f"bin{axis}"
+            find, n = self.find_bin(edges, value, name)
+            below = self.flow(
+                node["flow"],
+                "below",
+                name,
+                n,
+                value,
+                f"Index below bounds in MultiBinning for input {idx} val: ",
+            )
+            above = self.flow(
+                node["flow"],
+                "above",
+                name,
+                n,
+                value,
+                f"Index above bounds in MultiBinning input {idx} val: ",
+            )
+            lines.append(find)
+            lines.append(f"  if ( {name} == 0 ) {{ {below} }}\n")
+            lines.append(f"  else if ( {name} == {n + 1} ) {{ {above} }}\n")
+            lines.append(f"  index += ({name} - 1) * {stride};\n")
+        return "".join(lines) + self.content(node["content"], "index")
+
+    def category(self, node: Dict[str, Any]) -> str:
+        idx = self.input_index(node["input"])
+        # the first of duplicate keys wins, as in the evaluator
+        cases: Dict[int, Any] = {}
+        for item in node["content"]:
+            key = item["key"]
+            if isinstance(key, str):
+                string_id = self.evaluator.string_id(node["input"], key).id
+                self.string_ids[(idx, key)] = string_id
+                key = string_id
+            cases.setdefault(key, item["value"])
+        lines = [f"  const int key = (int) x[{idx}];\n", "  switch ( key ) {\n"]
+        for key, value in cases.items():
+            lines.append(f"    case {key}: return {self.expression(value)};\n")
+        if node.get("default") is not None:
+            lines.append(f"    default: return {self.expression(node['default'])};\n")
+        lines.append("  }\n")
+        if node.get("default") is None:
+            lines.append(
+                '  throw std::out_of_range("Index not available in Category '
+                f'for index {idx} val: " + std::to_string(key));\n'
+            )
+        return "".join(lines)
+
+    def transform(self, node: Dict[str, Any]) -> str:
+        idx = self.input_index(node["input"])
+        if self.types[idx] == "string":
+            raise ValueError("Transform cannot rewrite string inputs")
+        rule = self.expression(node["rule"])
+        if self.types[idx] == "int":
+            rule = f"(double) (int) std::round({rule})"
+        content = self.function(node["content"])
+        ninputs = len(self.inputs)
+        return (
+            f"  double y[{ninputs}];\n"
+            f"  std::copy(x, x + {ninputs}, y);\n"
+            f"  y[{idx}] = {rule};\n"
+            f"  return {content}(y);\n"
+        )
+
+
+def generate(data: str) -> str:
+    """Generate the C++ source of a shared library evaluating a CorrectionSet
+
+    data is the JSON document of the CorrectionSet
+    """
+    # numbers as the evaluator parses them, which are not always correctly
+    # rounded, so that the constants are the same
+    document = json.loads(data, parse_float=_core.parse_number)
+    evaluator = _core.CorrectionSet.from_string(data)
+    parts = [_PREAMBLE, "\nnamespace {\n"]
+    entries = []
+    for i, correction in enumerate(document["corrections"]):
+        loaded = evaluator[correction["name"]]
+        generator = _CorrectionGenerator(correction, loaded, f"c{i}_")
+        parts.extend(reversed(generator.functions))
+        string_ids = "nullptr"
+        if generator.string_ids:
+            items = ", ".join(
+                f"{{{input}, {_cstring(value)}, {string_id}}}"
+                for (input, value), string_id in generator.string_ids.items()
+            )
+            parts.append(
+                f"const correctionlib_string_id c{i}_string_ids[] = {{{items}}};\n"
+            )
+            string_ids = f"c{i}_string_ids"
+        entries.append(
+            f"  {{{_cstring(correction['name'])}, {len(generator.inputs)}, "
+            f"{string_ids}, {len(generator.string_ids)}, "
+            f"{loaded.definition_hash:#x}u, {generator.entry}}},\n"
+        )
+    parts.append("}\n\n")
+    parts.append(
+        f"CORRECTIONLIB_EXPORT const int correctionlib_abi_version = {ABI_VERSION};\n"
+    )
+    parts.append(
+        f"CORRECTIONLIB_EXPORT const size_t correctionlib_ncorrections = {len(entries)};\n"
+    )
+    parts.append(
+        "CORRECTIONLIB_EXPORT const correctionlib_correction correctionlib_corrections[] = {\n"
+    )
+    parts.extend(entries)
+    parts.append("};\n")
+    return "".join(parts)
+
+
+def _cache_dir() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "correctionlib")
+
+
+def build(data: str, cache_dir: Optional[str] = None) -> str:
+    """Compile a CorrectionSet into a shared library, and return its path
+
+    data is the JSON document of the CorrectionSet. The library is cached in
+    cache_dir (by default ``$XDG_CACHE_HOME/correctionlib``), under the hash
+    of its source and the compiler command, and only built if not found there.
+    """
+    source = generate(data)
+    # no contraction into fused multiply-adds, to match the evaluator
+    command = shlex.split(os.environ.get("CXX", "c++")) + [
+        "-std=c++17",
+        "-O2",
+        "-shared",
+        "-fPIC",
+        "-ffp-contract=off",
+    ]
+    key = hashlib.sha256("\0".join(command + [source]).encode("utf-8")).hexdigest()
+    cache_dir = cache_dir or _cache_dir()
+    suffix = ".dll" if sys.platform.startswith("win32") else ".so"
+    path = os.path.join(cache_dir, key + suffix)
+    if os.path.exists(path):
+        return path
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=cache_dir) as tmpdir:
+        src = os.path.join(tmpdir, "corrections.cc")
+        with open(src, "w") as fout:
+            fout.write(source)
+        lib = os.path.join(tmpdir, "corrections" + suffix)
+        result = subprocess.run(
+            command + [src, "-o", lib],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Compilation of corrections failed:\n{result.stdout}")
+        # atomic, in case another process builds the same library concurrently
+        os.replace(lib, path)
+    return path
+
+
+def load(filename: str, cache_dir: Optional[str] = None) -> _core.CorrectionSet:
+    """Load a CorrectionSet from a JSON file, evaluated by compiled code
+
+    See build for cache_dir
+    """
+    with open(filename) as fin:
+        data = fin.read()
+    return _core.CorrectionSet.from_string(data, compiled=build(data, cache_dir))
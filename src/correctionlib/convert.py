@@ -2,10 +2,19 @@
 
 Mostly TODO right now
 """
+import math
 from numbers import Real
-from typing import TYPE_CHECKING, Any, Iterable, List, Sequence
-
-from .schemav2 import Binning, Category, Content, Correction, MultiBinning, Variable
+from typing import TYPE_CHECKING, Any, Iterable, List, Sequence, Union
+
+from .schemav2 import (
+    Binning,
+    Category,
+    Content,
+    Correction,
+    MultiBinning,
+    UniformBinning,
+    Variable,
+)
 
 if TYPE_CHECKING:
     from numpy import ndarray
@@ -30,11 +39,14 @@ def from_uproot_THx(path: str) -> Correction:
     return from_histogram(uproot.open(path))
 
 
-def from_histogram(hist: "PlottableHistogram") -> Correction:
+def from_histogram(hist: "PlottableHistogram", uniform: bool = False) -> Correction:
     """Read any object with PlottableHistogram interface protocol
 
     Interface as defined in
     https://github.com/scikit-hep/uhi/blob/v0.1.1/src/uhi/typing/plottable.py
+
+    If uniform is set, the edges of axes with equal-width bins are written
+    as a UniformBinning rather than listed.
     """
 
     def read_axis(axis: "PlottableAxis", pos: int) -> Variable:
@@ -56,13 +68,19 @@ def from_histogram(hist: "PlottableHistogram") -> Correction:
     variables = [read_axis(ax, i) for i, ax in enumerate(hist.axes)]
     # Here we could try to optimize the ordering
 
-    def edges(axis: "PlottableAxis") -> List[float]:
+    def edges(axis: "PlottableAxis") -> Union[List[float], UniformBinning]:
         out = []
         for i, b in enumerate(axis):
             assert isinstance(b, tuple)
             out.append(b[0])
             if i == len(axis) - 1:
                 out.append(b[1])
+        n, low, high = len(out) - 1, out[0], out[-1]
+        if uniform and all(
+            math.isclose(edge, low + i * (high - low) / n, rel_tol=1e-12)
+            for i, edge in enumerate(out)
+        ):
+            return UniformBinning(n=n, low=low, high=high)
         return out
 
     def flatten_to(values: "ndarray", depth: int) -> Iterable[Any]:
@@ -66,7 +66,7 @@ class Transform(Model):
     Any downstream nodes will see a different value for the rewritten input
     If the input is an integer type, the rule output will be cast from a
     double to integer type before using. These should be used sparingly and at
-    high levels in the tree, since they require an allocation.
+    high levels in the tree, since they require a copy of the inputs.
     """
 
     nodetype: Literal["transform"]
@@ -77,6 +77,28 @@ class Transform(Model):
     )
 
 
+class UniformBinning(Model):
+    """Uniform binning description, to be used as replacement for a list of edges"""
+
+    n: int = Field(description="Number of bins", ge=1)
+    low: float = Field(description="Lower edge of the first bin")
+    high: float = Field(description="Upper edge of the last bin")
+
+    @validator("high")
+    def validate_high(cls, high: float, values: Any) -> float:
+        if "low" in values and high <= values["low"]:
+            raise ValueError(
+                f"Higher binning edge must be larger than lower binning edge, got {values['low']} and {high}"
+            )
+        return high
+
+
+def _nbins(edges: Union[List[float], UniformBinning]) -> int:
+    if isinstance(edges, UniformBinning):
+        return edges.n
+    return len(edges) - 1
+
+
 class Binning(Model):
     """1-dimensional binning in an input variable"""
 
@@ -84,7 +106,7 @@ class Binning(Model):
     input: str = Field(
         description="The name of the correction input variable this binning applies to"
     )
-    edges: List[float] = Field(
+    edges: Union[List[float], UniformBinning] = Field(
         description="Edges of the binning, where edges[i] <= x < edges[i+1] => f(x, ...) = content[i](...)"
     )
     content: List[Content]
@@ -93,16 +115,19 @@ class Binning(Model):
     )
 
     @validator("edges")
-    def validate_edges(cls, edges: List[float], values: Any) -> List[float]:
-        for lo, hi in zip(edges[:-1], edges[1:]):
-            if hi <= lo:
-                raise ValueError(f"Binning edges not monotone increasing: {edges}")
+    def validate_edges(
+        cls, edges: Union[List[float], UniformBinning], values: Any
+    ) -> Union[List[float], UniformBinning]:
+        if isinstance(edges, list):
+            for lo, hi in zip(edges[:-1], edges[1:]):
+                if hi <= lo:
+                    raise ValueError(f"Binning edges not monotone increasing: {edges}")
         return edges
 
     @validator("content")
     def validate_content(cls, content: List[Content], values: Any) -> List[Content]:
         if "edges" in values:
-            nbins = len(values["edges"]) - 1
+            nbins = _nbins(values["edges"])
             if nbins != len(content):
                 raise ValueError(
                     f"Binning content length ({len(content)}) is not one larger than edges ({nbins + 1})"
@@ -118,11 +143,14 @@ class MultiBinning(Model):
         description="The names of the correction input variables this binning applies to",
         min_items=1,
     )
-    edges: List[List[float]] = Field(description="Bin edges for each input")
+    edges: List[Union[List[float], UniformBinning]] = Field(
+        description="Bin edges for each input"
+    )
     content: List[Content] = Field(
         description="""Bin contents as a flattened array
         This is a C-ordered array, i.e. content[d1*d2*d3*i0 + d2*d3*i1 + d3*i2 + i3] corresponds
-        to the element at i0 in dimension 0, i1 in dimension 1, etc. and d0 = len(edges[0]), etc.
+        to the element at i0 in dimension 0, i1 in dimension 1, etc. and d0 is the number of bins
+        of dimension 0 (len(edges[0]) - 1, or edges[0].n for a UniformBinning), etc.
     """
     )
     flow: Union[Content, Literal["clamp", "error"]] = Field(
@@ -130,8 +158,12 @@ class MultiBinning(Model):
     )
 
     @validator("edges")
-    def validate_edges(cls, edges: List[List[float]], values: Any) -> List[List[float]]:
+    def validate_edges(
+        cls, edges: List[Union[List[float], UniformBinning]], values: Any
+    ) -> List[Union[List[float], UniformBinning]]:
         for i, dim in enumerate(edges):
+            if isinstance(dim, UniformBinning):
+                continue
             for lo, hi in zip(dim[:-1], dim[1:]):
                 if hi <= lo:
                     raise ValueError(
@@ -144,7 +176,7 @@ class MultiBinning(Model):
         if "edges" in values:
             nbins = 1
             for dim in values["edges"]:
-                nbins *= len(dim) - 1
+                nbins *= _nbins(dim)
             if nbins != len(content):
                 raise ValueError(
                     f"MultiBinning content length ({len(content)}) does not match the product of dimension sizes ({nbins})"
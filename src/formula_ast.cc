@@ -1,19 +1,61 @@
 #include <mutex>
 #include <cmath>
+#include <cstring>
+#include <cstdio>
+#include <charconv>
+#include <optional>
+#include <sstream>
 #include "peglib.h"
 #include "correction.h"
 
 using namespace correction;
 
 namespace {
+  std::runtime_error parse_error(const std::string_view expression, size_t pos, const std::string& msg) {
+    return std::runtime_error(
+      "Failed to parse Formula expression at position " + std::to_string(pos) + ":\n"
+      + std::string(expression) + "\n"
+      + std::string(pos, ' ') + "^\n"
+      + msg
+    );
+  }
+
+  const std::unordered_map<std::string_view, FormulaAst::UnaryFcn> unary_functions {
+    {"log", FormulaAst::UnaryFcn::Log},
+    {"log10", FormulaAst::UnaryFcn::Log10},
+    {"exp", FormulaAst::UnaryFcn::Exp},
+    {"erf", FormulaAst::UnaryFcn::Erf},
+    {"sqrt", FormulaAst::UnaryFcn::Sqrt},
+    {"abs", FormulaAst::UnaryFcn::Abs},
+    {"cos", FormulaAst::UnaryFcn::Cos},
+    {"sin", FormulaAst::UnaryFcn::Sin},
+    {"tan", FormulaAst::UnaryFcn::Tan},
+    {"acos", FormulaAst::UnaryFcn::Acos},
+    {"asin", FormulaAst::UnaryFcn::Asin},
+    {"atan", FormulaAst::UnaryFcn::Atan},
+    {"cosh", FormulaAst::UnaryFcn::Cosh},
+    {"sinh", FormulaAst::UnaryFcn::Sinh},
+    {"tanh", FormulaAst::UnaryFcn::Tanh},
+    {"acosh", FormulaAst::UnaryFcn::Acosh},
+    {"asinh", FormulaAst::UnaryFcn::Asinh},
+    {"atanh", FormulaAst::UnaryFcn::Atanh},
+  };
+
+  const std::unordered_map<std::string_view, FormulaAst::BinaryFcn> binary_functions {
+    {"atan2", FormulaAst::BinaryFcn::Atan2},
+    {"pow", FormulaAst::BinaryFcn::Pow},
+    {"max", FormulaAst::BinaryFcn::Max},
+    {"min", FormulaAst::BinaryFcn::Min},
+  };
+
   class PEGParser {
     public:
-      // We are not sure if peglib is threadsafe, so the policy is to lock this
-      // parser mutex until we are done with the peg::Ast object
-      std::mutex m;
       typedef std::shared_ptr<peg::Ast> AstPtr;
 
       PEGParser(const char * grammar) {
+        // peglib reads all grammars with one shared generator
+        static std::mutex load_mutex;
+        const std::lock_guard<std::mutex> lock(load_mutex);
         parser_.load_grammar(grammar);
         parser_.enable_ast();
         parser_.enable_packrat_parsing();
@@ -27,12 +69,7 @@ namespace {
           msg = themsg;
         };
         if ( ! parser_.parse(expression, peg_ast) ) {
-          throw std::runtime_error(
-            "Failed to parse Formula expression at position " + std::to_string(pos) + ":\n"
-            + std::string(expression) + "\n"
-            + std::string(pos, ' ') + "^\n"
-            + msg
-          );
+          throw parse_error(expression, pos, msg);
         }
         peg_ast = parser_.optimize_ast(peg_ast);
         return peg_ast;
@@ -42,7 +79,7 @@ namespace {
       peg::parser parser_;
   };
 
-  PEGParser tformula_parser(R"(
+  const char * tformula_grammar = R"(
   EXPRESSION  <- ATOM (BINARYOP ATOM)* {
                   precedence
                     L == !=
@@ -64,18 +101,17 @@ namespace {
   UATOM       <- UNARYOP? ( CALLU / CALLB / NAME / '(' EXPRESSION ')' )
   NAME        <- PARAMETER / VARIABLE
   %whitespace <- [ \t]*
-  )");
+  )";
 
-  struct TranslationContext {
-      const std::vector<double>& params;
-      const std::vector<size_t>& variableIdx;
-      bool bind_parameters;
-  };
+  // One parser per thread, so that formulas can be parsed concurrently
+  PEGParser& tformula_parser() {
+    thread_local PEGParser parser(tformula_grammar);
+    return parser;
+  }
 
-  FormulaAst translate_tformula_ast(
-      const PEGParser::AstPtr ast,
-      const TranslationContext& context
-      ) {
+  // Translates the peglib AST into a FormulaAst where variables hold their
+  // position in the formula (0 for x, ..., 3 for t) and parameters are unbound
+  FormulaAst translate_tformula_ast(const PEGParser::AstPtr ast) {
     if (ast->is_token) {
       if (ast->name == "LITERAL") {
         return {FormulaAst::NodeType::Literal, ast->token_to_number<double>(), {}};
@@ -89,22 +125,10 @@ namespace {
         else {
           throw std::runtime_error("Unrecognized variable name in formula");
         }
-        if ( context.variableIdx.size() <= idx ) {
-          throw std::runtime_error("Insufficient variables for formula");
-        }
-        return {FormulaAst::NodeType::Variable, context.variableIdx[idx], {}};
+        return {FormulaAst::NodeType::Variable, idx, {}};
       }
       else if (ast->name == "PARAMETER") {
-        auto pidx = ast->token_to_number<size_t>();
-        if ( context.bind_parameters ) {
-          if ( pidx >= context.params.size() ) {
-            throw std::runtime_error("Insufficient parameters for formula");
-          }
-          return {FormulaAst::NodeType::Literal, context.params[pidx], {}};
-        }
-        else {
-          return {FormulaAst::NodeType::Parameter, pidx, {}};
-        }
+        return {FormulaAst::NodeType::Parameter, ast->token_to_number<size_t>(), {}};
       }
     }
     else if (ast->name == "UATOM" ) {
@@ -116,57 +140,31 @@ namespace {
       return {
         FormulaAst::NodeType::UAtom,
         op,
-        {translate_tformula_ast(ast->nodes[1], context)}
+        {translate_tformula_ast(ast->nodes[1])}
       };
     }
     else if (ast->name == "CALLU" ) {
       if ( ast->nodes.size() != 2 ) { throw std::runtime_error("CALLU without 2 nodes?"); }
-      FormulaAst::UnaryFcn fun;
-      auto name = ast->nodes[0]->token;
-      // TODO: lookup in static map
-      if      ( name == "log" )   { fun = [](double x) { return std::log(x); }; }
-      else if ( name == "log10" ) { fun = [](double x) { return std::log10(x); }; }
-      else if ( name == "exp" )   { fun = [](double x) { return std::exp(x); }; }
-      else if ( name == "erf" )   { fun = [](double x) { return std::erf(x); }; }
-      else if ( name == "sqrt" )  { fun = [](double x) { return std::sqrt(x); }; }
-      else if ( name == "abs" )   { fun = [](double x) { return std::abs(x); }; }
-      else if ( name == "cos" )   { fun = [](double x) { return std::cos(x); }; }
-      else if ( name == "sin" )   { fun = [](double x) { return std::sin(x); }; }
-      else if ( name == "tan" )   { fun = [](double x) { return std::tan(x); }; }
-      else if ( name == "acos" )  { fun = [](double x) { return std::acos(x); }; }
-      else if ( name == "asin" )  { fun = [](double x) { return std::asin(x); }; }
-      else if ( name == "atan" )  { fun = [](double x) { return std::atan(x); }; }
-      else if ( name == "cosh" )  { fun = [](double x) { return std::cosh(x); }; }
-      else if ( name == "sinh" )  { fun = [](double x) { return std::sinh(x); }; }
-      else if ( name == "tanh" )  { fun = [](double x) { return std::tanh(x); }; }
-      else if ( name == "acosh" ) { fun = [](double x) { return std::acosh(x); }; }
-      else if ( name == "asinh" ) { fun = [](double x) { return std::asinh(x); }; }
-      else if ( name == "atanh" ) { fun = [](double x) { return std::atanh(x); }; }
-      else {
-        throw std::runtime_error("unrecognized unary function: " + std::string(name));
+      const auto fun = unary_functions.find(ast->nodes[0]->token);
+      if ( fun == unary_functions.end() ) {
+        throw std::runtime_error("unrecognized unary function: " + std::string(ast->nodes[0]->token));
       }
       return {
         FormulaAst::NodeType::UnaryCall,
-        fun,
-        {translate_tformula_ast(ast->nodes[1], context)}
+        fun->second,
+        {translate_tformula_ast(ast->nodes[1])}
       };
     }
     else if (ast->name == "CALLB" ) {
       if ( ast->nodes.size() != 3 ) { throw std::runtime_error("CALLB without 3 nodes?"); }
-      FormulaAst::BinaryFcn fun;
-      auto name = ast->nodes[0]->token;
-      // TODO: lookup in static map
-      if      ( name == "atan2" ) { fun = [](double x, double y) { return std::atan2(x, y); }; }
-      else if ( name == "pow" )   { fun = [](double x, double y) { return std::pow(x, y); }; }
-      else if ( name == "max" )   { fun = [](double x, double y) { return std::max(x, y); }; }
-      else if ( name == "min" )   { fun = [](double x, double y) { return std::min(x, y); }; }
-      else {
-        throw std::runtime_error("unrecognized binary function: " + std::string(name));
+      const auto fun = binary_functions.find(ast->nodes[0]->token);
+      if ( fun == binary_functions.end() ) {
+        throw std::runtime_error("unrecognized binary function: " + std::string(ast->nodes[0]->token));
       }
       return {
         FormulaAst::NodeType::BinaryCall,
-        fun,
-        {translate_tformula_ast(ast->nodes[1], context), translate_tformula_ast(ast->nodes[2], context)}
+        fun->second,
+        {translate_tformula_ast(ast->nodes[1]), translate_tformula_ast(ast->nodes[2])}
       };
     }
     else if (ast->name == "EXPRESSION" ) {
@@ -188,12 +186,287 @@ namespace {
       return {
         FormulaAst::NodeType::Expression,
         op,
-        {translate_tformula_ast(ast->nodes[0], context), translate_tformula_ast(ast->nodes[2], context)}
+        {translate_tformula_ast(ast->nodes[0]), translate_tformula_ast(ast->nodes[2])}
       };
     }
     throw std::runtime_error("Unrecognized AST node");
   }
 
+  // Recursive descent parser of the same grammar as tformula_grammar, with
+  // precedence climbing for binary operators, which builds the FormulaAst
+  // directly. It holds no state beyond one expression, so needs no lock.
+  class TFormulaParser {
+    public:
+      TFormulaParser(const std::string_view expression) : expression_(expression), pos_(0) {};
+
+      FormulaAst parse() {
+        try {
+          skip_whitespace();
+          auto ast = expression(0);
+          if ( pos_ < expression_.size() ) error(expecting_binaryop);
+          return ast;
+        }
+        catch (const std::runtime_error&) {
+          // peglib lists what every alternative it tried expected at the
+          // error, so an invalid expression is parsed again for its message
+          tformula_parser().parse(expression_);
+          throw;
+        }
+      };
+
+    private:
+      static constexpr const char * expecting_atom {"<VARIABLE>, <BINARYF>, <UNARYF>, <LITERAL>"};
+      static constexpr const char * expecting_binaryop {"<BINARYOP>"};
+
+      struct Operator {
+        FormulaAst::BinaryOp op;
+        size_t length;
+        int precedence;
+        bool right_associative;
+      };
+
+      static bool is_digit(char c) { return c >= '0' && c <= '9'; };
+      static bool is_word(char c) { return ! std::ispunct((unsigned char) c) && ! std::isspace((unsigned char) c); };
+      bool at(char c) const { return pos_ < expression_.size() && expression_[pos_] == c; };
+      bool at_digit() const { return pos_ < expression_.size() && is_digit(expression_[pos_]); };
+      bool at_name() const { return pos_ < expression_.size() && std::isalnum((unsigned char) expression_[pos_]); };
+
+      void skip_whitespace() {
+        while ( at(' ') || at('\t') ) ++pos_;
+      };
+
+      void expect(char c) {
+        if ( ! at(c) ) error(std::string("'") + c + "'");
+        ++pos_;
+        skip_whitespace();
+      };
+
+      // a message in the format of peglib, where the unexpected token is the
+      // character or word at the current position
+      [[noreturn]] void error(const std::string& expecting) const {
+        std::string msg = "syntax error";
+        if ( pos_ < expression_.size() ) {
+          size_t end = pos_ + 1;
+          if ( is_word(expression_[pos_]) ) {
+            while ( end < expression_.size() && end - pos_ < 8 && is_word(expression_[end]) ) ++end;
+          }
+          msg += ", unexpected '" + std::string(expression_.substr(pos_, end - pos_)) + "'";
+        }
+        msg += ", expecting " + expecting + ".";
+        throw parse_error(expression_, pos_ + 1, msg);
+      };
+
+      std::optional<Operator> binary_operator() const {
+        if ( pos_ >= expression_.size() ) return std::nullopt;
+        const bool eq = pos_ + 1 < expression_.size() && expression_[pos_ + 1] == '=';
+        switch ( expression_[pos_] ) {
+          case '=': if ( eq ) return Operator{FormulaAst::BinaryOp::Equal, 2, 0, false}; break;
+          case '!': if ( eq ) return Operator{FormulaAst::BinaryOp::NotEqual, 2, 0, false}; break;
+          case '>':
+            if ( eq ) return Operator{FormulaAst::BinaryOp::GreaterEq, 2, 1, false};
+            return Operator{FormulaAst::BinaryOp::Greater, 1, 1, false};
+          case '<':
+            if ( eq ) return Operator{FormulaAst::BinaryOp::LessEq, 2, 1, false};
+            return Operator{FormulaAst::BinaryOp::Less, 1, 1, false};
+          case '-': return Operator{FormulaAst::BinaryOp::Minus, 1, 2, false};
+          case '+': return Operator{FormulaAst::BinaryOp::Plus, 1, 2, false};
+          case '/': return Operator{FormulaAst::BinaryOp::Div, 1, 3, false};
+          case '*': return Operator{FormulaAst::BinaryOp::Times, 1, 3, false};
+          case '^': return Operator{FormulaAst::BinaryOp::Pow, 1, 4, true};
+        }
+        return std::nullopt;
+      };
+
+      FormulaAst expression(int min_precedence) {
+        auto left = atom();
+        while ( auto op = binary_operator() ) {
+          if ( op->precedence < min_precedence ) break;
+          pos_ += op->length;
+          skip_whitespace();
+          // as in peglib, an operator without a valid right operand is dropped,
+          // and parsing goes on after it
+          const size_t operand = pos_;
+          FormulaAst right;
+          try {
+            right = expression(op->right_associative ? op->precedence : op->precedence + 1);
+          }
+          catch (const std::runtime_error&) {
+            pos_ = operand;
+            break;
+          }
+          FormulaAst::Children children;
+          children.reserve(2);
+          children.push_back(std::move(left));
+          children.push_back(std::move(right));
+          left = FormulaAst(FormulaAst::NodeType::Expression, op->op, std::move(children));
+        }
+        return left;
+      };
+
+      FormulaAst atom() {
+        // a sign directly followed by digits belongs to the literal
+        if ( at_digit() || (at('-') && pos_ + 1 < expression_.size() && is_digit(expression_[pos_ + 1])) ) {
+          return literal();
+        }
+        if ( at('-') ) {
+          ++pos_;
+          skip_whitespace();
+          FormulaAst::Children children;
+          children.push_back(operand("<VARIABLE>, <BINARYF>, <UNARYF>"));
+          return {FormulaAst::NodeType::UAtom, FormulaAst::UnaryOp::Negative, std::move(children)};
+        }
+        return operand(expecting_atom);
+      };
+
+      FormulaAst operand(const char * expecting) {
+        if ( at('(') ) {
+          ++pos_;
+          skip_whitespace();
+          auto ast = expression(0);
+          if ( ! at(')') ) error(expecting_binaryop);
+          expect(')');
+          return ast;
+        }
+        if ( at('[') ) {
+          ++pos_;
+          skip_whitespace();
+          const size_t start = pos_;
+          while ( at_digit() ) ++pos_;
+          if ( pos_ == start ) error("<PARAMETER>");
+          size_t idx = 0;
+          std::from_chars(expression_.data() + start, expression_.data() + pos_, idx);
+          skip_whitespace();
+          expect(']');
+          return {FormulaAst::NodeType::Parameter, idx, {}};
+        }
+        if ( ! at_name() ) error(expecting);
+        const size_t start = pos_;
+        while ( at_name() ) ++pos_;
+        const auto name = expression_.substr(start, pos_ - start);
+        if ( const auto fun = unary_functions.find(name); fun != unary_functions.end() ) {
+          skip_whitespace();
+          expect('(');
+          FormulaAst::Children children;
+          children.push_back(expression(0));
+          if ( ! at(')') ) error(expecting_binaryop);
+          expect(')');
+          return {FormulaAst::NodeType::UnaryCall, fun->second, std::move(children)};
+        }
+        if ( const auto fun = binary_functions.find(name); fun != binary_functions.end() ) {
+          skip_whitespace();
+          expect('(');
+          FormulaAst::Children children;
+          children.reserve(2);
+          children.push_back(expression(0));
+          if ( ! at(',') ) error(expecting_binaryop);
+          expect(',');
+          children.push_back(expression(0));
+          if ( ! at(')') ) error(expecting_binaryop);
+          expect(')');
+          return {FormulaAst::NodeType::BinaryCall, fun->second, std::move(children)};
+        }
+        // variables are a single letter, anything following is left to the caller
+        pos_ = start;
+        const char * const variables = "xyzt";
+        const char * const var = std::strchr(variables, expression_[pos_]);
+        if ( var == nullptr ) error(expecting);
+        ++pos_;
+        skip_whitespace();
+        return {FormulaAst::NodeType::Variable, (size_t) (var - variables), {}};
+      };
+
+      FormulaAst literal() {
+        const size_t start = pos_;
+        if ( at('-') ) ++pos_;
+        while ( at_digit() ) ++pos_;
+        if ( at('.') ) {
+          ++pos_;
+          while ( at_digit() ) ++pos_;
+        }
+        // nothing can follow a literal directly, so an incomplete exponent is
+        // reported where its digits are missing
+        if ( at('e') ) {
+          ++pos_;
+          if ( at('-') ) ++pos_;
+          if ( ! at_digit() ) error("<LITERAL>");
+          while ( at_digit() ) ++pos_;
+        }
+        const auto token = expression_.substr(start, pos_ - start);
+        skip_whitespace();
+        return {FormulaAst::NodeType::Literal, to_double(token), {}};
+      };
+
+      // converted as by peglib, rounding to nearest
+      static double to_double(const std::string_view token) {
+        double value = 0.;
+#if defined(__cpp_lib_to_chars) && __cpp_lib_to_chars >= 201611L
+        std::from_chars(token.data(), token.data() + token.size(), value);
+#else
+        std::istringstream stream{std::string(token)};
+        stream.imbue(std::locale::classic());
+        stream >> value;
+#endif
+        return value;
+      };
+
+      const std::string_view expression_;
+      size_t pos_;
+  };
+
+  // Parsed expressions, shared by all formulas of the process with the same
+  // expression, since files often repeat one expression in many bins
+  class ParseCache {
+    public:
+      std::shared_ptr<const FormulaAst> get(const std::string_view expression) {
+        {
+          const std::lock_guard<std::mutex> lock(m_);
+          const auto it = cache_.find(std::string(expression));
+          if ( it != cache_.end() ) return it->second;
+        }
+        // another thread may be parsing the same expression, in which case
+        // the first to finish is kept
+        auto ast = std::make_shared<const FormulaAst>(TFormulaParser(expression).parse());
+        const std::lock_guard<std::mutex> lock(m_);
+        return cache_.try_emplace(std::string(expression), ast).first->second;
+      };
+
+    private:
+      std::mutex m_;
+      std::unordered_map<std::string, std::shared_ptr<const FormulaAst>> cache_;
+  };
+
+  ParseCache tformula_cache;
+
+  struct BindingContext {
+      const std::vector<double>& params;
+      const std::vector<size_t>& variableIdx;
+      bool bind_parameters;
+  };
+
+  // Copies a cached FormulaAst with the variables of a particular formula
+  FormulaAst bind_formula_ast(const FormulaAst& ast, const BindingContext& context) {
+    if ( ast.nodetype() == FormulaAst::NodeType::Variable ) {
+      const size_t idx = std::get<size_t>(ast.data());
+      if ( context.variableIdx.size() <= idx ) {
+        throw std::runtime_error("Insufficient variables for formula");
+      }
+      return {FormulaAst::NodeType::Variable, context.variableIdx[idx], {}};
+    }
+    else if ( ast.nodetype() == FormulaAst::NodeType::Parameter && context.bind_parameters ) {
+      const size_t pidx = std::get<size_t>(ast.data());
+      if ( pidx >= context.params.size() ) {
+        throw std::runtime_error("Insufficient parameters for formula");
+      }
+      return {FormulaAst::NodeType::Literal, context.params[pidx], {}};
+    }
+    FormulaAst::Children children;
+    children.reserve(ast.children().size());
+    for (const auto& child : ast.children()) {
+      children.push_back(bind_formula_ast(child, context));
+    }
+    return {ast.nodetype(), ast.data(), std::move(children)};
+  }
+
 }
 
 FormulaAst FormulaAst::parse(
@@ -204,12 +477,22 @@ FormulaAst FormulaAst::parse(
     bool bind_parameters
     ) {
   if ( type == ParserType::TFormula ) {
-    const std::lock_guard<std::mutex> lock(tformula_parser.m);
-    return translate_tformula_ast(tformula_parser.parse(expression), TranslationContext{params, variableIdx, bind_parameters});
+    const auto ast = tformula_cache.get(expression);
+    return bind_formula_ast(*ast, BindingContext{params, variableIdx, bind_parameters});
   }
   throw std::runtime_error("Unrecognized formula parser type");
 }
 
+FormulaAst FormulaAst::parse_reference(
+    const std::string_view expression,
+    const std::vector<double>& params,
+    const std::vector<size_t>& variableIdx,
+    bool bind_parameters
+    ) {
+  const auto ast = translate_tformula_ast(tformula_parser().parse(expression));
+  return bind_formula_ast(ast, BindingContext{params, variableIdx, bind_parameters});
+}
+
 double FormulaAst::evaluate(const std::vector<Variable::Type>& values, const std::vector<double>& params) const {
   switch (nodetype_) {
     case NodeType::Literal:
@@ -223,30 +506,539 @@ double FormulaAst::evaluate(const std::vector<Variable::Type>& values, const std
         case UnaryOp::Negative: return -children_[0].evaluate(values, params);
       }
     case NodeType::UnaryCall:
-      return std::get<UnaryFcn>(data_)(
-          children_[0].evaluate(values, params)
-          );
+      return apply(std::get<UnaryFcn>(data_), children_[0].evaluate(values, params));
     case NodeType::BinaryCall:
-      return std::get<BinaryFcn>(data_)(
-          children_[0].evaluate(values, params), children_[1].evaluate(values, params)
+      return apply(
+          std::get<BinaryFcn>(data_),
+          children_[0].evaluate(values, params),
+          children_[1].evaluate(values, params)
           );
-    case NodeType::Undefined:
-      throw std::runtime_error("Unrecognized AST node");
     case NodeType::Expression:
-      auto left = children_[0].evaluate(values, params);
-      auto right = children_[1].evaluate(values, params);
-      switch (std::get<BinaryOp>(data_)) {
-        case BinaryOp::Equal: return (left == right) ? 1. : 0.;
-        case BinaryOp::NotEqual: return (left != right) ? 1. : 0.;
-        case BinaryOp::Greater: return (left > right) ? 1. : 0.;
-        case BinaryOp::Less: return (left < right) ? 1. : 0.;
-        case BinaryOp::GreaterEq: return (left >= right) ? 1. : 0.;
-        case BinaryOp::LessEq: return (left <= right) ? 1. : 0.;
-        case BinaryOp::Minus: return left - right;
-        case BinaryOp::Plus: return left + right;
-        case BinaryOp::Div: return left / right;
-        case BinaryOp::Times: return left * right;
-        case BinaryOp::Pow: return std::pow(left, right);
+      return apply(
+          std::get<BinaryOp>(data_),
+          children_[0].evaluate(values, params),
+          children_[1].evaluate(values, params)
+          );
+    case NodeType::Undefined:
+      break;
+  }
+  throw std::runtime_error("Unrecognized AST node");
+}
+
+namespace {
+  constexpr FormulaProgram::OpCode opcode(FormulaAst::UnaryFcn fcn) {
+    return (FormulaProgram::OpCode) ((size_t) FormulaProgram::OpCode::Log + (size_t) fcn);
+  }
+
+  constexpr FormulaProgram::OpCode opcode(FormulaAst::BinaryFcn fcn) {
+    switch (fcn) {
+      case FormulaAst::BinaryFcn::Atan2: return FormulaProgram::OpCode::Atan2;
+      case FormulaAst::BinaryFcn::Pow: return FormulaProgram::OpCode::Pow;
+      case FormulaAst::BinaryFcn::Max: return FormulaProgram::OpCode::Max;
+      case FormulaAst::BinaryFcn::Min: return FormulaProgram::OpCode::Min;
+    }
+    return FormulaProgram::OpCode::Literal; // unreachable
+  }
+
+  constexpr FormulaProgram::OpCode opcode(FormulaAst::BinaryOp op) {
+    switch (op) {
+      case FormulaAst::BinaryOp::Equal: return FormulaProgram::OpCode::Equal;
+      case FormulaAst::BinaryOp::NotEqual: return FormulaProgram::OpCode::NotEqual;
+      case FormulaAst::BinaryOp::Greater: return FormulaProgram::OpCode::Greater;
+      case FormulaAst::BinaryOp::Less: return FormulaProgram::OpCode::Less;
+      case FormulaAst::BinaryOp::GreaterEq: return FormulaProgram::OpCode::GreaterEq;
+      case FormulaAst::BinaryOp::LessEq: return FormulaProgram::OpCode::LessEq;
+      case FormulaAst::BinaryOp::Minus: return FormulaProgram::OpCode::Minus;
+      case FormulaAst::BinaryOp::Plus: return FormulaProgram::OpCode::Plus;
+      case FormulaAst::BinaryOp::Div: return FormulaProgram::OpCode::Div;
+      case FormulaAst::BinaryOp::Times: return FormulaProgram::OpCode::Times;
+      case FormulaAst::BinaryOp::Pow: return FormulaProgram::OpCode::Pow;
+    }
+    return FormulaProgram::OpCode::Literal; // unreachable
+  }
+
+  // values on the stack of FormulaProgram::evaluate that are kept on the C++ stack
+  constexpr size_t local_stack_size {32};
+
+  // rows per block in column-wise evaluation, small enough for the stack of
+  // columns to stay in cache
+  constexpr size_t batch_block {256};
+
+  // simple loops over a column, which the compiler can vectorize
+  template<typename F>
+  void apply_column(double* x, size_t m, F f) {
+    for (size_t k=0; k < m; ++k) x[k] = f(x[k]);
+  }
+
+  template<typename F>
+  void apply_columns(double* x, const double* y, size_t m, F f) {
+    for (size_t k=0; k < m; ++k) x[k] = f(x[k], y[k]);
+  }
+}
+
+double FormulaAst::apply(UnaryFcn fcn, double x) {
+  switch (fcn) {
+    case UnaryFcn::Log: return std::log(x);
+    case UnaryFcn::Log10: return std::log10(x);
+    case UnaryFcn::Exp: return std::exp(x);
+    case UnaryFcn::Erf: return std::erf(x);
+    case UnaryFcn::Sqrt: return std::sqrt(x);
+    case UnaryFcn::Abs: return std::abs(x);
+    case UnaryFcn::Cos: return std::cos(x);
+    case UnaryFcn::Sin: return std::sin(x);
+    case UnaryFcn::Tan: return std::tan(x);
+    case UnaryFcn::Acos: return std::acos(x);
+    case UnaryFcn::Asin: return std::asin(x);
+    case UnaryFcn::Atan: return std::atan(x);
+    case UnaryFcn::Cosh: return std::cosh(x);
+    case UnaryFcn::Sinh: return std::sinh(x);
+    case UnaryFcn::Tanh: return std::tanh(x);
+    case UnaryFcn::Acosh: return std::acosh(x);
+    case UnaryFcn::Asinh: return std::asinh(x);
+    case UnaryFcn::Atanh: return std::atanh(x);
+  }
+  throw std::runtime_error("Unrecognized unary function");
+}
+
+double FormulaAst::apply(BinaryFcn fcn, double x, double y) {
+  switch (fcn) {
+    case BinaryFcn::Atan2: return std::atan2(x, y);
+    case BinaryFcn::Pow: return std::pow(x, y);
+    case BinaryFcn::Max: return std::max(x, y);
+    case BinaryFcn::Min: return std::min(x, y);
+  }
+  throw std::runtime_error("Unrecognized binary function");
+}
+
+double FormulaAst::apply(BinaryOp op, double left, double right) {
+  switch (op) {
+    case BinaryOp::Equal: return (left == right) ? 1. : 0.;
+    case BinaryOp::NotEqual: return (left != right) ? 1. : 0.;
+    case BinaryOp::Greater: return (left > right) ? 1. : 0.;
+    case BinaryOp::Less: return (left < right) ? 1. : 0.;
+    case BinaryOp::GreaterEq: return (left >= right) ? 1. : 0.;
+    case BinaryOp::LessEq: return (left <= right) ? 1. : 0.;
+    case BinaryOp::Minus: return left - right;
+    case BinaryOp::Plus: return left + right;
+    case BinaryOp::Div: return left / right;
+    case BinaryOp::Times: return left * right;
+    case BinaryOp::Pow: return std::pow(left, right);
+  }
+  throw std::runtime_error("Unrecognized binary operation");
+}
+
+namespace {
+  bool is_literal(const FormulaAst& ast) {
+    return ast.nodetype() == FormulaAst::NodeType::Literal;
+  }
+
+  bool is_literal(const FormulaAst& ast, double value) {
+    return is_literal(ast) && std::get<double>(ast.data()) == value;
+  }
+
+  bool is_positive_zero(const FormulaAst& ast) {
+    return is_literal(ast, 0.) && ! std::signbit(std::get<double>(ast.data()));
+  }
+
+  // base^n for n > 0 as a product, by repeated squaring; the repeated
+  // factors are evaluated once thanks to the common subexpression elimination
+  // of FormulaProgram
+  FormulaAst product_power(const FormulaAst& base, unsigned n) {
+    if ( n == 1 ) return base;
+    auto half = product_power(base, n / 2);
+    FormulaAst square(FormulaAst::NodeType::Expression, FormulaAst::BinaryOp::Times, {half, half});
+    if ( n % 2 == 1 ) {
+      return {FormulaAst::NodeType::Expression, FormulaAst::BinaryOp::Times, {square, base}};
+    }
+    return square;
+  }
+
+  // largest integer power rewritten as a product
+  constexpr double max_product_power {16.};
+}
+
+FormulaAst FormulaAst::simplify(bool fast_math) const {
+  if ( children_.empty() ) return *this;
+  Children children;
+  children.reserve(children_.size());
+  bool constant {true};
+  for (const auto& child : children_) {
+    children.push_back(child.simplify(fast_math));
+    constant &= is_literal(children.back());
+  }
+  if ( constant ) {
+    // evaluated with the same functions as at run time, so this is exact
+    const FormulaAst node(nodetype_, data_, children);
+    return {NodeType::Literal, node.evaluate({}, {}), {}};
+  }
+
+  if ( nodetype_ == NodeType::UAtom && children[0].nodetype_ == NodeType::UAtom ) {
+    // -(-x)
+    return children[0].children_[0];
+  }
+
+  const bool is_pow = (
+      ( nodetype_ == NodeType::Expression && std::get<BinaryOp>(data_) == BinaryOp::Pow )
+      || ( nodetype_ == NodeType::BinaryCall && std::get<BinaryFcn>(data_) == BinaryFcn::Pow )
+      );
+  if ( is_pow && is_literal(children[1]) ) {
+    const auto& base = children[0];
+    const double n = std::get<double>(children[1].data_);
+    if ( n == 1. ) return base;
+    if ( n == 0. ) return {NodeType::Literal, 1., {}}; // even for NaN
+    // the rewrites below may differ from std::pow in the last bits, and sqrt
+    // also at -inf (NaN rather than +inf) and -0 (-0 rather than +0)
+    if ( fast_math && n == 0.5 ) {
+      return {NodeType::UnaryCall, UnaryFcn::Sqrt, {base}};
+    }
+    if ( fast_math && n == std::round(n) && std::abs(n) <= max_product_power ) {
+      auto product = product_power(base, (unsigned) std::abs(n));
+      if ( n < 0. ) {
+        return {NodeType::Expression, BinaryOp::Div, {{NodeType::Literal, 1., {}}, product}};
+      }
+      return product;
+    }
+  }
+  else if ( nodetype_ == NodeType::Expression ) {
+    const auto& left = children[0];
+    const auto& right = children[1];
+    switch (std::get<BinaryOp>(data_)) {
+      case BinaryOp::Times:
+        if ( is_literal(right, 1.) ) return left;
+        if ( is_literal(left, 1.) ) return right;
+        break;
+      case BinaryOp::Div:
+        if ( is_literal(right, 1.) ) return left;
+        break;
+      case BinaryOp::Minus:
+        // x - 0 is x even for x = -0, but x - (-0) is not
+        if ( is_positive_zero(right) ) return left;
+        break;
+      case BinaryOp::Plus:
+        // -0 + 0 is +0, so this only changes the sign of a zero result
+        if ( fast_math && is_literal(right, 0.) ) return left;
+        if ( fast_math && is_literal(left, 0.) ) return right;
+        break;
+      default:
+        break;
+    }
+  }
+  return {nodetype_, data_, children};
+}
+
+std::string FormulaAst::source() const {
+  switch (nodetype_) {
+    case NodeType::Literal: {
+      const double value = std::get<double>(data_);
+      if ( std::isnan(value) ) return "std::numeric_limits<double>::quiet_NaN()";
+      if ( std::isinf(value) ) {
+        return (value < 0) ? "(-std::numeric_limits<double>::infinity())" : "std::numeric_limits<double>::infinity()";
+      }
+      // hexadecimal, so that the value is exact
+      char buffer[32];
+      std::snprintf(buffer, sizeof(buffer), "%a", value);
+      return (value < 0 || std::signbit(value)) ? "(" + std::string(buffer) + ")" : std::string(buffer);
+    }
+    case NodeType::Variable:
+      return "x[" + std::to_string(std::get<size_t>(data_)) + "]";
+    case NodeType::Parameter:
+      return "p[" + std::to_string(std::get<size_t>(data_)) + "]";
+    case NodeType::UAtom:
+      return "(-" + children_[0].source() + ")";
+    case NodeType::UnaryCall: {
+      static const char* names[] = {
+        "log", "log10", "exp", "erf", "sqrt", "abs", "cos", "sin", "tan",
+        "acos", "asin", "atan", "cosh", "sinh", "tanh", "acosh", "asinh", "atanh",
       };
+      return "std::" + std::string(names[(size_t) std::get<UnaryFcn>(data_)]) + "(" + children_[0].source() + ")";
+    }
+    case NodeType::BinaryCall: {
+      static const char* names[] = {"atan2", "pow", "max", "min"};
+      return "std::" + std::string(names[(size_t) std::get<BinaryFcn>(data_)])
+        + "(" + children_[0].source() + ", " + children_[1].source() + ")";
+    }
+    case NodeType::Expression: {
+      const auto left = children_[0].source();
+      const auto right = children_[1].source();
+      auto compare = [&](const char* op) { return "((" + left + " " + op + " " + right + ") ? 1. : 0.)"; };
+      switch (std::get<BinaryOp>(data_)) {
+        case BinaryOp::Equal: return compare("==");
+        case BinaryOp::NotEqual: return compare("!=");
+        case BinaryOp::Greater: return compare(">");
+        case BinaryOp::Less: return compare("<");
+        case BinaryOp::GreaterEq: return compare(">=");
+        case BinaryOp::LessEq: return compare("<=");
+        case BinaryOp::Minus: return "(" + left + " - " + right + ")";
+        case BinaryOp::Plus: return "(" + left + " + " + right + ")";
+        case BinaryOp::Div: return "(" + left + " / " + right + ")";
+        case BinaryOp::Times: return "(" + left + " * " + right + ")";
+        case BinaryOp::Pow: return "std::pow(" + left + ", " + right + ")";
+      }
+      break;
+    }
+    case NodeType::Undefined:
+      break;
+  }
+  throw std::runtime_error("Unrecognized AST node");
+}
+
+// Subtrees that appear more than once in a FormulaAst
+struct FormulaProgram::Subexpressions {
+  struct Entry {
+    size_t uses;
+    bool stored;
+    uint32_t local;
+  };
+
+  Subexpressions(const FormulaAst& ast) {
+    hash(ast);
+    count(ast);
+  }
+
+  // nullptr for leaves, which are as cheap to push as to load
+  Entry* find(const FormulaAst& ast) {
+    if ( ast.children().empty() ) return nullptr;
+    auto [begin, end] = index_.equal_range(hashes_.at(&ast));
+    for (auto it = begin; it != end; ++it) {
+      if ( same(*it->second.first, ast) ) return &it->second.second;
+    }
+    return nullptr;
+  }
+
+  private:
+    // literals are compared bitwise, so that e.g. 0 and -0 are distinct
+    static bool same(const FormulaAst& a, const FormulaAst& b) {
+      if ( a.nodetype() != b.nodetype() || a.data().index() != b.data().index() ) return false;
+      if ( auto x = std::get_if<double>(&a.data()) ) {
+        if ( std::memcmp(x, &std::get<double>(b.data()), sizeof(double)) != 0 ) return false;
+      }
+      else if ( a.data() != b.data() ) return false;
+      if ( a.children().size() != b.children().size() ) return false;
+      for (size_t i=0; i < a.children().size(); ++i) {
+        if ( ! same(a.children()[i], b.children()[i]) ) return false;
+      }
+      return true;
+    }
+
+    size_t hash(const FormulaAst& ast) {
+      size_t h = std::visit([](const auto& data) -> size_t {
+        using T = std::decay_t<decltype(data)>;
+        if constexpr ( std::is_same_v<T, std::monostate> ) { return 0; }
+        else if constexpr ( std::is_same_v<T, double> ) {
+          uint64_t bits;
+          std::memcpy(&bits, &data, sizeof(double));
+          return std::hash<uint64_t>()(bits);
+        }
+        else { return std::hash<size_t>()((size_t) data); }
+      }, ast.data());
+      h ^= (size_t) ast.nodetype() + 0x9e3779b9 + (h << 6) + (h >> 2);
+      for (const auto& child : ast.children()) {
+        h ^= hash(child) + 0x9e3779b9 + (h << 6) + (h >> 2);
+      }
+      hashes_[&ast] = h;
+      return h;
+    }
+
+    // subtrees of a repeated subtree are only counted in its first
+    // occurrence, as the others are not evaluated
+    void count(const FormulaAst& ast) {
+      if ( ast.children().empty() ) return;
+      if ( auto entry = find(ast) ) {
+        entry->uses++;
+        return;
+      }
+      index_.emplace(hashes_.at(&ast), std::make_pair(&ast, Entry{1, false, 0}));
+      for (const auto& child : ast.children()) {
+        count(child);
+      }
+    }
+
+    std::unordered_map<const FormulaAst*, size_t> hashes_;
+    std::unordered_multimap<size_t, std::pair<const FormulaAst*, Entry>> index_;
+};
+
+FormulaProgram::FormulaProgram(const FormulaAst& ast) :
+  stack_size_(0), nlocals_(0), nparameters_(0)
+{
+  Subexpressions subexpressions(ast);
+  compile(ast, 0, subexpressions);
+  std::sort(variables_.begin(), variables_.end());
+  variables_.erase(std::unique(variables_.begin(), variables_.end()), variables_.end());
+}
+
+// Appends the postfix code of ast, which starts with depth values on the
+// stack, and returns the stack depth needed to evaluate it
+size_t FormulaProgram::compile(const FormulaAst& ast, size_t depth, Subexpressions& subexpressions) {
+  auto entry = subexpressions.find(ast);
+  if ( entry && entry->stored ) {
+    code_.push_back({OpCode::Load, entry->local});
+    stack_size_ = std::max(stack_size_, depth + 1);
+    return depth + 1;
+  }
+  const auto& children = ast.children();
+  size_t maxdepth = depth + 1;
+  for (size_t i=0; i < children.size(); ++i) {
+    maxdepth = std::max(maxdepth, compile(children[i], depth + i, subexpressions));
+  }
+  switch (ast.nodetype()) {
+    case FormulaAst::NodeType::Literal:
+      code_.push_back({OpCode::Literal, (uint32_t) constants_.size()});
+      constants_.push_back(std::get<double>(ast.data()));
+      break;
+    case FormulaAst::NodeType::Variable:
+      code_.push_back({OpCode::Variable, (uint32_t) std::get<size_t>(ast.data())});
+      variables_.push_back(std::get<size_t>(ast.data()));
+      break;
+    case FormulaAst::NodeType::Parameter:
+      code_.push_back({OpCode::Parameter, (uint32_t) std::get<size_t>(ast.data())});
+      nparameters_ = std::max(nparameters_, std::get<size_t>(ast.data()) + 1);
+      break;
+    case FormulaAst::NodeType::UAtom:
+      code_.push_back({OpCode::Negative, 0});
+      break;
+    case FormulaAst::NodeType::UnaryCall:
+      code_.push_back({opcode(std::get<FormulaAst::UnaryFcn>(ast.data())), 0});
+      break;
+    case FormulaAst::NodeType::BinaryCall:
+      code_.push_back({opcode(std::get<FormulaAst::BinaryFcn>(ast.data())), 0});
+      break;
+    case FormulaAst::NodeType::Expression:
+      code_.push_back({opcode(std::get<FormulaAst::BinaryOp>(ast.data())), 0});
+      break;
+    case FormulaAst::NodeType::Undefined:
+      throw std::runtime_error("Unrecognized AST node");
+  }
+  if ( entry && entry->uses > 1 ) {
+    entry->stored = true;
+    entry->local = nlocals_++;
+    code_.push_back({OpCode::Store, entry->local});
+  }
+  stack_size_ = std::max(stack_size_, maxdepth);
+  return maxdepth;
+}
+
+double FormulaProgram::evaluate(const std::vector<Variable::Type>& values, const std::vector<double>& params) const {
+  const size_t size = stack_size_ + nlocals_;
+  if ( size <= local_stack_size ) {
+    double stack[local_stack_size];
+    return run(stack, values, params);
+  }
+  thread_local std::vector<double> stack;
+  if ( stack.size() < size ) stack.resize(size);
+  return run(stack.data(), values, params);
+}
+
+void FormulaProgram::evaluate(size_t n, const std::vector<const double*>& values, const std::vector<double>& params, double* output) const {
+  const size_t block = std::min(n, batch_block);
+  thread_local std::vector<double> stack;
+  const size_t size = (stack_size_ + nlocals_) * block;
+  if ( stack.size() < size ) stack.resize(size);
+  for (size_t start=0; start < n; start += block) {
+    const size_t m = std::min(block, n - start);
+    run(stack.data(), block, start, m, values, params, output + start);
+  }
+}
+
+void FormulaProgram::run(double* stack, size_t block, size_t start, size_t m, const std::vector<const double*>& values, const std::vector<double>& params, double* output) const {
+  // top points at the last column pushed
+  double* top = stack - block;
+  double* locals = stack + stack_size_ * block;
+  for (const auto& [op, arg] : code_) {
+    switch (op) {
+      case OpCode::Literal: top += block; std::fill_n(top, m, constants_[arg]); break;
+      case OpCode::Variable: top += block; std::copy_n(values[arg] + start, m, top); break;
+      case OpCode::Parameter: top += block; std::fill_n(top, m, params[arg]); break;
+      case OpCode::Load: top += block; std::copy_n(locals + arg * block, m, top); break;
+      case OpCode::Store: std::copy_n(top, m, locals + arg * block); break;
+      case OpCode::Negative: apply_column(top, m, [](double x) { return -x; }); break;
+      case OpCode::Log: apply_column(top, m, [](double x) { return std::log(x); }); break;
+      case OpCode::Log10: apply_column(top, m, [](double x) { return std::log10(x); }); break;
+      case OpCode::Exp: apply_column(top, m, [](double x) { return std::exp(x); }); break;
+      case OpCode::Erf: apply_column(top, m, [](double x) { return std::erf(x); }); break;
+      case OpCode::Sqrt: apply_column(top, m, [](double x) { return std::sqrt(x); }); break;
+      case OpCode::Abs: apply_column(top, m, [](double x) { return std::abs(x); }); break;
+      case OpCode::Cos: apply_column(top, m, [](double x) { return std::cos(x); }); break;
+      case OpCode::Sin: apply_column(top, m, [](double x) { return std::sin(x); }); break;
+      case OpCode::Tan: apply_column(top, m, [](double x) { return std::tan(x); }); break;
+      case OpCode::Acos: apply_column(top, m, [](double x) { return std::acos(x); }); break;
+      case OpCode::Asin: apply_column(top, m, [](double x) { return std::asin(x); }); break;
+      case OpCode::Atan: apply_column(top, m, [](double x) { return std::atan(x); }); break;
+      case OpCode::Cosh: apply_column(top, m, [](double x) { return std::cosh(x); }); break;
+      case OpCode::Sinh: apply_column(top, m, [](double x) { return std::sinh(x); }); break;
+      case OpCode::Tanh: apply_column(top, m, [](double x) { return std::tanh(x); }); break;
+      case OpCode::Acosh: apply_column(top, m, [](double x) { return std::acosh(x); }); break;
+      case OpCode::Asinh: apply_column(top, m, [](double x) { return std::asinh(x); }); break;
+      case OpCode::Atanh: apply_column(top, m, [](double x) { return std::atanh(x); }); break;
+      default:
+        // binary operations, with the left operand in the column below the top
+        top -= block;
+        switch (op) {
+          case OpCode::Atan2: apply_columns(top, top + block, m, [](double x, double y) { return std::atan2(x, y); }); break;
+          case OpCode::Pow: apply_columns(top, top + block, m, [](double x, double y) { return std::pow(x, y); }); break;
+          case OpCode::Max: apply_columns(top, top + block, m, [](double x, double y) { return std::max(x, y); }); break;
+          case OpCode::Min: apply_columns(top, top + block, m, [](double x, double y) { return std::min(x, y); }); break;
+          case OpCode::Equal: apply_columns(top, top + block, m, [](double x, double y) { return (x == y) ? 1. : 0.; }); break;
+          case OpCode::NotEqual: apply_columns(top, top + block, m, [](double x, double y) { return (x != y) ? 1. : 0.; }); break;
+          case OpCode::Greater: apply_columns(top, top + block, m, [](double x, double y) { return (x > y) ? 1. : 0.; }); break;
+          case OpCode::Less: apply_columns(top, top + block, m, [](double x, double y) { return (x < y) ? 1. : 0.; }); break;
+          case OpCode::GreaterEq: apply_columns(top, top + block, m, [](double x, double y) { return (x >= y) ? 1. : 0.; }); break;
+          case OpCode::LessEq: apply_columns(top, top + block, m, [](double x, double y) { return (x <= y) ? 1. : 0.; }); break;
+          case OpCode::Minus: apply_columns(top, top + block, m, [](double x, double y) { return x - y; }); break;
+          case OpCode::Plus: apply_columns(top, top + block, m, [](double x, double y) { return x + y; }); break;
+          case OpCode::Div: apply_columns(top, top + block, m, [](double x, double y) { return x / y; }); break;
+          case OpCode::Times: apply_columns(top, top + block, m, [](double x, double y) { return x * y; }); break;
+          default: throw std::runtime_error("Unrecognized formula operation");
+        }
+    }
+  }
+  std::copy_n(top, m, output);
+}
+
+double FormulaProgram::run(double* stack, const std::vector<Variable::Type>& values, const std::vector<double>& params) const {
+  // top points at the last value pushed
+  double* top = stack - 1;
+  double* locals = stack + stack_size_;
+  for (const auto& [op, arg] : code_) {
+    switch (op) {
+      case OpCode::Literal: *++top = constants_[arg]; break;
+      case OpCode::Variable: *++top = std::get<double>(values[arg]); break;
+      case OpCode::Parameter: *++top = params[arg]; break;
+      case OpCode::Load: *++top = locals[arg]; break;
+      case OpCode::Store: locals[arg] = *top; break;
+      case OpCode::Negative: *top = -*top; break;
+      case OpCode::Log: *top = std::log(*top); break;
+      case OpCode::Log10: *top = std::log10(*top); break;
+      case OpCode::Exp: *top = std::exp(*top); break;
+      case OpCode::Erf: *top = std::erf(*top); break;
+      case OpCode::Sqrt: *top = std::sqrt(*top); break;
+      case OpCode::Abs: *top = std::abs(*top); break;
+      case OpCode::Cos: *top = std::cos(*top); break;
+      case OpCode::Sin: *top = std::sin(*top); break;
+      case OpCode::Tan: *top = std::tan(*top); break;
+      case OpCode::Acos: *top = std::acos(*top); break;
+      case OpCode::Asin: *top = std::asin(*top); break;
+      case OpCode::Atan: *top = std::atan(*top); break;
+      case OpCode::Cosh: *top = std::cosh(*top); break;
+      case OpCode::Sinh: *top = std::sinh(*top); break;
+      case OpCode::Tanh: *top = std::tanh(*top); break;
+      case OpCode::Acosh: *top = std::acosh(*top); break;
+      case OpCode::Asinh: *top = std::asinh(*top); break;
+      case OpCode::Atanh: *top = std::atanh(*top); break;
+      case OpCode::Atan2: --top; *top = std::atan2(top[0], top[1]); break;
+      case OpCode::Pow: --top; *top = std::pow(top[0], top[1]); break;
+      case OpCode::Max: --top; *top = std::max(top[0], top[1]); break;
+      case OpCode::Min: --top; *top = std::min(top[0], top[1]); break;
+      case OpCode::Equal: --top; *top = (top[0] == top[1]) ? 1. : 0.; break;
+      case OpCode::NotEqual: --top; *top = (top[0] != top[1]) ? 1. : 0.; break;
+      case OpCode::Greater: --top; *top = (top[0] > top[1]) ? 1. : 0.; break;
+      case OpCode::Less: --top; *top = (top[0] < top[1]) ? 1. : 0.; break;
+      case OpCode::GreaterEq: --top; *top = (top[0] >= top[1]) ? 1. : 0.; break;
+      case OpCode::LessEq: --top; *top = (top[0] <= top[1]) ? 1. : 0.; break;
+      case OpCode::Minus: --top; *top = top[0] - top[1]; break;
+      case OpCode::Plus: --top; *top = top[0] + top[1]; break;
+      case OpCode::Div: --top; *top = top[0] / top[1]; break;
+      case OpCode::Times: --top; *top = top[0] * top[1]; break;
+    }
   }
+  return *top;
 }
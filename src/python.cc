@@ -1,28 +1,429 @@
+#include <deque>
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
+#include <pybind11/numpy.h>
 #include "correction.h"
 
 namespace py = pybind11;
 using namespace correction;
 
+namespace {
+  // Keeps converted inputs alive for the duration of a batch evaluation
+  struct BatchStorage {
+    std::vector<py::array> arrays;
+    std::deque<Variable::Type> scalars;
+    std::deque<std::vector<StringId>> string_ids;
+  };
+
+  // The memory of any object supporting the buffer protocol, as contiguous bytes
+  class BufferView {
+    public:
+      BufferView(const py::object& obj) {
+        if ( PyObject_GetBuffer(obj.ptr(), &view_, PyBUF_SIMPLE) != 0 ) {
+          throw py::error_already_set();
+        }
+      };
+      ~BufferView() { PyBuffer_Release(&view_); };
+      BufferView(const BufferView&) = delete;
+      BufferView& operator=(const BufferView&) = delete;
+      const char * data() const { return (const char *) view_.buf; };
+      size_t size() const { return view_.len; };
+
+    private:
+      Py_buffer view_;
+  };
+
+  // pandas.Categorical, or a pandas.Series of category dtype
+  py::object as_categorical(const py::handle& arg) {
+    if ( py::hasattr(arg, "codes") && py::hasattr(arg, "categories") ) {
+      return py::reinterpret_borrow<py::object>(arg);
+    }
+    if ( ! py::isinstance<py::array>(arg) && py::hasattr(arg, "cat") ) {
+      return arg.attr("cat");
+    }
+    return py::none();
+  }
+
+  bool is_batch_input(const py::handle& arg) {
+    return py::isinstance<py::array>(arg) || ! as_categorical(arg).is_none();
+  }
+
+  template<typename T>
+  Column<T> array_column(BatchStorage& storage, const py::object& arg, const py::object& shape) {
+    auto numpy = py::module::import("numpy");
+    auto arr = py::array_t<T, py::array::c_style | py::array::forcecast>::ensure(
+        numpy.attr("broadcast_to")(arg, shape)
+        );
+    if ( ! arr ) {
+      throw py::type_error("Unable to convert input array");
+    }
+    storage.arrays.push_back(arr);
+    return {arr.data(), 1};
+  }
+
+  // Encode string values as codes into a vocabulary, translated to the interned
+  // ids of the correction, so that each distinct string is only looked up once
+  Column<StringId> string_column(
+      BatchStorage& storage,
+      const Correction& c,
+      size_t input,
+      const py::object& codes,
+      const py::iterable& vocabulary,
+      const py::object& shape
+      ) {
+    std::vector<StringId> ids;
+    for (const auto& item : vocabulary) {
+      ids.push_back({c.string_id(input, py::cast<std::string>(item))});
+    }
+    const auto column = array_column<int64_t>(storage, codes, shape);
+    auto& out = storage.string_ids.emplace_back(storage.arrays.back().size());
+    for (size_t k=0; k < out.size(); ++k) {
+      // a code of -1 is a missing value in pandas
+      const int64_t code = column[k];
+      out[k] = ( code >= 0 ) ? ids.at(code) : StringId{-1};
+    }
+    return {out.data(), 1};
+  }
+
+  Variable::BatchType make_column(
+      BatchStorage& storage,
+      const Correction& c,
+      size_t input,
+      const py::object& arg,
+      const py::object& shape
+      ) {
+    auto categorical = as_categorical(arg);
+    if ( ! categorical.is_none() ) {
+      if ( input < c.inputs().size() && c.inputs()[input].type() == Variable::VarType::string ) {
+        return string_column(storage, c, input, categorical.attr("codes"), categorical.attr("categories"), shape);
+      }
+      throw py::type_error("Categorical input given for input " + std::to_string(input) + " which is not a string");
+    }
+    if ( py::isinstance<py::array>(arg) ) {
+      auto arr = py::reinterpret_borrow<py::array>(arg);
+      switch ( arr.dtype().kind() ) {
+        case 'f':
+          return array_column<double>(storage, arg, shape);
+        case 'i':
+        case 'u':
+          // values that do not fit in an int are passed on as real, as scalars
+          // are, rather than wrapping around
+          if ( arr.size() > 0 && (size_t) arr.itemsize() + (arr.dtype().kind() == 'u') > sizeof(int) ) {
+            const auto low = py::cast<double>(arr.attr("min")());
+            const auto high = py::cast<double>(arr.attr("max")());
+            if ( low < std::numeric_limits<int>::min() || high > std::numeric_limits<int>::max() ) {
+              return array_column<double>(storage, arg, shape);
+            }
+          }
+          return array_column<int>(storage, arg, shape);
+        case 'b':
+          return array_column<int>(storage, arg, shape);
+        case 'U':
+        case 'S':
+        case 'O': {
+          if ( input >= c.inputs().size() || c.inputs()[input].type() != Variable::VarType::string ) {
+            throw std::runtime_error("Input " + std::to_string(input) + " has wrong type: got string array");
+          }
+          auto numpy = py::module::import("numpy");
+          py::tuple unique = numpy.attr("unique")(arg, py::arg("return_inverse") = true);
+          py::object codes = unique[1].attr("reshape")(arr.attr("shape"));
+          return string_column(storage, c, input, codes, unique[0], shape);
+        }
+        default:
+          throw py::type_error("Unsupported input array dtype: " + py::cast<std::string>(py::str(arr.dtype())));
+      }
+    }
+    // scalars are broadcast with a zero stride
+    const auto& value = storage.scalars.emplace_back(py::cast<Variable::Type>(arg));
+    return std::visit([](const auto& v) -> Variable::BatchType {
+      return Column<std::decay_t<decltype(v)>>{&v, 0};
+    }, value);
+  }
+
+  py::object evaluate_batch(const Correction& c, const py::args& args, py::object out, size_t threads, size_t min_chunk) {
+    auto numpy = py::module::import("numpy");
+    py::list arrays;
+    for (const auto& arg : args) {
+      auto categorical = as_categorical(arg);
+      if ( ! categorical.is_none() ) arrays.append(categorical.attr("codes"));
+      else if ( py::isinstance<py::array>(arg) ) arrays.append(arg);
+    }
+    py::object shape = py::tuple();
+    if ( arrays.size() > 0 ) {
+      shape = numpy.attr("broadcast")(*arrays).attr("shape");
+    }
+    else if ( ! out.is_none() ) {
+      shape = out.attr("shape");
+    }
+
+    BatchStorage storage;
+    std::vector<Variable::BatchType> columns;
+    columns.reserve(args.size());
+    for (const auto& arg : args) {
+      columns.push_back(make_column(storage, c, columns.size(), py::reinterpret_borrow<py::object>(arg), shape));
+    }
+
+    if ( out.is_none() ) {
+      out = numpy.attr("empty")(shape, "float64");
+    }
+    auto output = py::array_t<double, py::array::c_style>::ensure(out);
+    if ( ! output || output.ptr() != out.ptr() ) {
+      throw py::type_error("out must be a C-contiguous float64 array");
+    }
+    py::object out_shape = out.attr("shape");
+    if ( ! out_shape.equal(shape) ) {
+      throw py::value_error("out has shape " + py::cast<std::string>(py::str(out_shape))
+          + " but inputs broadcast to " + py::cast<std::string>(py::str(shape)));
+    }
+    double* data = output.mutable_data();
+    const size_t size = output.size();
+    {
+      py::gil_scoped_release release;
+      c.evaluate_batch(size, columns, data, threads, min_chunk);
+    }
+    return out;
+  }
+}
+
 PYBIND11_MODULE(_core, m) {
     m.doc() = "python binding for corrections evaluator";
 
+    m.def("parse_number", &parse_number,
+        py::arg("text"),
+        "Parse a JSON number as the corrections are loaded, for correctionlib.codegen");
+    m.def("formula_source", [](const std::string& expression, const std::vector<size_t>& variables, const std::vector<double>& parameters, bool reference) {
+          auto ast = reference
+            ? FormulaAst::parse_reference(expression, parameters, variables, true)
+            : FormulaAst::parse(FormulaAst::ParserType::TFormula, expression, parameters, variables, true);
+          return ast.simplify(false).source();
+        },
+        py::arg("expression"),
+        py::arg("variables"),
+        py::arg("parameters"),
+        py::arg("reference") = false,
+        R"(Translate a TFormula expression to a C++ expression, for correctionlib.codegen
+
+        variables are the input indices of the formula variables, which appear as
+        x[index] in the result, and parameters are bound as literals.
+        If reference is set, the expression is parsed with the peglib grammar
+        rather than the parser used when loading corrections.
+        )");
+
+    py::class_<StringId>(m, "StringId", "The interned id of a value of a string input, from Correction.string_id")
+        .def_readonly("id", &StringId::id)
+        .def("__eq__", [](const StringId& a, const StringId& b) { return a.id == b.id; }, py::is_operator())
+        .def("__hash__", [](const StringId& a) { return py::hash(py::int_(a.id)); })
+        .def("__repr__", [](const StringId& a) { return "StringId(" + std::to_string(a.id) + ")"; });
+
     py::class_<Correction, std::shared_ptr<Correction>>(m, "Correction")
         .def_property_readonly("name", &Correction::name)
         .def_property_readonly("description", &Correction::description)
         .def_property_readonly("version", &Correction::version)
-        .def("evaluate", [](Correction& c, py::args args) {
-          return c.evaluate(py::cast<std::vector<Variable::Type>>(args));
-        });
+        .def_property_readonly("compiled", &Correction::compiled)
+        .def_property_readonly("definition_hash", &Correction::definition_hash,
+            "Hash of the correction as loaded, which compiled libraries are checked against")
+        .def_property_readonly("loaded", &Correction::loaded,
+            "False if left out by the only argument when loading, so that it cannot be evaluated")
+        .def_property_readonly("inputs", [](const Correction& c) {
+          std::vector<std::string> names;
+          for (const auto& input : c.inputs()) names.push_back(input.name());
+          return names;
+        }, "Names of the inputs, in the order evaluate takes them")
+        .def("leaf_encodings", [](const Correction& c) {
+          std::vector<std::tuple<std::string, std::string, size_t>> out;
+          for (const auto& [type, encoding, size] : c.leaf_encodings()) {
+            out.push_back({
+              ( type == Content::Type::binning ) ? "binning" : "multibinning",
+              ( encoding == LeafEncoding::sparse ) ? "sparse" : ( encoding == LeafEncoding::dictionary ) ? "dictionary" : "plain",
+              size,
+            });
+          }
+          return out;
+        },
+        R"(How the bins of each binning and multibinning node are stored
+
+        Returns a (nodetype, encoding, size) tuple per node, binnings first, each
+        in the order they were loaded (inner nodes before the ones containing them).
+        The encoding is chosen when loading, from the values: "plain" keeps every
+        value, "sparse" the most common value and the positions of the others, and
+        "dictionary" a table of the distinct values and a small index per bin.
+        Size counts the bins, plus the flow value if there is one.
+        )")
+        .def("string_id", [](Correction& c, const std::string& input, const std::string& value) {
+          return StringId{c.string_id(c.input_index(input), value)};
+        },
+        R"(Interned id of a value of a string input (id -1 if it is not a key of any category)
+
+        The StringId may be passed to evaluate in place of the string.
+        )")
+        .def("evaluate", [](Correction& c, py::args args, py::kwargs kwargs) -> py::object {
+          // parsed here, as older pybind11 cannot bind named arguments after py::args
+          py::object out = py::none();
+          size_t threads = 1;
+          size_t min_chunk = 4096;
+          for (const auto& [key, value] : kwargs) {
+            const auto name = py::cast<std::string>(key);
+            if ( name == "out" ) out = py::reinterpret_borrow<py::object>(value);
+            else if ( name == "threads" ) threads = py::cast<size_t>(value);
+            else if ( name == "min_chunk" ) min_chunk = py::cast<size_t>(value);
+            else throw py::type_error("evaluate() got an unexpected keyword argument '" + name + "'");
+          }
+          bool batch = ! out.is_none();
+          for (const auto& arg : args) {
+            batch |= is_batch_input(arg);
+          }
+          if ( batch ) {
+            return evaluate_batch(c, args, out, threads, min_chunk);
+          }
+          auto values = py::cast<std::vector<Variable::Type>>(args);
+          double result;
+          {
+            py::gil_scoped_release release;
+            result = c.evaluate(values);
+          }
+          return py::float_(result);
+        },
+        R"(Evaluate the correction, as evaluate(*inputs, out=None, threads=1, min_chunk=4096)
+
+        Inputs may be python scalars or numpy arrays. If any input is an array,
+        all array inputs are broadcast against each other and any scalar inputs,
+        and the result is returned as a float64 array of the broadcast shape.
+        An existing C-contiguous float64 array of that shape may be passed as out.
+        String inputs may also be given as a pandas Categorical (or category
+        Series), or as a StringId from string_id. Each distinct string of a
+        string array or Categorical is only resolved once per call.
+        Array evaluation releases the GIL and may be split into chunks of at
+        least min_chunk rows over up to threads threads (0: one per core).
+        Each chunk is evaluated node by node, its rows split by the branch they
+        take, so larger chunks give each node and formula more rows at once.
+        )");
 
     py::class_<CorrectionSet>(m, "CorrectionSet")
-        .def_static("from_file", &CorrectionSet::from_file)
-        .def_static("from_string", &CorrectionSet::from_string)
+        .def_static("from_file", [](const std::string& fn, bool fast_math, std::optional<std::string> compiled, size_t threads, bool lazy, std::optional<std::string> cache_dir, std::optional<std::vector<std::string>> only, bool dedup) {
+          LoadOptions options;
+          options.fast_math = fast_math;
+          options.compiled = compiled.value_or("");
+          options.threads = threads;
+          options.lazy = lazy;
+          options.cache_dir = cache_dir.value_or("");
+          if ( only ) options.only.emplace(only->begin(), only->end());
+          options.dedup = dedup;
+          py::gil_scoped_release release;
+          return CorrectionSet::from_file(fn, options);
+        },
+        py::arg("filename"),
+        py::arg("fast_math") = false,
+        py::arg("compiled") = py::none(),
+        py::arg("threads") = 1,
+        py::arg("lazy") = false,
+        py::arg("cache_dir") = py::none(),
+        py::arg("only") = py::none(),
+        py::arg("dedup") = false,
+        R"(Load a CorrectionSet from a JSON file
+
+        The file may be compressed with gzip, xz or zstd, if correctionlib was
+        built with zlib, liblzma or libzstd respectively, and is then
+        decompressed while it is parsed.
+        If fast_math is set, formulas may be optimized in ways that change
+        results in the last bits, such as rewriting integer powers as products,
+        or at special values: x^0.5 is rewritten as sqrt(x), which is NaN at
+        x = -inf and -0 at x = -0, and x + 0 as x, which keeps the sign of -0.
+        compiled may name a shared library built from the same document by
+        correctionlib.codegen, which is then used to evaluate all corrections;
+        it cannot be combined with fast_math.
+        The corrections are built on up to threads threads (0: one per core);
+        with a single thread, they are built while the JSON is parsed, so that
+        the whole document is never held in memory.
+        If lazy is set, each correction is only built when it is first accessed,
+        and any error in its definition is raised then.
+        If cache_dir is given, the binary form (see to_binary) of each file
+        loaded is kept there, and loaded instead when the same file is loaded
+        again.
+        If only is given, only the corrections it names are built, and the data
+        of the others is skipped while parsing: they are still listed, with their
+        name, version and inputs, but cannot be evaluated (see Correction.loaded).
+        Names that are not in the document are an error.
+        The cache_dir is not used then.
+        If dedup is set, identical subtrees within each correction, and identical
+        bin edges across corrections, are only stored once (see dedup_savings).
+        )")
+        .def_static("from_string", [](const char * data, bool fast_math, std::optional<std::string> compiled, size_t threads, bool lazy, std::optional<std::vector<std::string>> only, bool dedup) {
+          LoadOptions options;
+          options.fast_math = fast_math;
+          options.compiled = compiled.value_or("");
+          options.threads = threads;
+          options.lazy = lazy;
+          if ( only ) options.only.emplace(only->begin(), only->end());
+          options.dedup = dedup;
+          py::gil_scoped_release release;
+          return CorrectionSet::from_string(data, options);
+        },
+        py::arg("data"),
+        py::arg("fast_math") = false,
+        py::arg("compiled") = py::none(),
+        py::arg("threads") = 1,
+        py::arg("lazy") = false,
+        py::arg("only") = py::none(),
+        py::arg("dedup") = false,
+        "Load a CorrectionSet from a JSON string; see from_file")
+        .def_static("from_buffer", [](const py::object& data, bool fast_math, std::optional<std::string> compiled, size_t threads, bool lazy, std::optional<std::vector<std::string>> only, bool dedup) {
+          LoadOptions options;
+          options.fast_math = fast_math;
+          options.compiled = compiled.value_or("");
+          options.threads = threads;
+          options.lazy = lazy;
+          if ( only ) options.only.emplace(only->begin(), only->end());
+          options.dedup = dedup;
+          const BufferView buffer(data);
+          py::gil_scoped_release release;
+          return CorrectionSet::from_buffer(buffer.data(), buffer.size(), options);
+        },
+        py::arg("data"),
+        py::arg("fast_math") = false,
+        py::arg("compiled") = py::none(),
+        py::arg("threads") = 1,
+        py::arg("lazy") = false,
+        py::arg("only") = py::none(),
+        py::arg("dedup") = false,
+        R"(Load a CorrectionSet from JSON in a bytes-like object; see from_file
+
+        Any object supporting the buffer protocol with contiguous memory, such as
+        bytes, bytearray, memoryview or mmap.mmap, is read without a copy.
+        Compressed data is recognized as in from_file.
+        )")
+        .def_static("from_binary", [](const py::object& data, std::optional<std::string> compiled) {
+          LoadOptions options;
+          options.compiled = compiled.value_or("");
+          const BufferView buffer(data);
+          py::gil_scoped_release release;
+          return CorrectionSet::from_binary(buffer.data(), buffer.size(), options);
+        },
+        py::arg("data"),
+        py::arg("compiled") = py::none(),
+        R"(Load a CorrectionSet from the output of to_binary, in any bytes-like object
+
+        The data must have been written by a version of correctionlib with the
+        same binary format, on a machine of the same byte order. Formulas keep
+        the fast_math setting they were loaded with.
+        )")
+        .def("to_binary", [](const CorrectionSet& c) {
+          std::string data;
+          {
+            py::gil_scoped_release release;
+            data = c.to_binary();
+          }
+          return py::bytes(data);
+        },
+        "The corrections in a binary form that loads faster than JSON, with formulas already parsed")
         .def_property_readonly("schema_version", &CorrectionSet::schema_version)
+        .def_property_readonly("dedup_savings", &CorrectionSet::dedup_savings,
+            "Approximate bytes saved by loading with dedup, over the corrections built so far")
         .def("__getitem__", &CorrectionSet::at, py::return_value_policy::move)
         .def("__len__", &CorrectionSet::size)
         .def("__iter__", [](const CorrectionSet &v) {
-          return py::make_key_iterator(v.begin(), v.end());
-        }, py::keep_alive<0, 1>());
+          // names only, so that no correction of a lazily loaded set is built
+          py::list names;
+          for (auto it = v.begin(); it != v.end(); ++it) names.append(it.name());
+          return py::iter(names);
+        });
 }
@@ -0,0 +1,308 @@
+import json
+import os
+import shutil
+
+import pytest
+
+import correctionlib._core as core
+from correctionlib import codegen
+from correctionlib import schemav2 as schema
+
+pytestmark = pytest.mark.skipif(
+    shutil.which(os.environ.get("CXX", "c++").split()[0]) is None,
+    reason="no C++ compiler available",
+)
+
+
+def make_cset():
+    return schema.CorrectionSet(
+        schema_version=schema.VERSION,
+        corrections=[
+            schema.Correction(
+                name="test",
+                version=1,
+                inputs=[
+                    schema.Variable(name="syst", type="string"),
+                    schema.Variable(name="flavor", type="int"),
+                    schema.Variable(name="eta", type="real"),
+                    schema.Variable(name="pt", type="real"),
+                ],
+                output=schema.Variable(name="sf", type="real"),
+                generic_formulas=[
+                    schema.Formula(
+                        nodetype="formula",
+                        expression="[0] + [1]*log(x)",
+                        parser="TFormula",
+                        variables=["pt"],
+                    ),
+                ],
+                data=schema.Category(
+                    nodetype="category",
+                    input="syst",
+                    content=[
+                        {
+                            "key": "nominal",
+                            "value": schema.Binning(
+                                nodetype="binning",
+                                input="eta",
+                                edges=[-2.5, -1.5, 0.0, 1.5, 2.5],
+                                content=[
+                                    schema.FormulaRef(
+                                        nodetype="formularef",
+                                        index=0,
+                                        parameters=[1.0, 0.01],
+                                    ),
+                                    schema.Formula(
+                                        nodetype="formula",
+                                        expression="0.9 + 0.1*tanh(y/50)^2",
+                                        parser="TFormula",
+                                        variables=["eta", "pt"],
+                                    ),
+                                    1.05,
+                                    schema.FormulaRef(
+                                        nodetype="formularef",
+                                        index=0,
+                                        parameters=[0.95, 0.02],
+                                    ),
+                                ],
+                                flow="clamp",
+                            ),
+                        },
+                        {
+                            "key": "up",
+                            "value": schema.MultiBinning(
+                                nodetype="multibinning",
+                                inputs=["eta", "pt"],
+                                edges=[
+                                    schema.UniformBinning(n=5, low=-2.5, high=2.5),
+                                    [20.0, 50.0, 100.0],
+                                ],
+                                content=[1.0 + 0.01 * i for i in range(10)],
+                                flow=0.5,
+                            ),
+                        },
+                        {
+                            "key": "down",
+                            "value": schema.Transform(
+                                nodetype="transform",
+                                input="flavor",
+                                rule=schema.Formula(
+                                    nodetype="formula",
+                                    expression="x/2",
+                                    parser="TFormula",
+                                    variables=["eta"],
+                                ),
+                                content=schema.Category(
+                                    nodetype="category",
+                                    input="flavor",
+                                    content=[
+                                        {"key": 0, "value": 0.7},
+                                        {"key": 1, "value": 0.8},
+                                        {"key": -1, "value": 0.9},
+                                    ],
+                                ),
+                            ),
+                        },
+                    ],
+                    default=1.0,
+                ),
+            )
+        ],
+    )
+
+
+def test_codegen(tmp_path):
+    np = pytest.importorskip("numpy")
+    data = make_cset().json()
+    path = codegen.build(data, cache_dir=str(tmp_path))
+    assert codegen.build(data, cache_dir=str(tmp_path)) == path
+    assert os.listdir(str(tmp_path)) == [os.path.basename(path)]
+
+    interpreted = core.CorrectionSet.from_string(data)["test"]
+    compiled = core.CorrectionSet.from_string(data, compiled=path)["test"]
+    assert not interpreted.compiled
+    assert compiled.compiled
+
+    def result(corr, *args):
+        try:
+            return corr.evaluate(*args)
+        except IndexError:
+            return "out of range"
+
+    rng = np.random.default_rng(1)
+    n = 2000
+    syst = rng.choice(["nominal", "up", "down", "other"], size=n)
+    flavor = rng.integers(0, 3, size=n)
+    eta = rng.uniform(-3.5, 3.5, size=n)
+    pt = rng.exponential(40.0, size=n) + 10.0
+    expected = []
+    for args in zip(syst.tolist(), flavor.tolist(), eta.tolist(), pt.tolist()):
+        expected.append(result(interpreted, *args))
+        assert result(compiled, *args) == expected[-1]
+    assert "out of range" in expected
+
+    # same string ids as the interpreter
+    nominal = interpreted.string_id("syst", "nominal")
+    assert compiled.evaluate(nominal, 0, 0.5, 30.0) == interpreted.evaluate(
+        "nominal", 0, 0.5, 30.0
+    )
+    mask = np.array([value != "out of range" for value in expected])
+    assert list(compiled.evaluate(syst[mask], flavor[mask], eta[mask], pt[mask])) == [
+        value for value in expected if value != "out of range"
+    ]
+
+
+def test_codegen_mismatch(tmp_path):
+    cset = make_cset()
+    path = codegen.build(cset.json(), cache_dir=str(tmp_path))
+    cset.corrections[0].name = "other"
+    with pytest.raises(RuntimeError):
+        core.CorrectionSet.from_string(cset.json(), compiled=path)
+    # same name and inputs, different content
+    cset = make_cset()
+    cset.corrections[0].data.default = 99.0
+    with pytest.raises(RuntimeError, match="different definition"):
+        core.CorrectionSet.from_string(cset.json(), compiled=path)
+    with pytest.raises(RuntimeError, match="fast_math"):
+        core.CorrectionSet.from_string(
+            make_cset().json(), compiled=path, fast_math=True
+        )
+    with pytest.raises(RuntimeError):
+        core.CorrectionSet.from_string(
+            make_cset().json(), compiled=str(tmp_path / "missing.so")
+        )
+
+
+def test_codegen_numbers(tmp_path):
+    # not parsed to the correctly rounded double by the evaluator
+    edge = 0.20938417613145166
+    assert core.parse_number(repr(edge)) != edge
+    cset = schema.CorrectionSet(
+        schema_version=schema.VERSION,
+        corrections=[
+            schema.Correction(
+                name="test",
+                version=1,
+                inputs=[schema.Variable(name="x", type="real")],
+                output=schema.Variable(name="y", type="real"),
+                data=schema.Binning(
+                    nodetype="binning",
+                    input="x",
+                    edges=[0.0, edge, 1.0],
+                    content=[1.0, 2.0],
+                    flow="clamp",
+                ),
+            )
+        ],
+    )
+    data = cset.json()
+    path = codegen.build(data, cache_dir=str(tmp_path))
+    interpreted = core.CorrectionSet.from_string(data)["test"]
+    compiled = core.CorrectionSet.from_string(data, compiled=path)["test"]
+    assert compiled.evaluate(edge) == interpreted.evaluate(edge)
+
+
+def test_codegen_duplicate_keys(tmp_path):
+    # not valid in the schema, but accepted by the evaluator
+    category = {
+        "nodetype": "category",
+        "input": "syst",
+        "content": [
+            {"key": "nominal", "value": 1.0},
+            {"key": "nominal", "value": 2.0},
+            {
+                "key": "up",
+                "value": {
+                    "nodetype": "category",
+                    "input": "flavor",
+                    "content": [{"key": 0, "value": 3.0}, {"key": 0, "value": 4.0}],
+                },
+            },
+        ],
+    }
+    data = json.dumps(
+        {
+            "schema_version": schema.VERSION,
+            "corrections": [
+                {
+                    "name": "test",
+                    "version": 1,
+                    "inputs": [
+                        {"name": "syst", "type": "string"},
+                        {"name": "flavor", "type": "int"},
+                    ],
+                    "output": {"name": "y", "type": "real"},
+                    "data": category,
+                }
+            ],
+        }
+    )
+    path = codegen.build(data, cache_dir=str(tmp_path))
+    interpreted = core.CorrectionSet.from_string(data)["test"]
+    compiled = core.CorrectionSet.from_string(data, compiled=path)["test"]
+    assert interpreted.evaluate("nominal", 0) == 1.0
+    assert interpreted.evaluate("up", 0) == 3.0
+    for args in [("nominal", 0), ("up", 0)]:
+        assert compiled.evaluate(*args) == interpreted.evaluate(*args)
+
+
+def test_codegen_errors(tmp_path):
+    # out of bounds values raise the errors of the interpreter
+    cset = schema.CorrectionSet(
+        schema_version=schema.VERSION,
+        corrections=[
+            schema.Correction(
+                name="test",
+                version=1,
+                inputs=[
+                    schema.Variable(name="kind", type="int"),
+                    schema.Variable(name="x", type="real"),
+                    schema.Variable(name="y", type="real"),
+                ],
+                output=schema.Variable(name="z", type="real"),
+                data=schema.Category(
+                    nodetype="category",
+                    input="kind",
+                    content=[
+                        {
+                            "key": 0,
+                            "value": schema.Binning(
+                                nodetype="binning",
+                                input="y",
+                                edges=[0.0, 1.0, 2.0],
+                                content=[1.0, 2.0],
+                                flow="error",
+                            ),
+                        },
+                        {
+                            "key": 1,
+                            "value": schema.MultiBinning(
+                                nodetype="multibinning",
+                                inputs=["x", "y"],
+                                edges=[
+                                    schema.UniformBinning(n=2, low=0.0, high=1.0),
+                                    [0.0, 1.0, 2.0],
+                                ],
+                                content=[1.0, 2.0, 3.0, 4.0],
+                                flow="error",
+                            ),
+                        },
+                    ],
+                ),
+            )
+        ],
+    )
+    data = cset.json()
+    path = codegen.build(data, cache_dir=str(tmp_path))
+    interpreted = core.CorrectionSet.from_string(data)["test"]
+    compiled = core.CorrectionSet.from_string(data, compiled=path)["test"]
+
+    def error(corr, *args):
+        with pytest.raises(RuntimeError) as info:
+            corr.evaluate(*args)
+        return str(info.value)
+
+    for args in [(0, 0.5, -1.0), (0, 0.5, 2.5)]:
+        assert error(compiled, *args) == error(interpreted, *args)
+    for args in [(1, -0.5, 0.5), (1, 1.5, 0.5), (1, 0.5, -1.0), (1, 0.5, 2.5)]:
+        assert error(compiled, *args) == error(interpreted, *args)
@@ -1,6 +1,12 @@
+import bisect
+import gzip
 import json
+import lzma
 import math
+import os
 import platform
+import random
+import struct
 
 import pytest
 
@@ -16,6 +22,23 @@ def wrap(*corrs):
     return core.CorrectionSet.from_string(cset.json())
 
 
+def numbered_correction(i, expression=None, description=None, inputs=None, version=1):
+    """Correction corr{i} of a formula of x, by default i*x"""
+    return schema.Correction(
+        name=f"corr{i}",
+        description=description,
+        version=version,
+        inputs=inputs or [schema.Variable(name="x", type="real")],
+        output=schema.Variable(name="a scale", type="real"),
+        data=schema.Formula(
+            nodetype="formula",
+            expression=expression or f"{i}*x",
+            parser="TFormula",
+            variables=["x"],
+        ),
+    )
+
+
 def test_evaluator_v1():
     with pytest.raises(RuntimeError):
         cset = core.CorrectionSet.from_string("{")
@@ -198,6 +221,9 @@ def test_tformula():
     assert evaluate("1-2+3", [], []) == 2.0
     assert evaluate("(1+2)-(3+4)", [], []) == -4.0
     assert evaluate("3/2*4+1", [], []) == 3.0 / 2.0 * 4.0 + 1
+    # deeper than the fixed-size evaluation stack
+    assert evaluate("(" * 40 + "x" + "+1)" * 40, [1.0], []) == 41.0
+    assert evaluate("[0]*x+[1]", [2.0], [3.0, 0.5]) == 6.5
     assert evaluate("1+3/2*4", [], []) == 1 + 3.0 / 2.0 * 4.0
     assert evaluate("1+4*(3/2+5)", [], []) == 1 + 4 * (3.0 / 2.0 + 5.0)
     assert evaluate("1+2*3/4*5", [], []) == 1 + 2.0 * 3.0 / 4.0 * 5
@@ -652,6 +678,76 @@ def test_tformula():
         )
 
 
+def test_tformula_parsers():
+    # the parser used when loading is cross-checked against the peglib grammar
+    rng = random.Random(1)
+    unary = ["log", "log10", "exp", "erf", "sqrt", "abs", "cos", "sin", "tan"]
+    unary += ["acos", "asin", "atan", "cosh", "sinh", "tanh", "acosh", "asinh", "atanh"]
+    binary = ["atan2", "pow", "max", "min"]
+    operators = ["==", "!=", ">", "<", ">=", "<=", "-", "+", "/", "*", "^"]
+
+    def space():
+        return rng.choice(["", "", " ", "\t"])
+
+    def atom(depth):
+        choice = rng.randrange(8 if depth < 3 else 4)
+        if choice == 0:
+            literal = rng.choice(["", "-"]) + str(rng.randrange(1000))
+            literal += rng.choice(["", ".", ".5", ".25"])
+            return literal + rng.choice(["", "e3", "e-2"])
+        elif choice == 1:
+            return rng.choice("xyzt")
+        elif choice == 2:
+            return "[%s%d%s]" % (space(), rng.randrange(3), space())
+        sign = rng.choice(["", "", "-", "- "])
+        if choice == 3:
+            return sign + rng.choice("xyzt")
+        elif choice < 6:
+            return sign + "%s%s(%s)" % (rng.choice(unary), space(), expression(depth))
+        elif choice == 6:
+            args = (rng.choice(binary), expression(depth), expression(depth))
+            return sign + "%s(%s,%s)" % args
+        return sign + "(%s)" % expression(depth)
+
+    def expression(depth=0):
+        out = space() + atom(depth + 1)
+        for _ in range(rng.randrange(3)):
+            out += space() + rng.choice(operators) + space() + atom(depth + 1)
+        return out + space()
+
+    def source(expr, reference):
+        try:
+            return core.formula_source(expr, [0, 1, 2, 3], [1.5, 2.5, 3.5], reference)
+        except RuntimeError as error:
+            return str(error)
+
+    expressions = [expression() for _ in range(500)]
+    for expr in list(expressions):
+        i = rng.randrange(len(expr))
+        expressions.append(expr[:i] + rng.choice("()[],.e1x") + expr[i + 1 :])
+    expressions += ["", "x)", "(x", "-2^2", "-x^2", "2^3^2", "x--2", "- 2", "1e-"]
+    expressions += ["3x", "[1", "log10(x", "z.", "-]", "[1(", "- (x)cos(y)"]
+    # a binary operator without a valid right operand is dropped
+    expressions += ["x*", "x+ ", "2*x+", "x^", "(x*)", "x*(y+)", "max(x,y*)"]
+    expressions += ["x**", "x*-", "x*y^1e", "x*(y*1e)", "x+)"]
+    failed = 0
+    for expr in expressions:
+        result = source(expr, False)
+        failed += result.startswith("Failed")
+        # including the same error messages
+        assert result == source(expr, True), expr
+    assert 0 < failed < len(expressions) / 2
+    assert source("2^3^2", False) == "0x1p+9"
+    assert source("2*x+", False) == source("2*x", False)
+
+    with pytest.raises(RuntimeError, match="position 2:\n.*\n.*\n.*unexpected '\\)'"):
+        core.formula_source("x)", [0], [])
+    with pytest.raises(
+        RuntimeError, match="position 4:\n.*\n.*\n.*expecting <LITERAL>"
+    ):
+        core.formula_source("1e-", [], [])
+
+
 def test_category():
     def make_cat(items, default):
         cset = wrap(
@@ -695,6 +791,22 @@ def test_category():
     with pytest.raises(RuntimeError):
         corr.evaluate("one")
 
+    # sparse keys use a hash table rather than direct indexing
+    keys = [-(2 ** 31), 7, 1000, 123456, 2 ** 31 - 1] + list(range(-50, 50, 4))
+    corr = make_cat({key: float(i) for i, key in enumerate(keys)}, None)
+    for i, key in enumerate(keys):
+        assert corr.evaluate(key) == float(i)
+    with pytest.raises(IndexError):
+        corr.evaluate(8)
+    corr = make_cat({key: float(i) for i, key in enumerate(keys)}, -1.0)
+    for key in [8, -(2 ** 31) + 1, 2 ** 31 - 2, 0]:
+        assert corr.evaluate(key) == -1.0
+
+    items = {0: 1.0, 4: 2.0, 5: 3.0}
+    corr = make_cat(items, 0.5)
+    for key in range(-2, 8):
+        assert corr.evaluate(key) == items.get(key, 0.5)
+
 
 def test_binning():
     def binning(flow):
@@ -807,6 +919,254 @@ def test_binning():
     assert corr.evaluate(-1.0, 5.0) == 2.0 * -1 + 5.0 * 5.0
     assert corr.evaluate(0.0, 10.0) == 0.0
 
+    # mixed numeric and node content
+    cset = wrap(
+        schema.Correction(
+            name="test",
+            version=2,
+            inputs=[
+                schema.Variable(name="x", type="real"),
+                schema.Variable(name="y", type="real"),
+            ],
+            output=schema.Variable(name="a scale", type="real"),
+            data=schema.MultiBinning(
+                nodetype="multibinning",
+                inputs=["x", "y"],
+                edges=[[0.0, 1.0, 3.0], [10.0, 20.0]],
+                content=[
+                    1.0,
+                    schema.Formula(
+                        nodetype="formula",
+                        expression="x + y",
+                        parser="TFormula",
+                        variables=["x", "y"],
+                    ),
+                ],
+                flow=42.0,
+            ),
+        )
+    )
+    corr = cset["test"]
+    assert corr.evaluate(0.5, 15.0) == 1.0
+    assert corr.evaluate(2.0, 15.0) == 17.0
+    assert corr.evaluate(4.0, 15.0) == 42.0
+
+
+def test_uniform_binning():
+    np = pytest.importorskip("numpy")
+
+    def binning(edges, flow="error"):
+        cset = wrap(
+            schema.Correction(
+                name="test",
+                version=2,
+                inputs=[schema.Variable(name="x", type="real")],
+                output=schema.Variable(name="a scale", type="real"),
+                data=schema.Binning(
+                    nodetype="binning",
+                    input="x",
+                    edges=edges,
+                    content=[float(i) for i in range(10)],
+                    flow=flow,
+                ),
+            )
+        )
+        return cset["test"]
+
+    explicit = [i / 10 for i in range(11)]
+    compact = schema.UniformBinning(n=10, low=0.0, high=1.0)
+    with pytest.raises(ValueError):
+        schema.UniformBinning(n=10, low=1.0, high=0.0)
+    for edges in (explicit, compact):
+        corr = binning(edges)
+        for i, edge in enumerate(explicit[:-1]):
+            assert corr.evaluate(edge) == float(i)
+            assert corr.evaluate(edge + 0.05) == float(i)
+        assert corr.evaluate(float(np.nextafter(1.0, 0.0))) == 9.0
+        with pytest.raises(RuntimeError):
+            corr.evaluate(float(np.nextafter(0.0, -1.0)))
+        with pytest.raises(RuntimeError):
+            corr.evaluate(1.0)
+
+    corr = binning(compact, flow=42.0)
+    assert corr.evaluate(-0.1) == 42.0
+    assert corr.evaluate(1.0) == 42.0
+    assert corr.evaluate(float("nan")) == 42.0
+    corr = binning(compact, flow="clamp")
+    assert corr.evaluate(-0.1) == 0.0
+    assert corr.evaluate(1.0) == 9.0
+
+    # nearly uniform edges must still resolve exactly as written
+    edges = [i / 10 for i in range(11)]
+    edges[5] = float(np.nextafter(0.5, 1.0))
+    corr = binning(edges)
+    assert corr.evaluate(0.5) == 4.0
+    assert corr.evaluate(edges[5]) == 5.0
+
+    cset = wrap(
+        schema.Correction(
+            name="test",
+            version=2,
+            inputs=[
+                schema.Variable(name="x", type="real"),
+                schema.Variable(name="y", type="real"),
+            ],
+            output=schema.Variable(name="a scale", type="real"),
+            data=schema.MultiBinning(
+                nodetype="multibinning",
+                inputs=["x", "y"],
+                edges=[
+                    [0.0, 1.0, 3.0],
+                    {"n": 3, "low": 10.0, "high": 40.0},
+                ],
+                content=[float(i) for i in range(2 * 3)],
+                flow="error",
+            ),
+        )
+    )
+    corr = cset["test"]
+    assert corr.evaluate(0.0, 10.0) == 0.0
+    assert corr.evaluate(0.0, 20.0) == 1.0
+    assert corr.evaluate(1.0, 39.0) == 5.0
+    with pytest.raises(RuntimeError):
+        corr.evaluate(0.0, 40.0)
+
+
+def test_binning_search():
+    np = pytest.importorskip("numpy")
+    rng = random.Random(3)
+    # a branch-free count, a binary search and a tree descent, by number of edges
+    for nedges in (5, 100, 3000):
+        # exact in decimal, so as to be parsed exactly
+        edges = sorted(rng.sample(range(-6400, 6400), nedges))
+        edges = [edge / 64 for edge in edges]
+        corr = wrap(
+            schema.Correction(
+                name="test",
+                version=2,
+                inputs=[schema.Variable(name="x", type="real")],
+                output=schema.Variable(name="a scale", type="real"),
+                data=schema.Binning(
+                    nodetype="binning",
+                    input="x",
+                    edges=edges,
+                    content=[float(i) for i in range(nedges - 1)],
+                    flow=-1.0,
+                ),
+            )
+        )["test"]
+
+        def expected(x):
+            i = bisect.bisect_right(edges, x)
+            return float(i - 1) if 0 < i < nedges else -1.0
+
+        values = [rng.uniform(-110.0, 110.0) for _ in range(500)]
+        values += edges + np.nextafter(edges, -math.inf).tolist()
+        values += [-math.inf, math.inf, float("nan")]
+        for x in values:
+            assert corr.evaluate(x) == expected(x)
+        assert list(corr.evaluate(np.array(values))) == [expected(x) for x in values]
+
+
+def test_formula_optimization():
+    def load(expr, parameters, fast_math):
+        cset = schema.CorrectionSet(
+            schema_version=schema.VERSION,
+            corrections=[
+                schema.Correction(
+                    name="test",
+                    version=1,
+                    inputs=[schema.Variable(name="x", type="real")],
+                    output=schema.Variable(name="f", type="real"),
+                    data=schema.Formula(
+                        nodetype="formula",
+                        expression=expr,
+                        parser="TFormula",
+                        variables=["x"],
+                        parameters=parameters,
+                    ),
+                )
+            ],
+        )
+        return core.CorrectionSet.from_string(cset.json(), fast_math=fast_math)["test"]
+
+    expr = "[0]*[1]*x + log(x)*log(x) + (x+1)^3 - pow(x, 0.5) + pow(x, -2)*1 + 0"
+
+    def expected(x):
+        return (
+            2.0 * 3.0 * x
+            + math.log(x) * math.log(x)
+            + math.pow(x + 1, 3)
+            - math.pow(x, 0.5)
+            + math.pow(x, -2)
+            + 0.0
+        )
+
+    exact = load(expr, [2.0, 3.0], False)
+    fast = load(expr, [2.0, 3.0], True)
+    for x in [0.3, 1.0, 2.5, 17.0, 1234.5]:
+        assert exact.evaluate(x) == expected(x)
+        assert fast.evaluate(x) == pytest.approx(expected(x))
+
+    # -0 + 0 is +0, which only fast_math may drop
+    assert math.copysign(1.0, load("x + 0", None, False).evaluate(-0.0)) == 1.0
+    assert math.copysign(1.0, load("x + 0", None, True).evaluate(-0.0)) == -1.0
+    assert load("x - 0", None, False).evaluate(-0.0) == 0.0
+    assert math.isnan(load("x^0 * x", None, False).evaluate(math.nan))
+    # as sqrt(x), x^0.5 is NaN at -inf, and keeps the sign of -0
+    assert load("x^0.5", None, False).evaluate(-math.inf) == math.inf
+    assert math.isnan(load("x^0.5", None, True).evaluate(-math.inf))
+    assert math.copysign(1.0, load("x^0.5", None, False).evaluate(-0.0)) == 1.0
+    assert math.copysign(1.0, load("x^0.5", None, True).evaluate(-0.0)) == -1.0
+
+
+def test_formula_shared_expression():
+    # the parse of an expression is shared, but not its variables and parameters
+    formula = {
+        "nodetype": "formula",
+        "expression": "[0]*x + y",
+        "parser": "TFormula",
+    }
+    cset = wrap(
+        schema.Correction(
+            name="test",
+            version=1,
+            inputs=[
+                schema.Variable(name="a", type="real"),
+                schema.Variable(name="b", type="real"),
+                schema.Variable(name="i", type="int"),
+            ],
+            output=schema.Variable(name="f", type="real"),
+            data=schema.Category(
+                nodetype="category",
+                input="i",
+                content=[
+                    {
+                        "key": 0,
+                        "value": dict(formula, variables=["a", "b"], parameters=[2.0]),
+                    },
+                    {
+                        "key": 1,
+                        "value": dict(formula, variables=["b", "a"], parameters=[3.0]),
+                    },
+                ],
+            ),
+        )
+    )
+    corr = cset["test"]
+    assert corr.evaluate(1.0, 10.0, 0) == 12.0
+    assert corr.evaluate(1.0, 10.0, 1) == 31.0
+    with pytest.raises(RuntimeError):
+        wrap(
+            schema.Correction(
+                name="test",
+                version=1,
+                inputs=[schema.Variable(name="a", type="real")],
+                output=schema.Variable(name="f", type="real"),
+                data=dict(formula, variables=["a"], parameters=[2.0]),
+            )
+        )
+
 
 def test_formularef():
     cset = wrap(
@@ -849,6 +1209,27 @@ def test_formularef():
     assert corr.evaluate(1.5) == 1.1 + -0.2 * 1.5
     assert corr.evaluate(2.5) == 3.1 + 0.5 * 2.5
 
+    with pytest.raises(RuntimeError):
+        wrap(
+            schema.Correction(
+                name="reftest",
+                version=2,
+                inputs=[schema.Variable(name="x", type="real")],
+                output=schema.Variable(name="a scale", type="real"),
+                generic_formulas=[
+                    schema.Formula(
+                        nodetype="formula",
+                        expression="[0] + [1]*x",
+                        parser="TFormula",
+                        variables=["x"],
+                    ),
+                ],
+                data=schema.FormulaRef(
+                    nodetype="formularef", index=0, parameters=[0.1]
+                ),
+            )
+        )
+
 
 def test_transform():
     cset = wrap(
@@ -918,3 +1299,1122 @@ def test_transform():
         corr.evaluate(3)
     assert corr.evaluate(9) == 0.1
     assert corr.evaluate(10) == 0.1
+
+    # nested transforms, with strings passed through
+    cset = wrap(
+        schema.Correction(
+            name="test",
+            version=2,
+            inputs=[
+                schema.Variable(name="syst", type="string"),
+                schema.Variable(name="x", type="real"),
+                schema.Variable(name="y", type="real"),
+            ],
+            output=schema.Variable(name="a scale", type="real"),
+            data=schema.Transform(
+                nodetype="transform",
+                input="x",
+                rule=schema.Formula(
+                    nodetype="formula",
+                    expression="2*x",
+                    parser="TFormula",
+                    variables=["x"],
+                ),
+                content=schema.Transform(
+                    nodetype="transform",
+                    input="y",
+                    rule=schema.Formula(
+                        nodetype="formula",
+                        expression="x + y",
+                        parser="TFormula",
+                        variables=["x", "y"],
+                    ),
+                    content=schema.Category(
+                        nodetype="category",
+                        input="syst",
+                        content=[
+                            {
+                                "key": "central",
+                                "value": schema.Formula(
+                                    nodetype="formula",
+                                    expression="100*x + y",
+                                    parser="TFormula",
+                                    variables=["x", "y"],
+                                ),
+                            }
+                        ],
+                    ),
+                ),
+            ),
+        )
+    )
+    corr = cset["test"]
+    assert corr.evaluate("central", 1.0, 3.0) == 100 * 2.0 + (2.0 + 3.0)
+    assert corr.evaluate("central", 2.0, 1.0) == 100 * 4.0 + (4.0 + 1.0)
+    with pytest.raises(IndexError):
+        corr.evaluate("up", 2.0, 1.0)
+    assert corr.evaluate("central", 0.5, 0.0) == 100 * 1.0 + 1.0
+
+
+def test_evaluate_batch():
+    np = pytest.importorskip("numpy")
+    cset = wrap(
+        schema.Correction(
+            name="test",
+            version=2,
+            inputs=[
+                schema.Variable(name="syst", type="string"),
+                schema.Variable(name="flavor", type="int"),
+                schema.Variable(name="pt", type="real"),
+            ],
+            output=schema.Variable(name="a scale", type="real"),
+            data=schema.Category(
+                nodetype="category",
+                input="syst",
+                content=[
+                    {
+                        "key": "central",
+                        "value": schema.Binning(
+                            nodetype="binning",
+                            input="pt",
+                            edges=[0.0, 10.0, 20.0],
+                            content=[
+                                schema.Formula(
+                                    nodetype="formula",
+                                    expression="1 + 0.1*x",
+                                    parser="TFormula",
+                                    variables=["pt"],
+                                ),
+                                2.0,
+                            ],
+                            flow="clamp",
+                        ),
+                    },
+                    {
+                        "key": "up",
+                        "value": schema.Category(
+                            nodetype="category",
+                            input="flavor",
+                            content=[{"key": 5, "value": 3.0}],
+                            default=4.0,
+                        ),
+                    },
+                ],
+            ),
+        )
+    )
+    corr = cset["test"]
+    pt = np.array([1.0, 5.0, 15.0, 25.0])
+    expected = np.array([1.1, 1.5, 2.0, 2.0])
+    out = corr.evaluate("central", 0, pt)
+    assert isinstance(out, np.ndarray)
+    assert out.shape == (4,)
+    assert np.allclose(out, expected)
+    assert [corr.evaluate("central", 0, x) for x in pt] == list(out)
+
+    flavor = np.array([5, 0, 5, 4])
+    assert np.array_equal(corr.evaluate("up", flavor, pt), [3.0, 4.0, 3.0, 4.0])
+    syst = np.array(["central", "up", "up", "central"])
+    assert np.allclose(corr.evaluate(syst, flavor, pt), [1.1, 4.0, 3.0, 2.0])
+
+    # broadcasting
+    out = corr.evaluate("central", 0, pt.reshape(2, 2))
+    assert out.shape == (2, 2)
+    assert np.allclose(out.ravel(), expected)
+    out = corr.evaluate(syst[:, None], 5, pt[None, :])
+    assert out.shape == (4, 4)
+    assert np.allclose(out[0], expected)
+    assert np.allclose(out[1], 3.0)
+
+    out = np.zeros(4)
+    res = corr.evaluate("central", 0, pt, out=out)
+    assert res is out
+    assert np.allclose(out, expected)
+    with pytest.raises(TypeError):
+        corr.evaluate("central", 0, pt, out=np.zeros(4, dtype=np.float32))
+    with pytest.raises(ValueError):
+        corr.evaluate("central", 0, pt, out=np.zeros(3))
+
+    with pytest.raises(RuntimeError):
+        # wrong type
+        corr.evaluate("central", 0.0, pt)
+    with pytest.raises(RuntimeError):
+        corr.evaluate("central", pt)
+    with pytest.raises(IndexError):
+        corr.evaluate(np.array(["central", "down"]), 0, 1.0)
+    # integers that do not fit in an int are an error, as scalars, not wrapped
+    with pytest.raises(RuntimeError, match="wrong type"):
+        corr.evaluate("up", 2 ** 32 + 5, 1.0)
+    with pytest.raises(RuntimeError, match="wrong type"):
+        corr.evaluate("up", np.array([5, 2 ** 32 + 5]), 1.0)
+    with pytest.raises(RuntimeError, match="wrong type"):
+        corr.evaluate("up", np.array([5, 2 ** 31], dtype=np.uint32), 1.0)
+    flavor = np.array([5, 2 ** 31 - 1], dtype=np.uint64)
+    assert np.array_equal(corr.evaluate("up", flavor, 1.0), [3.0, 4.0])
+
+
+def test_evaluate_batch_formulas():
+    np = pytest.importorskip("numpy")
+    cset = wrap(
+        schema.Correction(
+            name="test",
+            version=2,
+            inputs=[
+                schema.Variable(name="eta", type="real"),
+                schema.Variable(name="pt", type="real"),
+            ],
+            output=schema.Variable(name="a scale", type="real"),
+            generic_formulas=[
+                schema.Formula(
+                    nodetype="formula",
+                    expression="[0] + [1]*log(x) + [2]*log(x)^2 + [3]/sqrt(x)",
+                    parser="TFormula",
+                    variables=["pt"],
+                ),
+            ],
+            data=schema.Binning(
+                nodetype="binning",
+                input="eta",
+                edges=[-2.5, -1.0, 0.0, 1.0, 2.5],
+                content=[
+                    schema.FormulaRef(
+                        nodetype="formularef", index=0, parameters=[1.0, 0.1, 0.01, 2.0]
+                    ),
+                    schema.FormulaRef(
+                        nodetype="formularef",
+                        index=0,
+                        parameters=[0.9, 0.2, -0.01, 1.0],
+                    ),
+                    schema.Formula(
+                        nodetype="formula",
+                        expression="max(min(x, 2), -2)*atan2(y, 10) + exp(-y/100)",
+                        parser="TFormula",
+                        variables=["eta", "pt"],
+                    ),
+                    1.5,
+                ],
+                flow="clamp",
+            ),
+        )
+    )
+    corr = cset["test"]
+    rng = np.random.default_rng(42)
+    eta = rng.uniform(-3, 3, size=5000)
+    pt = rng.exponential(50.0, size=5000) + 15.0
+    out = corr.evaluate(eta, pt, min_chunk=1000)
+    assert list(out) == [corr.evaluate(e, p) for e, p in zip(eta, pt)]
+    # too few rows to evaluate column-wise
+    assert list(corr.evaluate(eta[:20], pt[:20])) == list(out[:20])
+
+
+def test_evaluate_batch_partitioned():
+    np = pytest.importorskip("numpy")
+
+    def formula(expression, variables):
+        return schema.Formula(
+            nodetype="formula",
+            expression=expression,
+            parser="TFormula",
+            variables=variables,
+        )
+
+    fine = [i / 10 for i in range(-30, 31)]
+    cset = wrap(
+        schema.Correction(
+            name="test",
+            version=2,
+            inputs=[
+                schema.Variable(name="syst", type="string"),
+                schema.Variable(name="flavor", type="int"),
+                schema.Variable(name="eta", type="real"),
+                schema.Variable(name="pt", type="real"),
+            ],
+            output=schema.Variable(name="a scale", type="real"),
+            data=schema.Category(
+                nodetype="category",
+                input="syst",
+                content=[
+                    schema.CategoryItem(
+                        key="nested",
+                        value=schema.Binning(
+                            nodetype="binning",
+                            input="eta",
+                            edges=[-3.0, -1.0, 0.0, 1.0, 3.0],
+                            content=[
+                                formula("1 + x/100", ["pt"]),
+                                schema.MultiBinning(
+                                    nodetype="multibinning",
+                                    inputs=["eta", "pt"],
+                                    edges=[[-1.0, -0.5, 0.0], [0.0, 50.0, 1000.0]],
+                                    content=[
+                                        formula("x*y", ["eta", "pt"]),
+                                        0.5,
+                                        schema.Category(
+                                            nodetype="category",
+                                            input="flavor",
+                                            content=[
+                                                schema.CategoryItem(key=0, value=0.1),
+                                                schema.CategoryItem(
+                                                    key=5, value=formula("x", ["pt"])
+                                                ),
+                                            ],
+                                            default=0.3,
+                                        ),
+                                        0.7,
+                                    ],
+                                    flow=formula("2*x", ["eta"]),
+                                ),
+                                schema.Transform(
+                                    nodetype="transform",
+                                    input="pt",
+                                    rule=formula("x/2", ["pt"]),
+                                    content=formula("x", ["pt"]),
+                                ),
+                                schema.MultiBinning(
+                                    nodetype="multibinning",
+                                    inputs=["eta", "pt"],
+                                    edges=[
+                                        [1.0, 2.0, 3.0],
+                                        {"n": 4, "low": 0.0, "high": 400.0},
+                                    ],
+                                    content=[float(i) for i in range(8)],
+                                    flow=-1.0,
+                                ),
+                            ],
+                            flow="error",
+                        ),
+                    ),
+                    schema.CategoryItem(
+                        key="transform",
+                        value=schema.Transform(
+                            nodetype="transform",
+                            input="flavor",
+                            # rounded to an int
+                            rule=schema.Binning(
+                                nodetype="binning",
+                                input="eta",
+                                edges=[-3.0, 0.0, 1.0, 3.0],
+                                content=[formula("x/50", ["pt"]), 5.4, 0.0],
+                                flow="clamp",
+                            ),
+                            content=schema.Category(
+                                nodetype="category",
+                                input="flavor",
+                                content=[
+                                    schema.CategoryItem(
+                                        key=0,
+                                        value=schema.Transform(
+                                            nodetype="transform",
+                                            input="eta",
+                                            rule=formula("-x", ["eta"]),
+                                            content=schema.Binning(
+                                                nodetype="binning",
+                                                input="eta",
+                                                edges=[-3.0, 0.0, 3.0],
+                                                content=[formula("x", ["pt"]), 2.0],
+                                                flow="clamp",
+                                            ),
+                                        ),
+                                    ),
+                                    schema.CategoryItem(key=1, value=0.1),
+                                    schema.CategoryItem(
+                                        key=5, value=formula("x + y", ["eta", "pt"])
+                                    ),
+                                ],
+                                default=0.3,
+                            ),
+                        ),
+                    ),
+                    schema.CategoryItem(
+                        key="fine",
+                        # more branches than rows reach it in a small batch
+                        value=schema.Binning(
+                            nodetype="binning",
+                            input="eta",
+                            edges=fine,
+                            content=[
+                                formula(f"{i} + x", ["pt"])
+                                for i in range(len(fine) - 1)
+                            ],
+                            flow="clamp",
+                        ),
+                    ),
+                ],
+                default=schema.Binning(
+                    nodetype="binning",
+                    input="pt",
+                    edges=[0.0, 100.0, 200.0],
+                    content=[formula("x", ["eta"]), 2.0],
+                    flow=3.0,
+                ),
+            ),
+        )
+    )
+    corr = cset["test"]
+    rng = np.random.default_rng(7)
+    n = 20000
+    syst = rng.choice(["nested", "transform", "fine", "other"], size=n)
+    flavor = rng.choice([0, 5, 3], size=n)
+    eta = rng.uniform(-2.999, 2.999, size=n)
+    pt = rng.exponential(100.0, size=n)
+    for rows in (slice(None), slice(0, 40)):
+        args = (syst[rows], flavor[rows], eta[rows], pt[rows])
+        expected = [corr.evaluate(*row) for row in zip(*(a.tolist() for a in args))]
+        assert list(corr.evaluate(*args)) == expected
+        assert list(corr.evaluate(*args, min_chunk=1000, threads=2)) == expected
+
+    # a row out of range fails the batch as it fails on its own
+    eta[123] = 5.0
+    with pytest.raises(RuntimeError, match="Index above bounds in Binning"):
+        corr.evaluate(np.array(["nested"] * n), flavor, eta, pt)
+
+
+def test_string_ids():
+    np = pytest.importorskip("numpy")
+    cset = wrap(
+        schema.Correction(
+            name="test",
+            version=2,
+            inputs=[
+                schema.Variable(name="syst", type="string"),
+                schema.Variable(name="x", type="real"),
+            ],
+            output=schema.Variable(name="a scale", type="real"),
+            data=schema.Category(
+                nodetype="category",
+                input="syst",
+                content=[
+                    {"key": "central", "value": 1.0},
+                    {
+                        "key": "up",
+                        "value": schema.Category(
+                            nodetype="category",
+                            input="syst",
+                            content=[{"key": "up", "value": 2.0}],
+                        ),
+                    },
+                ],
+                default=3.0,
+            ),
+        ),
+        schema.Correction(
+            name="other",
+            version=1,
+            inputs=[schema.Variable(name="syst", type="string")],
+            output=schema.Variable(name="a scale", type="real"),
+            data=schema.Category(
+                nodetype="category",
+                input="syst",
+                content=[{"key": key, "value": 1.0} for key in "abc"],
+            ),
+        ),
+    )
+    corr = cset["test"]
+    central = corr.string_id("syst", "central")
+    up = corr.string_id("syst", "up")
+    down = corr.string_id("syst", "down")
+    assert central.id >= 0 and up.id >= 0 and central != up
+    assert down.id == -1 and down == corr.string_id("syst", "left")
+    with pytest.raises(RuntimeError):
+        corr.string_id("x", "central")
+    assert corr.evaluate(central, 0.0) == 1.0
+    assert corr.evaluate(up, 0.0) == 2.0
+    assert corr.evaluate(down, 0.0) == 3.0
+    assert corr.evaluate("down", 0.0) == 3.0
+    # ids are only taken when given as such, and must be in the table
+    with pytest.raises(RuntimeError, match="wrong type: got int expected string"):
+        corr.evaluate(central.id, 0.0)
+    with pytest.raises(RuntimeError, match="wrong type: got int expected string"):
+        corr.evaluate(np.array([central.id]), 0.0)
+    with pytest.raises(IndexError, match="no string with id 2"):
+        corr.evaluate(cset["other"].string_id("syst", "c"), 0.0)
+    with pytest.raises(IndexError, match="no string with id 2"):
+        corr.evaluate(cset["other"].string_id("syst", "c"), np.zeros(3))
+
+    syst = np.array(["up", "central", "down", "up"])
+    expected = [2.0, 1.0, 3.0, 2.0]
+    assert np.array_equal(corr.evaluate(syst, 0.0), expected)
+    assert np.array_equal(corr.evaluate(syst.astype(object), 0.0), expected)
+    assert np.array_equal(corr.evaluate(up, np.zeros(2)), [2.0, 2.0])
+
+    pd = pytest.importorskip("pandas")
+    cat = pd.Categorical(["up", "central", None, "down", "up"])
+    expected = [2.0, 1.0, 3.0, 3.0, 2.0]
+    assert np.array_equal(corr.evaluate(cat, 0.0), expected)
+    assert np.array_equal(corr.evaluate(pd.Series(cat), np.zeros(5)), expected)
+    with pytest.raises(TypeError):
+        corr.evaluate("up", cat)
+
+
+def test_evaluate_threads():
+    np = pytest.importorskip("numpy")
+    cset = wrap(
+        schema.Correction(
+            name="test",
+            version=2,
+            inputs=[schema.Variable(name="x", type="real")],
+            output=schema.Variable(name="a scale", type="real"),
+            data=schema.Binning(
+                nodetype="binning",
+                input="x",
+                edges=[0.0, 1.0, 2.0],
+                content=[
+                    schema.Formula(
+                        nodetype="formula",
+                        expression="x*x",
+                        parser="TFormula",
+                        variables=["x"],
+                    ),
+                    2.0,
+                ],
+                flow="error",
+            ),
+        )
+    )
+    corr = cset["test"]
+    x = np.linspace(0.0, 1.999, 100_001)
+    expected = np.where(x < 1.0, x * x, 2.0)
+    for threads in [0, 1, 4]:
+        out = corr.evaluate(x, threads=threads, min_chunk=1000)
+        assert np.array_equal(out, expected)
+
+    x[50_000] = 5.0
+    with pytest.raises(RuntimeError):
+        corr.evaluate(x, threads=4, min_chunk=100)
+    with pytest.raises(TypeError, match="unexpected keyword argument 'thread'"):
+        corr.evaluate(x, thread=4)
+
+
+def test_load_threads():
+    data = schema.CorrectionSet(
+        schema_version=schema.VERSION,
+        corrections=[
+            numbered_correction(i, expression=f"{i}*x + sqrt(x)^{i % 3}")
+            for i in range(50)
+        ],
+    ).json()
+    serial = core.CorrectionSet.from_string(data)
+    for threads in [0, 4]:
+        cset = core.CorrectionSet.from_string(data, threads=threads)
+        assert list(cset) == list(serial)
+        for name in cset:
+            assert cset[name].evaluate(2.0) == serial[name].evaluate(2.0)
+
+    broken = json.loads(data)
+    broken["corrections"][25]["data"]["expression"] = "x +* 2"
+    with pytest.raises(RuntimeError):
+        core.CorrectionSet.from_string(json.dumps(broken), threads=4)
+
+
+def test_load_streaming():
+    # threads=1 builds the corrections while the JSON is parsed
+    corr = schema.Correction(
+        name="test",
+        version=1,
+        inputs=[
+            schema.Variable(name="x", type="real"),
+            schema.Variable(name="syst", type="string"),
+        ],
+        output=schema.Variable(name="a scale", type="real"),
+        data=schema.Binning(
+            nodetype="binning",
+            input="x",
+            edges=[0.0, 1.0, 2.0, 3.0],
+            content=[
+                schema.MultiBinning(
+                    nodetype="multibinning",
+                    inputs=["x", "x"],
+                    edges=[
+                        schema.UniformBinning(n=2, low=0.0, high=1.0),
+                        [0.0, 0.5, 1.0],
+                    ],
+                    content=[
+                        1.0,
+                        schema.Formula(
+                            nodetype="formula",
+                            expression="2*x",
+                            parser="TFormula",
+                            variables=["x"],
+                        ),
+                        3.0,
+                        4.0,
+                    ],
+                    flow="clamp",
+                ),
+                schema.MultiBinning(
+                    nodetype="multibinning",
+                    inputs=["x"],
+                    edges=[[1.0, 1.5, 2.0]],
+                    content=[5.0, 6.0],
+                    flow="error",
+                ),
+                7.0,
+            ],
+            flow=schema.Category(
+                nodetype="category",
+                input="syst",
+                content=[
+                    schema.CategoryItem(key="up", value=8.0),
+                    schema.CategoryItem(key="down", value=9.0),
+                ],
+            ),
+        ),
+    )
+    data = schema.CorrectionSet(
+        schema_version=schema.VERSION, corrections=[corr]
+    ).json()
+    # the same layout, with the keys of each object sorted: read whole instead
+    reordered = json.dumps(json.loads(data), sort_keys=True)
+    points = [(0.2, "up"), (0.7, "up"), (1.2, "up"), (1.7, "up"), (2.5, "up")]
+    points += [(-1.0, "up"), (4.0, "down")]
+    for text in [data, reordered]:
+        expected = core.CorrectionSet.from_string(text, threads=2)
+        loaded = core.CorrectionSet.from_string(text, threads=1)
+        assert loaded.to_binary() == expected.to_binary()
+        for point in points:
+            assert loaded["test"].evaluate(*point) == expected["test"].evaluate(*point)
+        down = loaded["test"].string_id("syst", "down")
+        assert down == expected["test"].string_id("syst", "down")
+    assert core.CorrectionSet.from_string(data)["test"].evaluate(0.7, "up") == 4.0
+
+    # errors are those of the whole document being parsed
+    for broken in [data[:-1], data[:500] + "," + data[500:], data + "{}"]:
+        messages = []
+        for threads in [1, 2]:
+            with pytest.raises(RuntimeError) as ex:
+                core.CorrectionSet.from_string(broken, threads=threads)
+            messages.append(str(ex.value))
+        assert messages[0] == messages[1]
+        assert "JSON parse error" in messages[0]
+    broken = data.replace("5.0, 6.0", "5, 6")
+    with pytest.raises(RuntimeError, match="Unrecognized Content node type"):
+        core.CorrectionSet.from_string(broken, threads=1)
+
+
+def test_load_lazy(tmp_path):
+    description = 'with } and " in a string'
+    cset = json.loads(
+        schema.CorrectionSet(
+            schema_version=schema.VERSION,
+            corrections=[
+                numbered_correction(i, description=description) for i in range(10)
+            ],
+        ).json()
+    )
+    cset["corrections"][3]["data"]["expression"] = "x +* 2"
+    data = json.dumps(cset, indent=2)
+    with pytest.raises(RuntimeError):
+        core.CorrectionSet.from_string(data)
+
+    path = tmp_path / "corrections.json"
+    path.write_text(data)
+    for lazy in [
+        core.CorrectionSet.from_string(data, lazy=True),
+        core.CorrectionSet.from_file(str(path), lazy=True),
+    ]:
+        assert lazy.schema_version == schema.VERSION
+        assert len(lazy) == 10
+        assert list(lazy) == sorted(f"corr{i}" for i in range(10))
+        assert lazy["corr7"].evaluate(2.0) == 14.0
+        assert lazy["corr7"] is lazy["corr7"]
+        assert lazy["corr7"].description == description
+        with pytest.raises(RuntimeError, match="Failed to parse Formula"):
+            lazy["corr3"]
+        with pytest.raises(IndexError):
+            lazy["missing"]
+        for name in lazy:
+            if name != "corr3":
+                assert lazy[name].evaluate(1.0) == float(name[4:])
+
+    cset["schema_version"] = 1
+    with pytest.raises(RuntimeError, match="not backward-compatible"):
+        core.CorrectionSet.from_string(json.dumps(cset), lazy=True)
+    with pytest.raises(RuntimeError, match="JSON parse error"):
+        core.CorrectionSet.from_string(data[:-10], lazy=True)
+
+
+def test_load_only(tmp_path):
+    def make(i):
+        corr = numbered_correction(
+            i,
+            inputs=[
+                schema.Variable(name="x", type="real"),
+                schema.Variable(name="syst", type="string"),
+            ],
+            version=i,
+        )
+        corr.data = schema.Category(
+            nodetype="category",
+            input="syst",
+            content=[
+                schema.CategoryItem(key="nominal", value=corr.data),
+                # skipped over without being parsed
+                schema.CategoryItem(key='with ]} and \\" in a string', value=1.0),
+            ],
+        )
+        return corr
+
+    cset = json.loads(
+        schema.CorrectionSet(
+            schema_version=schema.VERSION,
+            corrections=[make(i) for i in range(10)],
+        ).json()
+    )
+    # the data of the corrections left out is not even looked at
+    cset["corrections"][3]["data"]["content"][0]["value"]["expression"] = "x +* 2"
+    data = json.dumps(cset)
+    path = tmp_path / "corrections.json"
+    path.write_text(data)
+    for loaded in [
+        core.CorrectionSet.from_string(data, only=["corr1", "corr7"]),
+        core.CorrectionSet.from_string(data, only=["corr1", "corr7"], threads=2),
+        core.CorrectionSet.from_string(data, only=["corr1", "corr7"], lazy=True),
+        core.CorrectionSet.from_file(
+            str(path), only=["corr1", "corr7"], cache_dir=str(tmp_path)
+        ),
+    ]:
+        assert list(loaded) == sorted(f"corr{i}" for i in range(10))
+        assert loaded["corr7"].loaded
+        assert loaded["corr7"].evaluate(2.0, "nominal") == 14.0
+        assert loaded["corr1"].string_id("syst", "nominal").id == 0
+        skipped = loaded["corr3"]
+        assert not skipped.loaded
+        assert skipped.name == "corr3"
+        assert skipped.version == 3
+        assert skipped.inputs == ["x", "syst"]
+        with pytest.raises(RuntimeError, match="Correction corr3 was not loaded"):
+            skipped.evaluate(2.0, "nominal")
+        with pytest.raises(RuntimeError, match="was not loaded"):
+            loaded.to_binary()
+    assert os.listdir(str(tmp_path)) == ["corrections.json"]
+    assert core.CorrectionSet.from_string(data, only=[])["corr1"].inputs == [
+        "x",
+        "syst",
+    ]
+    with pytest.raises(RuntimeError, match="Failed to parse Formula"):
+        core.CorrectionSet.from_string(data, only=["corr3"])
+    # a misspelt name is not silently ignored
+    for kwargs in [{}, {"threads": 2}, {"lazy": True}]:
+        with pytest.raises(RuntimeError, match="Correction corr10 to load"):
+            core.CorrectionSet.from_string(data, only=["corr1", "corr10"], **kwargs)
+    with pytest.raises(RuntimeError, match="JSON parse error"):
+        core.CorrectionSet.from_string(data[: data.index("]}") + 1], only=["corr9"])
+
+
+def test_load_dedup():
+    def pt_binning(i):
+        return schema.Binning(
+            nodetype="binning",
+            input="pt",
+            edges=[20.0, 30.0, 50.0, 100.0],
+            content=[1.0 + i, 2.0 + i, 3.0],
+            flow="clamp",
+        )
+
+    def make(name):
+        nominal = schema.Binning(
+            nodetype="binning",
+            input="eta",
+            edges=[-2.5, 0.0, 2.5],
+            content=[pt_binning(0), pt_binning(1)],
+            flow="clamp",
+        )
+        return schema.Correction(
+            name=name,
+            version=1,
+            inputs=[
+                schema.Variable(name="syst", type="string"),
+                schema.Variable(name="eta", type="real"),
+                schema.Variable(name="pt", type="real"),
+            ],
+            output=schema.Variable(name="a scale", type="real"),
+            data=schema.Category(
+                nodetype="category",
+                input="syst",
+                content=[
+                    schema.CategoryItem(key=f"syst{i}", value=nominal)
+                    for i in range(20)
+                ]
+                + [schema.CategoryItem(key="other", value=pt_binning(2))],
+            ),
+        )
+
+    data = schema.CorrectionSet(
+        schema_version=schema.VERSION,
+        corrections=[make("first"), make("second")],
+    ).json()
+    expected = core.CorrectionSet.from_string(data)
+    assert expected.dedup_savings == 0
+    for options in [{}, {"threads": 2}, {"lazy": True}]:
+        cset = core.CorrectionSet.from_string(data, dedup=True, **options)
+        for name in ["first", "second"]:
+            for args in [
+                ("syst3", -1.0, 60.0),
+                ("syst7", 1.0, 25.0),
+                ("other", 0.0, 0.0),
+            ]:
+                assert cset[name].evaluate(*args) == expected[name].evaluate(*args)
+        assert cset.to_binary() == expected.to_binary()
+        # 19 of the systematics and the edges of all the pt binnings but one
+        assert cset.dedup_savings > 2 * 19 * 3 * 8
+
+
+def test_leaf_encodings():
+    edges = [float(i) for i in range(21)]
+    mostly_one = [1.0] * 400
+    mostly_one[17] = 1.5
+    mostly_one[250] = 0.5
+    few_values = [0.75 + 0.25 * (i % 4) for i in range(400)]
+    all_values = [1.0 + i / 512 for i in range(400)]
+    maps = {"sparse": mostly_one, "dictionary": few_values, "plain": all_values}
+    corr = schema.Correction(
+        name="maps",
+        version=1,
+        inputs=[
+            schema.Variable(name="map", type="string"),
+            schema.Variable(name="x", type="real"),
+            schema.Variable(name="y", type="real"),
+        ],
+        output=schema.Variable(name="a scale", type="real"),
+        data=schema.Category(
+            nodetype="category",
+            input="map",
+            content=[
+                schema.CategoryItem(
+                    key=key,
+                    value=schema.MultiBinning(
+                        nodetype="multibinning",
+                        inputs=["x", "y"],
+                        edges=[edges, edges],
+                        content=content,
+                        flow=1.0,
+                    ),
+                )
+                for key, content in maps.items()
+            ]
+            + [
+                schema.CategoryItem(
+                    key="nodes",
+                    value=schema.Binning(
+                        nodetype="binning",
+                        input="x",
+                        edges=edges,
+                        content=[1.0] * 19
+                        + [
+                            schema.Formula(
+                                nodetype="formula",
+                                expression="2*x",
+                                parser="TFormula",
+                                variables=["y"],
+                            )
+                        ],
+                        flow="clamp",
+                    ),
+                )
+            ],
+        ),
+    )
+    data = schema.CorrectionSet(schema_version=schema.VERSION, corrections=[corr])
+    cset = core.CorrectionSet.from_string(data.json())
+    assert cset["maps"].leaf_encodings() == [
+        ("binning", "dictionary", 21),
+        ("multibinning", "sparse", 401),
+        ("multibinning", "dictionary", 401),
+        ("multibinning", "plain", 401),
+    ]
+    for key, content in maps.items():
+        for i in range(20):
+            for j in range(20):
+                value = cset["maps"].evaluate(key, i + 0.5, j + 0.5)
+                assert value == content[20 * i + j]
+        assert cset["maps"].evaluate(key, -1.0, 0.5) == 1.0
+    assert cset["maps"].evaluate("nodes", 3.5, 3.0) == 1.0
+    assert cset["maps"].evaluate("nodes", 30.0, 3.0) == 6.0
+
+    # stored expanded, and compressed again when loaded from binary
+    binary = core.CorrectionSet.from_binary(cset.to_binary())
+    assert binary["maps"].leaf_encodings() == cset["maps"].leaf_encodings()
+    assert binary.to_binary() == cset.to_binary()
+
+
+def test_binary(tmp_path):
+    np = pytest.importorskip("numpy")
+    corrections = [
+        schema.Correction(
+            name="nested",
+            version=2,
+            inputs=[
+                schema.Variable(name="syst", type="string"),
+                schema.Variable(name="flavor", type="int"),
+                schema.Variable(name="eta", type="real"),
+                schema.Variable(name="pt", type="real"),
+            ],
+            output=schema.Variable(name="sf", type="real"),
+            generic_formulas=[
+                schema.Formula(
+                    nodetype="formula",
+                    expression="[0] + [1]*log(x)",
+                    parser="TFormula",
+                    variables=["pt"],
+                ),
+            ],
+            data=schema.Category(
+                nodetype="category",
+                input="syst",
+                content=[
+                    schema.CategoryItem(
+                        key="nominal",
+                        value=schema.Binning(
+                            nodetype="binning",
+                            input="eta",
+                            edges=[-2.5, -1.5, 0.0, 1.5, 2.5],
+                            content=[
+                                schema.FormulaRef(
+                                    nodetype="formularef",
+                                    index=0,
+                                    parameters=[1.0, 0.01],
+                                ),
+                                schema.Formula(
+                                    nodetype="formula",
+                                    expression="0.9 + 0.1*tanh(y/50)^2",
+                                    parser="TFormula",
+                                    variables=["eta", "pt"],
+                                ),
+                                1.05,
+                                0.95,
+                            ],
+                            flow="clamp",
+                        ),
+                    ),
+                    schema.CategoryItem(
+                        key="up",
+                        value=schema.MultiBinning(
+                            nodetype="multibinning",
+                            inputs=["eta", "pt"],
+                            edges=[
+                                schema.UniformBinning(n=5, low=-2.5, high=2.5),
+                                [20.0, 50.0, 100.0],
+                            ],
+                            content=[1.0 + 0.01 * i for i in range(10)],
+                            flow=0.5,
+                        ),
+                    ),
+                    schema.CategoryItem(
+                        key="down",
+                        value=schema.Transform(
+                            nodetype="transform",
+                            input="flavor",
+                            rule=schema.Formula(
+                                nodetype="formula",
+                                expression="x/2",
+                                parser="TFormula",
+                                variables=["eta"],
+                            ),
+                            content=schema.Category(
+                                nodetype="category",
+                                input="flavor",
+                                content=[
+                                    schema.CategoryItem(key=k * 1000, value=k / 10)
+                                    for k in range(-3, 4)
+                                ],
+                                default=0.0,
+                            ),
+                        ),
+                    ),
+                ],
+                default=schema.MultiBinning(
+                    nodetype="multibinning",
+                    inputs=["pt"],
+                    edges=[[0.0, 30.0, 1000.0]],
+                    content=[
+                        schema.Formula(
+                            nodetype="formula",
+                            expression="x^3",
+                            parser="TFormula",
+                            variables=["pt"],
+                        ),
+                        2.0,
+                    ],
+                    flow="error",
+                ),
+            ),
+        ),
+        schema.Correction(
+            name="scalar",
+            version=1,
+            inputs=[],
+            output=schema.Variable(name="a", type="real"),
+            data=1.5,
+        ),
+    ]
+    data = schema.CorrectionSet(
+        schema_version=schema.VERSION, corrections=corrections
+    ).json()
+    cset = core.CorrectionSet.from_string(data)
+    binary = cset.to_binary()
+    loaded = core.CorrectionSet.from_binary(binary)
+    assert loaded.to_binary() == binary
+    assert list(loaded) == list(cset)
+    assert loaded["scalar"].evaluate() == 1.5
+    assert loaded["nested"].version == 2
+    assert loaded["nested"].string_id("syst", "down") == cset["nested"].string_id(
+        "syst", "down"
+    )
+
+    rng = np.random.default_rng(2)
+    n = 1000
+    args = (
+        rng.choice(["nominal", "up", "down", "other"], size=n),
+        rng.integers(-4, 4, size=n) * 1000,
+        rng.uniform(-3.5, 3.5, size=n),
+        rng.uniform(-10, 200.0, size=n),
+    )
+    args[3][args[3] < 0] = 10.0
+    assert np.array_equal(
+        loaded["nested"].evaluate(*args), cset["nested"].evaluate(*args)
+    )
+
+    # every truncation is detected
+    for i in range(0, len(binary), 7):
+        with pytest.raises(RuntimeError):
+            core.CorrectionSet.from_binary(binary[:i])
+    with pytest.raises(RuntimeError, match="Not binary"):
+        core.CorrectionSet.from_binary(data.encode())
+    # as are bin edges out of order, and uniform binnings with low >= high
+    damaged = []
+    for old, new in [(50.0, 200.0), (-2.5, 2.5)]:
+        damaged.append(binary.replace(struct.pack("=d", old), struct.pack("=d", new)))
+        assert damaged[-1] != binary
+        with pytest.raises(RuntimeError, match="Invalid binary"):
+            core.CorrectionSet.from_binary(damaged[-1])
+
+    # on-disk cache
+    path = tmp_path / "corrections.json"
+    path.write_text(data)
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    first = core.CorrectionSet.from_file(str(path), cache_dir=str(cache_dir))
+    (cached,) = cache_dir.iterdir()
+    assert cached.read_bytes() == binary
+    cached.write_bytes(loaded["nested"].name.encode())
+    assert first.to_binary() == binary
+    assert (
+        core.CorrectionSet.from_file(str(path), cache_dir=str(cache_dir)).to_binary()
+        == binary
+    )
+    assert cached.read_bytes() == binary
+    for item in damaged:
+        cached.write_bytes(item)
+        assert (
+            core.CorrectionSet.from_file(
+                str(path), cache_dir=str(cache_dir)
+            ).to_binary()
+            == binary
+        )
+        assert cached.read_bytes() == binary
+    assert (
+        core.CorrectionSet.from_file(str(path), cache_dir=str(cache_dir)).to_binary()
+        == binary
+    )
+    fast = core.CorrectionSet.from_file(
+        str(path), fast_math=True, cache_dir=str(cache_dir)
+    )
+    assert len(list(cache_dir.iterdir())) == 2
+    assert fast.to_binary() != binary
+
+
+def test_from_buffer(tmp_path):
+    np = pytest.importorskip("numpy")
+    cset = schema.CorrectionSet(
+        schema_version=schema.VERSION,
+        corrections=[numbered_correction(i) for i in range(3)],
+    )
+    data = cset.json().encode()
+    padded = b"  " + data + b" trailing"
+    buffers = [
+        data,
+        bytearray(data),
+        memoryview(padded)[2 : 2 + len(data)],
+        np.frombuffer(data, dtype=np.uint8),
+    ]
+    for buffer in buffers:
+        for lazy in [False, True]:
+            loaded = core.CorrectionSet.from_buffer(buffer, lazy=lazy)
+            assert loaded["corr2"].evaluate(3.0) == 6.0
+    with pytest.raises(RuntimeError, match="JSON parse error"):
+        core.CorrectionSet.from_buffer(memoryview(padded)[2:])
+    with pytest.raises(ValueError):
+        core.CorrectionSet.from_buffer(np.frombuffer(data, dtype=np.uint8)[::2])
+    with pytest.raises(TypeError):
+        core.CorrectionSet.from_buffer(cset.json())
+
+    binary = core.CorrectionSet.from_buffer(data).to_binary()
+    assert core.CorrectionSet.from_binary(bytearray(binary)).to_binary() == binary
+
+    # mapped files
+    path = tmp_path / "corrections.json"
+    path.write_bytes(data)
+    for lazy in [False, True]:
+        loaded = core.CorrectionSet.from_file(str(path), lazy=lazy)
+        assert loaded["corr1"].evaluate(3.0) == 3.0
+    path.write_bytes(b"")
+    with pytest.raises(RuntimeError, match="JSON parse error"):
+        core.CorrectionSet.from_file(str(path))
+    with pytest.raises(RuntimeError, match="Unable to open file"):
+        core.CorrectionSet.from_file(str(tmp_path / "missing.json"))
+
+
+def test_compressed(tmp_path):
+    cset = schema.CorrectionSet(
+        schema_version=schema.VERSION,
+        corrections=[
+            numbered_correction(i, description=f"correction number {i} " * 100)
+            for i in range(200)
+        ],
+    )
+    data = cset.json().encode()
+    # spans several chunks of the decompressing stream
+    assert len(data) > 4 * 65536
+    codecs = {"gz": gzip.compress, "xz": lzma.compress}
+    try:
+        import zstandard
+
+        codecs["zst"] = zstandard.ZstdCompressor().compress
+    except ImportError:
+        pass
+    for suffix, compress in codecs.items():
+        path = tmp_path / f"corrections.json.{suffix}"
+        path.write_bytes(compress(data))
+        try:
+            core.CorrectionSet.from_file(str(path))
+        except RuntimeError as ex:
+            assert "correctionlib was built without" in str(ex)
+            continue
+        for lazy in [False, True]:
+            loaded = core.CorrectionSet.from_file(str(path), lazy=lazy)
+            assert loaded["corr199"].evaluate(2.0) == 398.0
+            loaded = core.CorrectionSet.from_buffer(path.read_bytes(), lazy=lazy)
+            assert loaded["corr3"].evaluate(2.0) == 6.0
+        cache_dir = tmp_path / suffix
+        cache_dir.mkdir()
+        for _ in range(2):
+            loaded = core.CorrectionSet.from_file(str(path), cache_dir=str(cache_dir))
+            assert loaded["corr5"].evaluate(2.0) == 10.0
+        assert len(list(cache_dir.iterdir())) == 1
+
+        path.write_bytes(compress(data)[:-100])
+        with pytest.raises(RuntimeError, match="compressed data"):
+            core.CorrectionSet.from_file(str(path))
+        path.write_bytes(compress(data[:-1]))
+        with pytest.raises(RuntimeError, match="JSON parse error"):
+            core.CorrectionSet.from_file(str(path))
+
+    # concatenated members, as written by appending to a .gz file
+    path = tmp_path / "concatenated.json.gz"
+    path.write_bytes(gzip.compress(data[:100000]) + gzip.compress(data[100000:]))
+    try:
+        loaded = core.CorrectionSet.from_file(str(path))
+    except RuntimeError as ex:
+        assert "correctionlib was built without" in str(ex)
+    else:
+        assert loaded["corr199"].evaluate(2.0) == 398.0